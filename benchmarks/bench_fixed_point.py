@@ -0,0 +1,73 @@
+"""Benchmark of Decimal against fixed point (STATE_FIXED_POINT) chat data.
+
+Times print_to_string_balance_info and the (de)serialization of the pinned
+data message and of SQLite snapshots for chats with many categories:
+
+    python benchmarks/bench_fixed_point.py --categories 10,100,1000
+"""
+
+import argparse
+import os
+import random
+import sys
+import timeit
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+os.environ.setdefault("TELEGRAM_BOT_KEY", "benchmark")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--categories", default="10,100,1000")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args()
+
+
+def best_time(func, number):
+    return min(timeit.repeat(func, number=number, repeat=5)) / number
+
+
+def main(args):
+    import codec
+    import fixed_point
+    from budget import Category
+    from main import print_to_string_balance_info
+
+    random.seed(args.seed)
+    header = (
+        f"{'operation':<22}{'cats':>6}{'decimal us':>12}{'fixed us':>10}{'speedup':>9}"
+    )
+    print(header)
+    print("-" * len(header))
+    for categories in (int(c) for c in args.categories.split(",")):
+        decimal_data = {}
+        for i in range(categories):
+            limit = Decimal(random.randint(100, 5000))
+            spent = Decimal(random.randint(0, 50000)) / 100
+            decimal_data[f"cat_{i}"] = Category(limit, limit - spent)
+        fixed_data = fixed_point.to_fixed_point(decimal_data, 2)
+        decimal_message = codec.encode_message(decimal_data)
+        fixed_message = codec.encode_message(fixed_data)
+        decimal_json = codec.dumps_data(decimal_data)
+        fixed_json = codec.dumps_data(fixed_data)
+        rows = [
+            ("print balance info", print_to_string_balance_info, None),
+            ("encode message", codec.encode_message, None),
+            ("decode message", codec.decode_message, (decimal_message, fixed_message)),
+            ("dump snapshot", codec.dumps_data, None),
+            ("load snapshot", codec.loads_data, (decimal_json, fixed_json)),
+        ]
+        number = max(1, 20000 // categories)
+        for name, func, inputs in rows:
+            decimal_input, fixed_input = inputs or (decimal_data, fixed_data)
+            decimal_time = best_time(lambda: func(decimal_input), number) * 1e6
+            fixed_time = best_time(lambda: func(fixed_input), number) * 1e6
+            print(
+                f"{name:<22}{categories:>6}{decimal_time:>12.1f}{fixed_time:>10.1f}"
+                f"{decimal_time / fixed_time:>8.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,206 @@
+"""Benchmark of the bot handlers against an in-process fake Telegram Bot.
+
+Runs every command of main.py for each combination of chat and category
+counts and reports throughput, latency percentiles and Telegram API calls
+per command. No network access is needed:
+
+    python benchmarks/bench_handlers.py --chats 1,100 --categories 10,200 --latency-ms 30
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from fake_bot import (  # noqa: E402
+    FakeBot,
+    make_callback_update,
+    make_context,
+    make_update,
+)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chats", default="1,10,100")
+    parser.add_argument("--categories", default="10,100")
+    parser.add_argument("--ops", type=int, default=500, help="commands per row")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--storage", choices=("pinned", "sqlite"), default="pinned")
+    parser.add_argument("--write-delay", type=float, default=0.0)
+    parser.add_argument(
+        "--fixed-point", action="store_true", help="keep amounts as integers"
+    )
+    parser.add_argument(
+        "--rate-limits",
+        action="store_true",
+        help="keep the outbound scheduler's Telegram rate limits",
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args()
+
+
+class ErrorCounter(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+# (name, handler name in main.py, text of the message for a category count)
+COMMANDS = [
+    ("spend", "spend", lambda n: f"{random.randint(1, 99)} cat_{random.randrange(n)}"),
+    (
+        "spend misspelled",
+        "spend",
+        lambda n: f"{random.randint(1, 99)} Cat-{random.randrange(n)}s",
+    ),
+    (
+        "spend x5",
+        "spend",
+        lambda n: "\n".join(
+            f"{random.randint(1, 99)} cat_{random.randrange(n)}" for _ in range(5)
+        ),
+    ),
+    ("spend group", "spend", lambda n: f"{random.randint(1, 99)} food"),
+    ("get_all_balance_info", "get_all_balance_info", lambda n: "/get_all_balance_info"),
+    (
+        "upsert_balance",
+        "upsert_balance",
+        lambda n: f"/upsert_balance {random.randint(100, 999)} cat_{random.randrange(n)}",
+    ),
+    (
+        "change_limit",
+        "change_limit",
+        lambda n: f"/change_limit {random.randint(100, 999)} cat_{random.randrange(n)}",
+    ),
+    ("reset_limits", "reset_limits", lambda n: "/reset_limits"),
+    ("report", "report", lambda n: "/report"),
+    (
+        "quick spend",
+        "quick_button",
+        lambda n: f"q:s:{random.choice((1, 5, 10))}:cat_{random.randrange(n)}",
+    ),
+]
+
+# Messages of COMMANDS starting with this are callback data of a button press
+CALLBACK_PREFIX = "q:"
+
+
+async def run_command(handler, bot, chat_ids, make_text, categories, ops, concurrency):
+    context = make_context(bot)
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(i):
+        text = make_text(categories)
+        if text.startswith(CALLBACK_PREFIX):
+            update = make_callback_update(bot, chat_ids[i % len(chat_ids)], text)
+        else:
+            update = make_update(bot, chat_ids[i % len(chat_ids)], text)
+        async with semaphore:
+            started = time.perf_counter()
+            await handler(update, context)
+            latencies.append(time.perf_counter() - started)
+
+    bot.calls.clear()
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(ops)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "ops/s": ops / elapsed,
+        "p50 ms": percentile(latencies, 0.5) * 1000,
+        "p99 ms": percentile(latencies, 0.99) * 1000,
+        "api/op": sum(bot.calls.values()) / ops,
+    }
+
+
+async def run(args):
+    import codec
+    import main
+    import spending
+    import state
+    from budget import Category
+
+    spending.store.open(tempfile.mkdtemp(prefix="money-counter-bench-"))
+    logging.getLogger().setLevel(logging.WARNING)
+    errors = ErrorCounter()
+    logging.getLogger().addHandler(errors)
+    random.seed(args.seed)
+
+    header = f"{'command':<27}{'chats':>7}{'cats':>6}{'ops/s':>10}{'p50 ms':>9}{'p99 ms':>9}{'api/op':>8}{'errors':>8}"
+    print(header)
+    print("-" * len(header))
+    next_chat_id = 1
+    for chats in (int(c) for c in args.chats.split(",")):
+        for categories in (int(c) for c in args.categories.split(",")):
+            bot = FakeBot(args.latency_ms / 1000)
+            chat_ids = list(range(next_chat_id, next_chat_id + chats))
+            next_chat_id += chats
+            data = {
+                f"cat_{i}": Category(Decimal(1000), Decimal(1000))
+                for i in range(categories)
+            }
+            # A group for "spend group"
+            for week in range(1, 5):
+                data[f"food.week_{week}"] = Category(Decimal(250), Decimal(250))
+            for chat_id in chat_ids:
+                bot.seed_pinned(chat_id, codec.encode_message(data))
+            state.invalidate_cache()
+
+            rows = [("cold get_all_balance_info", "get_all_balance_info", None)]
+            rows += COMMANDS
+            for name, handler_name, make_text in rows:
+                errors.count = 0
+                ops = args.ops
+                if make_text is None:
+                    make_text, ops = (lambda n: "/get_all_balance_info"), chats
+                result = await run_command(
+                    getattr(main, handler_name),
+                    bot,
+                    chat_ids,
+                    make_text,
+                    categories,
+                    ops,
+                    args.concurrency,
+                )
+                print(
+                    f"{name:<27}{chats:>7}{categories:>6}{result['ops/s']:>10.0f}"
+                    f"{result['p50 ms']:>9.2f}{result['p99 ms']:>9.2f}"
+                    f"{result['api/op']:>8.2f}{errors.count:>8}"
+                )
+            await state.flush_pending_writes()
+    await state.shutdown()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    os.environ["STATE_STORAGE"] = args.storage
+    os.environ["STATE_WRITE_DELAY"] = str(args.write_delay)
+    os.environ["STATE_FIXED_POINT"] = "1" if args.fixed_point else "0"
+    if not args.rate_limits:
+        os.environ["OUTBOUND_CHAT_RATE"] = "0"
+        os.environ["OUTBOUND_GLOBAL_RATE"] = "0"
+    if args.storage == "sqlite":
+        os.environ["STATE_SQLITE_PATH"] = os.path.join(
+            tempfile.mkdtemp(prefix="money-counter-bench-"), "bench.db"
+        )
+    asyncio.run(run(args))
@@ -0,0 +1,105 @@
+"""Memory taken by the cached state of many chats.
+
+Builds the data of many chats with a few categories each in the old layout
+of nested {"limit": Decimal, "balance": Decimal} dicts, as Categories with
+Decimal amounts, as FixedPointData and as the ChatState the cache keeps.
+Every layout is built in a fresh process, and the growth of its resident
+set is reported per chat:
+
+    python benchmarks/bench_memory.py --chats 10000,100000,1000000 --categories 5
+"""
+
+import argparse
+import os
+import resource
+import subprocess
+import sys
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+LAYOUTS = ("dict", "category", "fixed point", "chat state")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chats", default="10000,100000,1000000")
+    parser.add_argument("--categories", type=int, default=5)
+    parser.add_argument("--child", nargs=3, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def max_rss() -> int:
+    # Kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# Data of one chat as it is after some spends, every name and amount its own
+# object like when it is parsed from a pinned message
+def chat_data(chat: int, categories: int, layout: str):
+    from budget import Category
+
+    data = {}
+    for i in range(categories):
+        limit = Decimal(100 + i * 50)
+        balance = limit - Decimal(chat % 1000) / 100
+        if layout == "dict":
+            data[f"category {i}"] = {"limit": limit, "balance": balance}
+        else:
+            data[f"category {i}"] = Category(limit, balance)
+    return data
+
+
+def build(layout: str, chats: int, categories: int) -> int:
+    import fixed_point
+    from chat_state import ChatState
+
+    before = max_rss()
+    kept = []
+    for chat in range(chats):
+        data = chat_data(chat, categories, layout)
+        if layout == "fixed point":
+            data = fixed_point.to_fixed_point(data, 2)
+        elif layout == "chat state":
+            data = ChatState(data)
+        kept.append(data)
+    return max_rss() - before
+
+
+def main(args):
+    if args.child:
+        layout, chats, categories = args.child
+        print(build(layout, int(chats), int(categories)))
+        return
+    header = (
+        f"{'layout':<14}{'chats':>10}{'total MB':>11}{'bytes/chat':>12}{'vs dict':>9}"
+    )
+    print(f"{args.categories} categories per chat")
+    print(header)
+    print("-" * len(header))
+    for chats in (int(c) for c in args.chats.split(",")):
+        dict_bytes = None
+        for layout in LAYOUTS:
+            output = subprocess.run(
+                [
+                    sys.executable,
+                    __file__,
+                    "--child",
+                    layout,
+                    str(chats),
+                    str(args.categories),
+                ],
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout
+            used = int(output)
+            dict_bytes = dict_bytes or used
+            print(
+                f"{layout:<14}{chats:>10}{used / 2**20:>11.1f}{used / chats:>12.0f}"
+                f"{used / dict_bytes:>8.2f}x"
+            )
+
+
+if __name__ == "__main__":
+    main(parse_args())
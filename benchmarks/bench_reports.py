@@ -0,0 +1,92 @@
+"""Benchmark of /report over the columnar spending history.
+
+Fills the history of one chat with a year of spends, then times loading it
+from disk and every kind of report:
+
+    python benchmarks/bench_reports.py --spends 10000,100000 --categories 30
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import timeit
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+YEAR = 365 * 86400
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--spends", default="1000,10000,100000")
+    parser.add_argument("--categories", type=int, default=30)
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args()
+
+
+def best_time(func, number):
+    return min(timeit.repeat(func, number=number, repeat=5)) / number
+
+
+def main(args):
+    import ledger
+    import spending
+
+    random.seed(args.seed)
+    now = time.time()
+    names = [f"cat_{i}" for i in range(args.categories)]
+    limits = {name: 300.0 for name in names}
+    header = f"{'operation':<22}{'spends':>8}{'ms':>10}"
+    print(header)
+    print("-" * len(header))
+    for chat_id, spends in enumerate(int(s) for s in args.spends.split(",")):
+        path = tempfile.mkdtemp(prefix="money-counter-bench-")
+        store = spending.SpendingStore(1, YEAR)
+        store.open(path)
+        timestamps = sorted(now - random.random() * YEAR for _ in range(spends))
+        events = [
+            ledger.Event(
+                ledger.SPEND,
+                random.choice(names),
+                Decimal(random.randint(1, 9999)) / 100,
+                ts,
+            )
+            for ts in timestamps
+        ]
+        while events:
+            store.record(chat_id, events[:1000])
+            del events[:1000]
+
+        def load():
+            cold_store = spending.SpendingStore(1, YEAR)
+            cold_store.open(path)
+            cold_store.get(chat_id)
+
+        columns = store.get(chat_id)
+        rows = [
+            ("load history", load),
+            (
+                "month by category",
+                lambda: spending.category_report(
+                    columns, spending.MONTH, now, "UTC", limits
+                ),
+            ),
+            (
+                "top 5 this month",
+                lambda: spending.top_report(columns, spending.MONTH, now, "UTC", 5),
+            ),
+            (
+                "last 52 weeks",
+                lambda: spending.period_report(columns, spending.WEEK, now, "UTC", 52),
+            ),
+        ]
+        for name, func in rows:
+            print(f"{name:<22}{spends:>8}{best_time(func, 20) * 1000:>10.2f}")
+
+
+if __name__ == "__main__":
+    main(parse_args())
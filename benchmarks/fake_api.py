@@ -0,0 +1,171 @@
+"""Local stand-in for the Telegram Bot API server.
+
+Serves the Bot API methods the bot uses over HTTP, keeps the messages and
+pinned messages of every chat in memory, and can add latency to every call,
+answer a share of them with 429 Too Many Requests and be down, answering
+every call with 502 Bad Gateway.
+"""
+
+import asyncio
+import itertools
+import json
+import logging
+import random
+import time
+from collections import Counter
+import tornado.netutil
+import tornado.web
+from tornado.httpserver import HTTPServer
+
+BOT_USER = {
+    "id": 1,
+    "is_bot": True,
+    "first_name": "Money counter",
+    "username": "money_counter_load_test_bot",
+}
+
+
+def _chat(chat_id: int) -> dict:
+    return {"id": chat_id, "type": "group", "title": f"chat {chat_id}"}
+
+
+class _MethodHandler(tornado.web.RequestHandler):
+    def initialize(self, api):
+        self.api = api
+
+    def check_xsrf_cookie(self):
+        pass
+
+    # PTB sends every parameter as form data, JSON encoded unless it is a string
+    def _parameters(self) -> dict:
+        parameters = {}
+        for name in self.request.body_arguments:
+            value = self.get_body_argument(name)
+            try:
+                parameters[name] = json.loads(value)
+            except ValueError:
+                parameters[name] = value
+        return parameters
+
+    async def post(self, token: str, method: str):
+        status, body = await self.api.handle(method, self._parameters())
+        self.set_status(status)
+        self.set_header("Content-Type", "application/json")
+        self.finish(json.dumps(body))
+
+
+class FakeBotApi:
+    def __init__(
+        self, latency: float = 0.0, rate_limit_share: float = 0.0, retry_after: int = 1
+    ):
+        self.latency = latency
+        self.rate_limit_share = rate_limit_share
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self.rate_limited = Counter()
+        self.failed = Counter()
+        # While set every call but getMe fails like in a Telegram outage
+        self.down = False
+        self._messages: dict[tuple[int, int], dict] = {}
+        self._pinned: dict[int, int] = {}
+        self._message_ids = itertools.count(1_000_000_000)
+        self._server = None
+
+    def _new_message(self, chat_id: int, text: str, **fields) -> dict:
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": _chat(chat_id),
+            "from": BOT_USER,
+            "text": text,
+            **fields,
+        }
+        self._messages[(chat_id, message["message_id"])] = message
+        return message
+
+    # Pins a message with the text, to prepare chats
+    def seed_pinned(self, chat_id: int, text: str):
+        self._pinned[chat_id] = self._new_message(chat_id, text)["message_id"]
+
+    # Sends a bot message to prepare chats, like the message of /quick
+    def seed_message(self, chat_id: int, text: str) -> dict:
+        return self._new_message(chat_id, text)
+
+    def _get_chat(self, parameters: dict) -> dict:
+        chat_id = int(parameters["chat_id"])
+        chat = {**_chat(chat_id), "accent_color_id": 0, "max_reaction_count": 11}
+        message_id = self._pinned.get(chat_id)
+        if message_id is not None:
+            chat["pinned_message"] = self._messages[(chat_id, message_id)]
+        return chat
+
+    def _send_message(self, parameters: dict) -> dict:
+        return self._new_message(int(parameters["chat_id"]), str(parameters["text"]))
+
+    def _edit_message_text(self, parameters: dict) -> dict:
+        key = (int(parameters["chat_id"]), int(parameters["message_id"]))
+        message = self._messages.get(key)
+        if message is None:
+            raise LookupError("Bad Request: message to edit not found")
+        message["text"] = str(parameters["text"])
+        return message
+
+    def _pin_chat_message(self, parameters: dict) -> bool:
+        self._pinned[int(parameters["chat_id"])] = int(parameters["message_id"])
+        return True
+
+    def _send_document(self, parameters: dict) -> dict:
+        document = {"file_id": "document", "file_unique_id": "document"}
+        return self._new_message(int(parameters["chat_id"]), "", document=document)
+
+    METHODS = {
+        "getMe": lambda self, parameters: BOT_USER,
+        "getChat": _get_chat,
+        "sendMessage": _send_message,
+        "editMessageText": _edit_message_text,
+        "pinChatMessage": _pin_chat_message,
+        "sendDocument": _send_document,
+        "answerCallbackQuery": lambda self, parameters: True,
+        "deleteWebhook": lambda self, parameters: True,
+    }
+
+    async def handle(self, method: str, parameters: dict) -> tuple[int, dict]:
+        self.calls[method] += 1
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+        if method != "getMe" and self.down:
+            self.failed[method] += 1
+            return 502, {"ok": False, "error_code": 502, "description": "Bad Gateway"}
+        if method != "getMe" and random.random() < self.rate_limit_share:
+            self.rate_limited[method] += 1
+            return 429, {
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }
+        handler = self.METHODS.get(method)
+        if handler is None:
+            return 404, {"ok": False, "error_code": 404, "description": "Not Found"}
+        try:
+            return 200, {"ok": True, "result": handler(self, parameters)}
+        except LookupError as e:
+            return 400, {"ok": False, "error_code": 400, "description": str(e.args[0])}
+
+    # Starts serving on the port, 0 picks a free one. Returns the base URL
+    # for Application.builder().base_url()
+    def start(self, port: int = 0) -> str:
+        # 429 answers would be logged as warnings
+        logging.getLogger("tornado.access").setLevel(logging.ERROR)
+        app = tornado.web.Application(
+            [(r"/bot([^/]+)/(\w+)", _MethodHandler, {"api": self})]
+        )
+        self._server = HTTPServer(app)
+        sockets = tornado.netutil.bind_sockets(port, "127.0.0.1")
+        self._server.add_sockets(sockets)
+        port = sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{port}/bot"
+
+    def stop(self):
+        if self._server is not None:
+            self._server.stop()
@@ -0,0 +1,127 @@
+import asyncio
+import itertools
+from collections import Counter
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from telegram import CallbackQuery, Chat, Message, MessageEntity, Update, User
+
+
+class FakeMessage:
+    __slots__ = ("chat_id", "message_id", "text")
+
+    def __init__(self, chat_id: int, message_id: int, text: str):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.text = text
+
+
+# In-process stand-in for telegram.Bot with the methods the bot uses. Every
+# call is counted per method and takes `latency` seconds
+class FakeBot:
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self._messages: dict[tuple[int, int], FakeMessage] = {}
+        self._pinned: dict[int, FakeMessage] = {}
+        self._keyboards: dict[int, FakeMessage] = {}
+        self._message_ids = itertools.count(1)
+
+    async def _call(self, method: str):
+        self.calls[method] += 1
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+
+    def _new_message(self, chat_id: int, text: str) -> FakeMessage:
+        message = FakeMessage(chat_id, next(self._message_ids), text)
+        self._messages[(chat_id, message.message_id)] = message
+        return message
+
+    # Pins a message without counting a call, to prepare chats
+    def seed_pinned(self, chat_id: int, text: str):
+        self._pinned[chat_id] = self._new_message(chat_id, text)
+
+    # The message with an inline keyboard of the chat, sent without counting
+    # a call the first time
+    def keyboard_message(self, chat_id: int) -> FakeMessage:
+        message = self._keyboards.get(chat_id)
+        if message is None:
+            message = self._keyboards[chat_id] = self._new_message(
+                chat_id, "Choose a category."
+            )
+        return message
+
+    async def get_chat(self, chat_id: int, **kwargs):
+        await self._call("get_chat")
+        return SimpleNamespace(id=chat_id, pinned_message=self._pinned.get(chat_id))
+
+    async def send_message(self, chat_id: int, text: str, **kwargs):
+        await self._call("send_message")
+        return self._new_message(chat_id, text)
+
+    async def edit_message_text(
+        self, text: str, chat_id: int = None, message_id: int = None, **kwargs
+    ):
+        await self._call("edit_message_text")
+        message = self._messages[(chat_id, message_id)]
+        message.text = text
+        return message
+
+    async def answer_callback_query(self, callback_query_id: str, **kwargs):
+        await self._call("answer_callback_query")
+        return True
+
+    async def pin_chat_message(self, chat_id: int, message_id: int, **kwargs):
+        await self._call("pin_chat_message")
+        self._pinned[chat_id] = self._messages[(chat_id, message_id)]
+        return True
+
+
+_update_ids = itertools.count(1)
+
+
+# Builds a real text message update bound to the bot, commands get their
+# bot_command entity like the ones sent by Telegram
+def make_update(bot, chat_id: int, text: str) -> Update:
+    update_id = next(_update_ids)
+    entities = None
+    if text.startswith("/"):
+        command_length = len(text.split(maxsplit=1)[0])
+        entities = [MessageEntity(MessageEntity.BOT_COMMAND, 0, command_length)]
+    message = Message(
+        update_id,
+        datetime.now(timezone.utc),
+        Chat(chat_id, Chat.GROUP),
+        from_user=User(1, "bench", False),
+        text=text,
+        entities=entities,
+    )
+    message.set_bot(bot)
+    update = Update(update_id, message=message)
+    update.set_bot(bot)
+    return update
+
+
+# Builds a press of an inline keyboard button with the callback data. All
+# presses in a chat are on the same bot message, like the /quick message
+def make_callback_update(bot, chat_id: int, data: str) -> Update:
+    update_id = next(_update_ids)
+    keyboard_message = bot.keyboard_message(chat_id)
+    message = Message(
+        keyboard_message.message_id,
+        datetime.now(timezone.utc),
+        Chat(chat_id, Chat.GROUP),
+        from_user=User(0, "bot", True),
+        text=keyboard_message.text,
+    )
+    message.set_bot(bot)
+    query = CallbackQuery(
+        str(update_id), User(1, "bench", False), str(chat_id), message, data=data
+    )
+    query.set_bot(bot)
+    update = Update(update_id, callback_query=query)
+    update.set_bot(bot)
+    return update
+
+
+def make_context(bot):
+    return SimpleNamespace(bot=bot, application=SimpleNamespace(bot=bot))
@@ -0,0 +1,330 @@
+"""End-to-end load test of the bot against a local Bot API stand-in.
+
+Generates synthetic traffic of many chats: spends, bursts of spends, other
+commands, group chatter, edited messages and /quick button presses. The
+updates arrive on a fixed schedule and go through Application.process_update
+of the application built by main.create_app, which talks to the local
+server of fake_api.py over HTTP. Reports sustained updates/sec, queue depth
+and latency percentiles measured from the scheduled arrival of each update:
+
+    python benchmarks/load_test.py --chats 1000 --rate 500 --duration 30 --latency-ms 50 --rate-limited 0.01
+
+With --outage the server is down for a while, and the state writes left
+pending when the traffic ends are waited for:
+
+    python benchmarks/load_test.py --duration 20 --outage 5 10
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from bench_handlers import ErrorCounter, percentile  # noqa: E402
+from fake_api import FakeBotApi  # noqa: E402
+
+TOKEN = "123456:LOADTEST"
+# Share of every kind of traffic, bursts count as one
+KINDS = {
+    "spend": 40,
+    "burst": 8,
+    "chatter": 30,
+    "command": 10,
+    "edited": 6,
+    "quick": 6,
+}
+COMMANDS = (
+    "/get_all_balance_info",
+    "/history 5",
+    "/report",
+    "/report top 3",
+    "/help",
+)
+CHATTER = (
+    "see you tomorrow",
+    "who is buying milk?",
+    "ok",
+    "thanks!",
+    "the cat ate again",
+    "did anyone pay the rent",
+)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chats", type=int, default=1000)
+    parser.add_argument("--categories", type=int, default=20)
+    parser.add_argument("--rate", type=float, default=200, help="updates per second")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds")
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument(
+        "--rate-limited",
+        type=float,
+        default=0.0,
+        help="share of Bot API calls answered with 429",
+    )
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument(
+        "--outage",
+        type=float,
+        nargs=2,
+        metavar=("START", "END"),
+        help="seconds from the start during which the server is down",
+    )
+    parser.add_argument("--storage", choices=("pinned", "sqlite"), default="pinned")
+    parser.add_argument("--write-delay", type=float, default=0.0)
+    parser.add_argument(
+        "--rate-limits",
+        action="store_true",
+        help="keep the outbound scheduler's Telegram rate limits",
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args()
+
+
+# Builds raw updates like Telegram sends them, with increasing ids
+class TrafficGenerator:
+    def __init__(self, chats: int, categories: int, keyboard_ids: dict[int, int]):
+        self.chat_ids = list(range(1, chats + 1))
+        # A few chats are much busier than the rest
+        self.weights = [1 / rank**1.1 for rank in range(1, chats + 1)]
+        self.categories = categories
+        self.keyboard_ids = keyboard_ids
+        self._update_id = 0
+        self._message_ids: dict[int, int] = {}
+        self._spends: dict[int, dict] = {}
+
+    def _chat(self) -> int:
+        return random.choices(self.chat_ids, self.weights)[0]
+
+    def _message(self, chat_id: int, text: str) -> dict:
+        message_id = self._message_ids.get(chat_id, 0) + 1
+        self._message_ids[chat_id] = message_id
+        message = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "group", "title": f"chat {chat_id}"},
+            "from": {"id": 1000 + chat_id, "is_bot": False, "first_name": "user"},
+            "text": text,
+        }
+        if text.startswith("/"):
+            length = len(text.split(maxsplit=1)[0])
+            message["entities"] = [
+                {"type": "bot_command", "offset": 0, "length": length}
+            ]
+        return message
+
+    def _update(self, **fields) -> dict:
+        self._update_id += 1
+        return {"update_id": self._update_id, **fields}
+
+    def _spend_text(self) -> str:
+        return f"{random.randint(1, 99)} cat_{random.randrange(self.categories)} lunch"
+
+    def _spend(self, chat_id: int) -> dict:
+        message = self._message(chat_id, self._spend_text())
+        self._spends[chat_id] = message
+        return self._update(message=message)
+
+    def _edited(self, chat_id: int) -> dict:
+        message = self._spends.get(chat_id)
+        if message is None:
+            return self._spend(chat_id)
+        edited = {**message, "text": self._spend_text(), "edit_date": int(time.time())}
+        return self._update(edited_message=edited)
+
+    def _quick(self, chat_id: int) -> dict:
+        data = (
+            f"q:s:{random.choice((1, 5, 10))}:cat_{random.randrange(self.categories)}"
+        )
+        message = {
+            "message_id": self.keyboard_ids[chat_id],
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "group", "title": f"chat {chat_id}"},
+            "text": "Choose a category.",
+        }
+        return self._update(
+            callback_query={
+                "id": str(self._update_id),
+                "from": {"id": 1000 + chat_id, "is_bot": False, "first_name": "user"},
+                "chat_instance": str(chat_id),
+                "message": message,
+                "data": data,
+            }
+        )
+
+    # (seconds from the start, raw update) for Poisson arrivals at the rate
+    def schedule(self, rate: float, duration: float) -> list[tuple[float, dict]]:
+        kinds, weights = zip(*KINDS.items())
+        arrivals = []
+        at = 0.0
+        while True:
+            at += random.expovariate(rate)
+            if at >= duration:
+                break
+            chat_id = self._chat()
+            kind = random.choices(kinds, weights)[0]
+            if kind == "spend":
+                arrivals.append((at, self._spend(chat_id)))
+            elif kind == "burst":
+                # Several people of one chat sending their spends at once
+                burst_at = at
+                for _ in range(random.randint(3, 8)):
+                    arrivals.append((burst_at, self._spend(chat_id)))
+                    burst_at += random.uniform(0.0, 0.3)
+            elif kind == "chatter":
+                text = random.choice(CHATTER)
+                arrivals.append(
+                    (at, self._update(message=self._message(chat_id, text)))
+                )
+            elif kind == "command":
+                text = random.choice(COMMANDS)
+                arrivals.append(
+                    (at, self._update(message=self._message(chat_id, text)))
+                )
+            elif kind == "edited":
+                arrivals.append((at, self._edited(chat_id)))
+            else:
+                arrivals.append((at, self._quick(chat_id)))
+        arrivals.sort(key=lambda arrival: arrival[0])
+        return arrivals
+
+
+async def run(args):
+    from telegram import Update
+    import codec
+    import main
+    import outbound
+    import state
+    from budget import Category
+
+    logging.getLogger().setLevel(logging.WARNING)
+    errors = ErrorCounter()
+    logging.getLogger().addHandler(errors)
+    random.seed(args.seed)
+
+    api = FakeBotApi(args.latency_ms / 1000, args.rate_limited, args.retry_after)
+    base_url = api.start()
+    data = {
+        f"cat_{i}": Category(Decimal(100000), Decimal(100000))
+        for i in range(args.categories)
+    }
+    data_message = codec.encode_message(data)
+    keyboard_ids = {}
+    for chat_id in range(1, args.chats + 1):
+        api.seed_pinned(chat_id, data_message)
+        keyboard_ids[chat_id] = api.seed_message(chat_id, "Choose a category.")[
+            "message_id"
+        ]
+    arrivals = TrafficGenerator(args.chats, args.categories, keyboard_ids).schedule(
+        args.rate, args.duration
+    )
+
+    app = main.create_app(
+        TOKEN,
+        metrics_port=0,
+        dedupe_path=os.path.join(args.work_dir, "dedupe"),
+        schedules_path=os.path.join(args.work_dir, "schedules.json"),
+        base_url=base_url,
+        outbox_path=os.path.join(args.work_dir, "outbox.jsonl"),
+    )
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+    api.calls.clear()
+
+    loop = asyncio.get_running_loop()
+    latencies = []
+    in_flight = 0
+    depths = []
+    outbound_depths = []
+
+    async def handle(update: Update, due: float):
+        nonlocal in_flight
+        try:
+            await app.update_processor.process_update(
+                update, app.process_update(update)
+            )
+        finally:
+            in_flight -= 1
+            latencies.append(loop.time() - due)
+
+    async def sample():
+        while True:
+            depths.append(in_flight)
+            outbound_depths.append(len(outbound.scheduler))
+            await asyncio.sleep(0.1)
+
+    async def outage(start: float, end: float):
+        await asyncio.sleep(start)
+        api.down = True
+        await asyncio.sleep(end - start)
+        api.down = False
+
+    sampler = asyncio.create_task(sample())
+    if args.outage:
+        asyncio.create_task(outage(*args.outage))
+    tasks = []
+    started = loop.time()
+    for at, raw in arrivals:
+        due = started + at
+        delay = due - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        in_flight += 1
+        update = Update.de_json(raw, app.bot)
+        tasks.append(asyncio.create_task(handle(update, due)))
+    await asyncio.gather(*tasks)
+    elapsed = loop.time() - started
+    sampler.cancel()
+    pending_writes = len(state._outbox)
+    while len(state._outbox) and loop.time() - started < args.duration + 120:
+        await asyncio.sleep(0.1)
+    drained = loop.time() - started - elapsed
+
+    await app.stop()
+    await app.post_stop(app)
+    await app.shutdown()
+    await state.shutdown()
+    api.stop()
+
+    latencies.sort()
+    print(f"updates          {len(arrivals)} in {elapsed:.1f}s")
+    print(f"offered          {len(arrivals) / args.duration:.0f} updates/s")
+    print(f"sustained        {len(arrivals) / elapsed:.0f} updates/s")
+    for name, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+        print(f"latency {name}      {percentile(latencies, fraction) * 1000:.1f} ms")
+    print(f"latency max      {latencies[-1] * 1000:.1f} ms")
+    print(f"queue depth      mean {sum(depths) / len(depths):.1f}, max {max(depths)}")
+    print(
+        f"outbound queue   mean {sum(outbound_depths) / len(outbound_depths):.1f}, "
+        f"max {max(outbound_depths)}"
+    )
+    print(f"api calls        {sum(api.calls.values())} {dict(api.calls)}")
+    print(f"429 answers      {sum(api.rate_limited.values())}")
+    print(f"failed calls     {sum(api.failed.values())} {dict(api.failed)}")
+    print(
+        f"pending writes   {pending_writes} at the end, "
+        f"{len(state._outbox)} left after {drained:.1f}s"
+    )
+    print(f"errors logged    {errors.count}")
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    os.environ["STATE_STORAGE"] = args.storage
+    os.environ["STATE_WRITE_DELAY"] = str(args.write_delay)
+    if not args.rate_limits:
+        os.environ["OUTBOUND_CHAT_RATE"] = "0"
+        os.environ["OUTBOUND_GLOBAL_RATE"] = "0"
+    args.work_dir = tempfile.mkdtemp(prefix="money-counter-load-")
+    os.environ["STATE_SQLITE_PATH"] = os.path.join(args.work_dir, "load.db")
+    os.environ["SPENDING_PATH"] = os.path.join(args.work_dir, "spending")
+    asyncio.run(run(args))
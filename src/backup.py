@@ -0,0 +1,206 @@
+import asyncio
+import csv
+import io
+import json
+import os
+from datetime import datetime, timezone
+from decimal import Decimal, InvalidOperation
+from typing import IO, Iterator
+from budget import MAX_AMOUNT_DIGITS, Category, is_amount
+from spending import SpendColumns
+
+CSV = "csv"
+JSONL = "jsonl"
+FORMATS = (CSV, JSONL)
+
+# Kinds of records, a balance of the chat or a spend of its history
+BALANCE = "balance"
+SPEND = "spend"
+CSV_FIELDS = ("record", "time", "type", "limit", "balance", "amount")
+
+# Rows formatted at a time by /export, and spends appended at a time by
+# /import
+EXPORT_CHUNK = 1000
+IMPORT_BATCH = int(os.getenv("IMPORT_BATCH", "1000"))
+# Bots can't download bigger files
+IMPORT_MAX_SIZE = 20 * 1024 * 1024
+
+
+def format_for(file_name: str | None) -> str:
+    if file_name and file_name.lower().endswith((".jsonl", ".json")):
+        return JSONL
+    return CSV
+
+
+def _time(ts: float) -> str:
+    return datetime.fromtimestamp(ts, timezone.utc).isoformat()
+
+
+# Records of the export: balances first, then the spends in the order they
+# were made, EXPORT_CHUNK of them at a time. Spends recorded meanwhile are
+# left out
+def _records(
+    balances: dict[str, Category], columns: SpendColumns | None
+) -> Iterator[list[dict]]:
+    yield [
+        {"record": BALANCE, "type": type, **info.to_json()}
+        for type, info in balances.items()
+    ]
+    if columns is None:
+        return
+    names = columns.names
+    rows = len(columns)
+    for start in range(0, rows, EXPORT_CHUNK):
+        stop = min(start + EXPORT_CHUNK, rows)
+        yield [
+            {
+                "record": SPEND,
+                "time": _time(ts),
+                "type": names[category],
+                "amount": amount,
+            }
+            for ts, category, amount in zip(
+                columns.ts[start:stop].tolist(),
+                columns.category[start:stop].tolist(),
+                columns.amount[start:stop].tolist(),
+            )
+        ]
+
+
+def _csv_chunks(records: Iterator[list[dict]]) -> Iterator[str]:
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, CSV_FIELDS)
+    writer.writeheader()
+    for chunk in records:
+        writer.writerows(chunk)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def _jsonl_chunks(records: Iterator[list[dict]]) -> Iterator[str]:
+    for chunk in records:
+        yield "".join(
+            json.dumps(record, ensure_ascii=False, default=str) + "\n"
+            for record in chunk
+        )
+
+
+# Writes the export to a binary file chunk by chunk, letting other updates
+# run between the chunks
+async def write_export(
+    file: IO[bytes],
+    format: str,
+    balances: dict[str, Category],
+    columns: SpendColumns | None,
+):
+    records = _records(balances, columns)
+    chunks = _jsonl_chunks(records) if format == JSONL else _csv_chunks(records)
+    for chunk in chunks:
+        file.write(chunk.encode())
+        await asyncio.sleep(0)
+
+
+def _amount(value: object, field: str) -> Decimal:
+    if isinstance(value, bool) or not isinstance(value, (str, int, float, Decimal)):
+        raise ValueError(f"{field} must be a number")
+    try:
+        amount = Decimal(str(value).strip())
+    except InvalidOperation:
+        raise ValueError(f"{field} must be a number")
+    if not is_amount(amount):
+        raise ValueError(
+            f"{field} must be a finite number with at most {MAX_AMOUNT_DIGITS} "
+            f"digits before the point"
+        )
+    return amount
+
+
+def _timestamp(value: object) -> float:
+    if not isinstance(value, str):
+        raise ValueError("time must be an ISO 8601 string")
+    moment = datetime.fromisoformat(value.strip())
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.timestamp()
+
+
+# Validated record: (BALANCE, type, limit, balance) or (SPEND, ts, type, amount)
+def _parse_record(record: object) -> tuple:
+    if not isinstance(record, dict):
+        raise ValueError("a record must be an object")
+    type = record.get("type")
+    if not isinstance(type, str) or not type.strip():
+        raise ValueError("type must be a non-empty string")
+    kind = record.get("record")
+    if kind == BALANCE:
+        limit = _amount(record.get("limit"), "limit")
+        return BALANCE, type, limit, _amount(record.get("balance"), "balance")
+    if kind == SPEND:
+        ts = _timestamp(record.get("time"))
+        return SPEND, ts, type, _amount(record.get("amount"), "amount")
+    raise ValueError(f"record must be '{BALANCE}' or '{SPEND}'")
+
+
+def _raw_records(file: IO[str], format: str) -> Iterator[tuple[int, object]]:
+    if format == JSONL:
+        for line_number, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+            try:
+                yield line_number, json.loads(line, parse_float=Decimal)
+            except ValueError:
+                raise ValueError(f"Line {line_number}: invalid JSON")
+        return
+    reader = csv.DictReader(file)
+    if reader.fieldnames is None or "record" not in reader.fieldnames:
+        raise ValueError(f"Line 1: the header must be {','.join(CSV_FIELDS)}")
+    for record in reader:
+        yield reader.line_num, record
+
+
+# Validated records of an import file, read one line at a time. Raises
+# ValueError with the line of the first invalid record
+def read_records(file: IO[str], format: str) -> Iterator[tuple]:
+    for line_number, record in _raw_records(file, format):
+        try:
+            yield _parse_record(record)
+        except ValueError as e:
+            raise ValueError(f"Line {line_number}: {e}")
+
+
+class ImportSummary:
+    __slots__ = ("balances", "spends")
+
+    def __init__(self):
+        self.balances: dict[str, Category] = {}
+        self.spends = 0
+
+
+# Reads the whole file once to validate it. Returns its balances, which are
+# written at once, and the number of spends, which are read again in batches
+# by spend_batches
+def validate(file: IO[str], format: str) -> ImportSummary:
+    summary = ImportSummary()
+    for record in read_records(file, format):
+        if record[0] == BALANCE:
+            _, type, limit, balance = record
+            summary.balances[type] = Category(limit, balance)
+        else:
+            summary.spends += 1
+    return summary
+
+
+# (ts, type, amount) spends of a validated file, IMPORT_BATCH at a time
+def spend_batches(file: IO[str], format: str) -> Iterator[list[tuple]]:
+    batch = []
+    for record in read_records(file, format):
+        if record[0] != SPEND:
+            continue
+        _, ts, type, amount = record
+        batch.append((ts, type, float(amount)))
+        if len(batch) >= IMPORT_BATCH:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
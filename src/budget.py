@@ -0,0 +1,82 @@
+from decimal import Decimal
+
+# Most digits an amount can have before the point. Bigger amounts are
+# refused, their text alone wouldn't fit a message
+MAX_AMOUNT_DIGITS = 15
+
+
+# A finite Decimal with at most MAX_AMOUNT_DIGITS digits before the point
+def is_amount(value: object) -> bool:
+    if not isinstance(value, Decimal) or not value.is_finite():
+        return False
+    return value.adjusted() < MAX_AMOUNT_DIGITS
+
+
+# Limit and balance of one category of a chat. Chat data maps category names
+# to these, next to anything else /set_custom_json_balance put there. Amounts
+# are Decimals, or integers in FixedPointData. With slots a category takes
+# about a quarter of the memory of a {"limit": ..., "balance": ...} dict
+class Category:
+    __slots__ = ("limit", "balance")
+
+    def __init__(self, limit, balance):
+        self.limit = limit
+        self.balance = balance
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Category):
+            return NotImplemented
+        return self.limit == other.limit and self.balance == other.balance
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        return f"Category(limit={self.limit!r}, balance={self.balance!r})"
+
+    def copy(self) -> "Category":
+        return Category(self.limit, self.balance)
+
+    # The category as it is kept in JSON
+    def to_json(self) -> dict:
+        return {"limit": self.limit, "balance": self.balance}
+
+
+# Copy of chat data that keeps its amounts when the data's categories change,
+# FixedPointData stays FixedPointData
+def snapshot(data: dict) -> dict:
+    copy = data.copy()
+    for type, info in copy.items():
+        if isinstance(info, Category):
+            copy[type] = info.copy()
+    return copy
+
+
+# Categories named with dots are in groups: "food.week1" is in the group
+# "food", "trip.food.day1" in "trip" and in "trip.food"
+GROUP_SEPARATOR = "."
+
+
+# Groups of a category, outermost first
+def groups_of(type: str) -> list[str]:
+    groups = []
+    end = type.find(GROUP_SEPARATOR, 1)
+    while end != -1 and end < len(type) - 1:
+        groups.append(type[:end])
+        end = type.find(GROUP_SEPARATOR, end + 2)
+    return groups
+
+
+# Limit and balance of all categories of a group together, kept up to date
+# as they change, and the categories themselves in the order of the data
+class Group:
+    __slots__ = ("limit", "balance", "members", "line")
+
+    def __init__(self):
+        self.limit = 0
+        self.balance = 0
+        self.members: dict[str, None] = {}
+        # Rendered summary line, None after a change
+        self.line: str | None = None
+
+    def __repr__(self) -> str:
+        return f"Group(limit={self.limit!r}, balance={self.balance!r})"
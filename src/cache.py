@@ -0,0 +1,46 @@
+import time
+from collections import OrderedDict
+
+
+class CacheEntry:
+    __slots__ = ("value", "expires_at")
+
+    def __init__(self, value: object, expires_at: float):
+        self.value = value
+        self.expires_at = expires_at
+
+
+# Bounded LRU cache of per-chat values with a time to live. get() returns the
+# entry, so a cached None can be told apart from a miss
+class ChatCache:
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict[int, CacheEntry] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, chat_id: int) -> CacheEntry | None:
+        entry = self._entries.get(chat_id)
+        if entry is None:
+            return None
+        if entry.expires_at <= time.monotonic():
+            del self._entries[chat_id]
+            return None
+        self._entries.move_to_end(chat_id)
+        return entry
+
+    def put(self, chat_id: int, value: object) -> None:
+        if self.max_size <= 0:
+            return
+        self._entries[chat_id] = CacheEntry(value, time.monotonic() + self.ttl)
+        self._entries.move_to_end(chat_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, chat_id: int | None = None) -> None:
+        if chat_id is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(chat_id, None)
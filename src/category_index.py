@@ -0,0 +1,200 @@
+import os
+import re
+from typing import NamedTuple
+
+# Shortest prefix that is resolved to the category it starts
+CATEGORY_MIN_PREFIX = int(os.getenv("CATEGORY_MIN_PREFIX", "3"))
+# Most typos forgiven in a name, fewer for short names
+CATEGORY_MAX_TYPOS = int(os.getenv("CATEGORY_MAX_TYPOS", "2"))
+# Candidates listed for an ambiguous name at most
+MAX_CANDIDATES = 5
+
+_SEPARATORS = re.compile(r"[\s_\-.]+")
+
+
+# "Budget_Foods-Week 3" -> "budgetfoodsweek3"
+def _fold(name: str) -> str:
+    return _SEPARATORS.sub("", name.casefold())
+
+
+# Same key for the singular and plural of a folded name, "groceries" and
+# "grocery" are both "grocery"
+def _alias(folded: str) -> str:
+    if folded.endswith("ies") and len(folded) > 4:
+        return folded[:-3] + "y"
+    if folded.endswith("s") and not folded.endswith("ss") and len(folded) > 3:
+        return folded[:-1]
+    return folded
+
+
+def _typos_allowed(key: str) -> int:
+    if len(key) < 4:
+        return 0
+    if len(key) < 7:
+        return min(1, CATEGORY_MAX_TYPOS)
+    return CATEGORY_MAX_TYPOS
+
+
+# Every string made by deleting up to `depth` characters of the key
+def _deletes(key: str, depth: int) -> set[str]:
+    result = {key}
+    frontier = {key}
+    for _ in range(depth):
+        frontier = {
+            word[:i] + word[after:]
+            for word in frontier
+            for i, after in enumerate(range(1, len(word) + 1))
+        }
+        result |= frontier
+    return result
+
+
+# Optimal string alignment distance: insertions, deletions, substitutions
+# and swaps of neighbours
+def _distance(a: str, b: str) -> int:
+    previous = None
+    row = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        before, previous, row = previous, row, [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            row[j] = min(previous[j] + 1, row[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                row[j] = min(row[j], before[j - 2] + 1)
+    return row[-1]
+
+
+class Resolution(NamedTuple):
+    # The category meant, None if there is none or it is ambiguous
+    name: str | None
+    # Categories it could be when it is ambiguous
+    candidates: list[str]
+
+
+class _Node:
+    __slots__ = ("children", "names")
+
+    def __init__(self):
+        self.children: dict[str, _Node] = {}
+        # Categories whose folded name starts with the path to this node
+        self.names: set[str] = set()
+
+
+# Index of the categories of one chat: a trie of folded names for prefixes,
+# an alias table for singular and plural forms and a table of the names with
+# up to CATEGORY_MAX_TYPOS characters deleted for typos. A lookup deletes
+# characters of the asked name too and meets the table halfway, so it takes
+# the same time with hundreds of categories. Names longer than every indexed
+# one by more than the typos allowed can't be near any of them and aren't
+# looked up, the deletions of a long name grow with the cube of its length.
+# Categories are added and removed one at a time as they change
+class CategoryIndex:
+    __slots__ = ("_trie", "_aliases", "_deletes", "_lengths")
+
+    def __init__(self, names=()):
+        self._trie = _Node()
+        self._aliases: dict[str, set[str]] = {}
+        self._deletes: dict[str, set[str]] = {}
+        # Length of the aliases -> how many names have an alias that long
+        self._lengths: dict[int, int] = {}
+        for name in names:
+            self.add(name)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._trie.names
+
+    # Adding a name that is already indexed changes nothing, it is removed by
+    # one remove()
+    def add(self, name: str):
+        if name in self._trie.names:
+            return
+        folded = _fold(name)
+        node = self._trie
+        node.names.add(name)
+        for char in folded:
+            node = node.children.setdefault(char, _Node())
+            node.names.add(name)
+        alias = _alias(folded)
+        self._aliases.setdefault(alias, set()).add(name)
+        self._lengths[len(alias)] = self._lengths.get(len(alias), 0) + 1
+        for key in _deletes(alias, _typos_allowed(alias)):
+            self._deletes.setdefault(key, set()).add(name)
+
+    def remove(self, name: str):
+        if name not in self._trie.names:
+            return
+        folded = _fold(name)
+        path = [self._trie]
+        for char in folded:
+            path.append(path[-1].children[char])
+        for node in path:
+            node.names.discard(name)
+        for parent, char in zip(reversed(path[:-1]), reversed(folded)):
+            if parent.children[char].names:
+                break
+            del parent.children[char]
+        alias = _alias(folded)
+        self._lengths[len(alias)] -= 1
+        if not self._lengths[len(alias)]:
+            del self._lengths[len(alias)]
+        for table, keys in (
+            (self._aliases, (alias,)),
+            (self._deletes, _deletes(alias, _typos_allowed(alias))),
+        ):
+            for key in keys:
+                names = table.get(key)
+                if names is not None:
+                    names.discard(name)
+                    if not names:
+                        del table[key]
+
+    def _prefixed(self, folded: str) -> set[str]:
+        node = self._trie
+        for char in folded:
+            node = node.children.get(char)
+            if node is None:
+                return set()
+        return node.names
+
+    def _near(self, alias: str) -> set[str]:
+        typos = _typos_allowed(alias)
+        if typos == 0 or len(alias) > max(self._lengths, default=0) + typos:
+            return set()
+        found = set()
+        for key in _deletes(alias, typos):
+            found |= self._deletes.get(key, set())
+        best = typos + 1
+        nearest = set()
+        for name in found:
+            distance = _distance(alias, _alias(_fold(name)))
+            if distance < best:
+                best, nearest = distance, {name}
+            elif distance == best:
+                nearest.add(name)
+        return nearest
+
+    # The category a name asked by a user means: the same name ignoring case
+    # and separators, its singular or plural, the only category it is a
+    # prefix of, or the nearest category within the typos allowed
+    def resolve(self, name: str) -> Resolution:
+        folded = _fold(name)
+        if not folded:
+            return Resolution(None, [])
+        alias = _alias(folded)
+        stages = (
+            lambda: self._aliases.get(alias, set()),
+            lambda: (
+                self._prefixed(folded) if len(folded) >= CATEGORY_MIN_PREFIX else set()
+            ),
+            lambda: self._near(alias),
+        )
+        for stage in stages:
+            names = stage()
+            exact = [other for other in names if _fold(other) == folded]
+            if len(exact) == 1:
+                return Resolution(exact[0], [])
+            if len(names) == 1:
+                return Resolution(next(iter(names)), [])
+            if names:
+                return Resolution(None, sorted(names)[:MAX_CANDIDATES])
+        return Resolution(None, [])
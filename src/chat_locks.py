@@ -0,0 +1,26 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+# chat_id -> [lock, number of holders and waiters]
+_locks: dict[int, list] = {}
+
+
+# Serializes code per chat; different chats never wait for each other.
+# Waiters are woken in FIFO order, so updates within a chat keep their order.
+@asynccontextmanager
+async def chat_lock(chat_id: int):
+    entry = _locks.get(chat_id)
+    if entry is None:
+        entry = _locks[chat_id] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _locks[chat_id]
+
+
+def active_chats() -> int:
+    return len(_locks)
@@ -0,0 +1,216 @@
+import ledger
+from budget import Category, Group, groups_of
+from category_index import CategoryIndex
+from fixed_point import FixedPointData, format_minor
+from ledger import Event
+
+
+# Chat data with running Left/Spent totals, updated in O(1) by every change
+# that goes through apply(), the rolled up totals of its groups, updated for
+# the groups of the changed category only, the rendered summary lines, of
+# which only the changed ones are rendered again, and the index of its
+# categories and groups. Groups and the index are built when they are first
+# needed and kept up to date as categories are added and deleted.
+# Only Categories are counted and shown, data set with
+# /set_custom_json_balance may have anything else too
+class ChatState:
+    __slots__ = ("data", "limit", "balance", "_scale", "_lines", "_groups", "_index")
+
+    def __init__(self, data: dict):
+        self.data = data
+        self._lines = None
+        self._groups = None
+        self._index = None
+        self._total()
+
+    def _total(self):
+        self.limit = 0
+        self.balance = 0
+        for info in self.data.values():
+            if isinstance(info, Category):
+                self.limit += info.limit
+                self.balance += info.balance
+        self._scale = getattr(self.data, "scale", None)
+        self._lines = None
+        if self._groups is not None:
+            # Same groups, amounts in new units. The objects are kept, callers
+            # may hold them
+            for group in self._groups.values():
+                group.limit = 0
+                group.balance = 0
+                group.line = None
+                for type in group.members:
+                    group.limit += self.data[type].limit
+                    group.balance += self.data[type].balance
+
+    def _take(self, type: str, info: Category):
+        self.limit -= info.limit
+        self.balance -= info.balance
+        if self._lines is not None:
+            self._lines.pop(type, None)
+        if self._groups is not None:
+            for name in groups_of(type):
+                group = self._groups[name]
+                group.limit -= info.limit
+                group.balance -= info.balance
+                group.line = None
+
+    def _put(self, type: str, info: Category):
+        self.limit += info.limit
+        self.balance += info.balance
+        if self._groups is not None:
+            for name in groups_of(type):
+                group = self._groups[name]
+                group.limit += info.limit
+                group.balance += info.balance
+                group.line = None
+
+    # A category is added to the index and to its groups, which are made
+    # when it is their first one
+    def _join(self, type: str):
+        if self._index is not None:
+            self._index.add(type)
+        if self._groups is None:
+            return
+        for name in groups_of(type):
+            group = self._groups.get(name)
+            if group is None:
+                group = self._groups[name] = Group()
+                if self._index is not None:
+                    self._index.add(name)
+            group.members[type] = None
+            if type in self.data:
+                # A plain value becomes a category where it is in the data,
+                # the members keep the order of the data
+                group.members = {
+                    member: None for member in self.data if member in group.members
+                }
+
+    # A group and a category may have the same name, the index has the name
+    # once and keeps it while either of them is left
+    def _leave(self, type: str):
+        if self._index is not None and type not in self._groups:
+            self._index.remove(type)
+        if self._groups is None:
+            return
+        for name in groups_of(type):
+            group = self._groups[name]
+            del group.members[type]
+            if not group.members:
+                del self._groups[name]
+                if self._index is not None and not isinstance(
+                    self.data.get(name), Category
+                ):
+                    self._index.remove(name)
+
+    def apply(self, event: Event):
+        # Checked before the totals, groups and index change with it
+        if event.amount is not None:
+            ledger.check_amount(self.data, event.amount)
+        info = self.data.get(event.type) if event.type is not None else None
+        # Categories change in place, the old amounts are taken out first
+        if isinstance(info, Category):
+            self._take(event.type, info)
+            if event.op == ledger.DELETE:
+                self._leave(event.type)
+        elif event.op == ledger.UPSERT:
+            self._join(event.type)
+        ledger.apply_event(self.data, event)
+        if getattr(self.data, "scale", None) != self._scale:
+            # A fixed point chat got a new scale, every amount changed
+            self._total()
+        elif event.op == ledger.RESET:
+            self.balance = self.limit
+            self._lines = None
+            for group in (self._groups or {}).values():
+                group.balance = group.limit
+                group.line = None
+        elif event.type is not None:
+            info = self.data.get(event.type)
+            if isinstance(info, Category):
+                self._put(event.type, info)
+
+    # Groups of the chat by name, the members of each in the order of the data
+    def groups(self) -> dict[str, Group]:
+        if self._groups is None:
+            self._groups = {}
+            for type, info in self.data.items():
+                if not isinstance(info, Category):
+                    continue
+                for name in groups_of(type):
+                    group = self._groups.get(name)
+                    if group is None:
+                        group = self._groups[name] = Group()
+                    group.limit += info.limit
+                    group.balance += info.balance
+                    group.members[type] = None
+        return self._groups
+
+    # Index of the names of the categories and groups
+    def categories(self) -> CategoryIndex:
+        if self._index is None:
+            names = [
+                type for type, info in self.data.items() if isinstance(info, Category)
+            ]
+            names.extend(self.groups())
+            self._index = CategoryIndex(names)
+        return self._index
+
+    def _show(self, value) -> str:
+        if isinstance(self.data, FixedPointData):
+            return format_minor(value, self.data.scale)
+        return str(value)
+
+    # Running Decimal totals keep the trailing zeros of every amount that was
+    # added and subtracted, so they are shown without them
+    def _show_total(self, value) -> str:
+        if isinstance(self.data, FixedPointData):
+            return format_minor(value, self.data.scale)
+        text = f"{value:f}"
+        if "." in text:
+            text = text.rstrip("0").rstrip(".")
+        return text
+
+    # "Left: <balance> / <limit>" over all categories, without looking at them
+    def footer(self) -> str:
+        left = self._show_total(self.balance)
+        return f"Left: {left} / {self._show_total(self.limit)}"
+
+    # Every category, then every group in the order of their first
+    # categories, then the totals. Only the lines of the categories and
+    # groups changed since the last summary are rendered
+    def summary(self) -> str:
+        if self._lines is None:
+            self._lines = {}
+        lines = self._lines
+        show = self._show
+        parts = []
+        groups = self.groups()
+        # Group name -> its line, in the order of their first categories
+        group_lines = {}
+        for type, info in self.data.items():
+            if not isinstance(info, Category):
+                continue
+            if groups:
+                for name in groups_of(type):
+                    group_lines.setdefault(name, None)
+            line = lines.get(type)
+            if line is None:
+                line = lines[type] = (
+                    f"{type}: {show(info.balance)} / {show(info.limit)}\n"
+                )
+            parts.append(line)
+        if group_lines:
+            parts.append("\n")
+            show = self._show_total
+            for name in group_lines:
+                group = groups[name]
+                if group.line is None:
+                    group.line = (
+                        f"{name}: {show(group.balance)} / {show(group.limit)}\n"
+                    )
+                parts.append(group.line)
+        spent = self._show_total(self.limit - self.balance)
+        limit = self._show_total(self.limit)
+        parts.append(f"\n{self.footer()}\nSpent: {spent} / {limit}")
+        return "".join(parts)
@@ -0,0 +1,180 @@
+import base64
+import json
+import zlib
+from decimal import Decimal
+from json.encoder import encode_basestring
+from budget import Category, is_amount
+from fixed_point import FixedPointData
+
+DATA_HEADER = "Data for money-counter"
+
+
+def _to_decimal(value):
+    if isinstance(value, Decimal):
+        return value
+    if isinstance(value, (int, float)):
+        return Decimal(str(value))
+    if isinstance(value, str):
+        return Decimal(value)
+    return value
+
+
+# A Category with Decimal amounts for {"limit": ..., "balance": ...} with
+# finite numbers, anything else is left as it is. Infinity, NaN and amounts
+# of more than MAX_AMOUNT_DIGITS digits stay plain values, which aren't
+# counted but can still be deleted
+def _to_category(info: object) -> object:
+    if isinstance(info, Category):
+        info = info.to_json()
+    elif not isinstance(info, dict) or info.keys() != {"limit", "balance"}:
+        return info
+    limit, balance = _to_decimal(info["limit"]), _to_decimal(info["balance"])
+    if is_amount(limit) and is_amount(balance):
+        return Category(limit, balance)
+    return info
+
+
+def normalize_data_to_decimals(data: object) -> object:
+    if not isinstance(data, dict):
+        return data
+    for type_key, info in list(data.items()):
+        data[type_key] = _to_category(info)
+    return data
+
+
+# FixedPointData is written as [scale, [type, limit, balance], ...] with
+# integer amounts, which the json module reads and writes without Decimals
+def _dumps_fixed_point(data: FixedPointData) -> str:
+    return json.dumps(
+        [
+            data.scale,
+            *([type, info.limit, info.balance] for type, info in data.items()),
+        ],
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+
+
+def _loads_fixed_point(data_json: str) -> FixedPointData:
+    scale, *triples = json.loads(data_json)
+    return FixedPointData(
+        scale,
+        ((type, Category(limit, balance)) for type, limit, balance in triples),
+    )
+
+
+# Mark FixedPointData and data of only Categories with Decimal amounts in
+# dumps_data's output, no JSON text starts with them. The latter is kept as
+# [type, limit, balance] triples like in pinned messages of version 2
+_FIXED_POINT = "v3"
+_TRIPLES = "v2"
+
+
+def _json_default(value: object) -> object:
+    if isinstance(value, Category):
+        return value.to_json()
+    return str(value)
+
+
+def dumps_data(data: object) -> str:
+    if isinstance(data, FixedPointData):
+        return _FIXED_POINT + _dumps_fixed_point(data)
+    if _is_triples_data(data):
+        return _TRIPLES + _encode_triples(data)
+    return json.dumps(data, default=_json_default)
+
+
+def loads_data(data_json: str) -> object:
+    if data_json.startswith(_FIXED_POINT):
+        return _loads_fixed_point(data_json.removeprefix(_FIXED_POINT))
+    if data_json.startswith(_TRIPLES):
+        return _loads_triples(data_json.removeprefix(_TRIPLES))
+    data = json.loads(data_json, parse_float=Decimal, parse_int=Decimal)
+    return normalize_data_to_decimals(data)
+
+
+# Telegram's limit for the text of a message
+MESSAGE_MAX_LENGTH = 4096
+
+# Version 2 keeps (type, limit, balance) triples in a JSON array of arrays,
+# compressed with zlib and base85 when that is shorter:
+#
+#   Data for money-counter v2
+#   z<base85 of zlib of [["food",100,87.5],["cat",20,20]]>
+#
+# Version 1 is a plain JSON object and is still read, and written for data
+# that doesn't fit into triples.
+#
+# Version 3 is written for FixedPointData and keeps integer amounts with the
+# chat's scale first, compressed the same way:
+#
+#   Data for money-counter v3
+#   [2,["food",10000,8750],["cat",2000,2000]]
+V2_HEADER = f"{DATA_HEADER} v2"
+V3_HEADER = f"{DATA_HEADER} v3"
+_COMPRESSED = "z"
+
+
+def _is_triples_data(data: object) -> bool:
+    if not isinstance(data, dict):
+        return False
+    for info in data.values():
+        if not isinstance(info, Category):
+            return False
+        # Infinity and NaN aren't JSON numbers, such data is kept in version 1
+        if not is_amount(info.limit) or not is_amount(info.balance):
+            return False
+    return True
+
+
+def _encode_triples(data: dict) -> str:
+    # Decimals are written as JSON numbers as they are, without float rounding
+    items = ",".join(
+        f"[{encode_basestring(type)},{info.limit},{info.balance}]"
+        for type, info in data.items()
+    )
+    return f"[{items}]"
+
+
+# Messages written before version 2 checked the amounts may have Infinity
+# and NaN, and ones written before the amounts were capped may have huge
+# amounts, which are read as plain values
+def _loads_triples(payload: str) -> dict:
+    triples = json.loads(
+        payload, parse_float=Decimal, parse_int=Decimal, parse_constant=Decimal
+    )
+    return {
+        type: (
+            Category(limit, balance)
+            if is_amount(limit) and is_amount(balance)
+            else {"limit": limit, "balance": balance}
+        )
+        for type, limit, balance in triples
+    }
+
+
+def _compress(payload: str) -> str:
+    compressed = _COMPRESSED + base64.b85encode(
+        zlib.compress(payload.encode(), 9)
+    ).decode("ascii")
+    return compressed if len(compressed) < len(payload) else payload
+
+
+def encode_message(data: object) -> str:
+    if isinstance(data, FixedPointData):
+        return f"{V3_HEADER}\n{_compress(_dumps_fixed_point(data))}"
+    if not _is_triples_data(data):
+        return f"{DATA_HEADER}\n{dumps_data(data)}"
+    return f"{V2_HEADER}\n{_compress(_encode_triples(data))}"
+
+
+def decode_message(text: str) -> object:
+    header, payload = text.split("\n", 1)
+    header = header.strip()
+    if header not in (V2_HEADER, V3_HEADER):
+        return loads_data(payload)
+    if payload.startswith(_COMPRESSED):
+        payload = zlib.decompress(base64.b85decode(payload[1:])).decode()
+    if header == V3_HEADER:
+        return _loads_fixed_point(payload)
+    return _loads_triples(payload)
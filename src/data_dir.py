@@ -0,0 +1,17 @@
+import os
+
+# Directory of the files the bot writes while it runs: the SQLite database,
+# the spending history, reset schedules and the outbox. Paths set on their
+# own are used as they are
+DATA_DIR = os.getenv("DATA_DIR", "data")
+
+
+def data_path(name: str) -> str:
+    return os.path.join(DATA_DIR, name)
+
+
+# Makes the directory of a file about to be written, if it is missing
+def make_parent(path: str):
+    parent = os.path.dirname(path)
+    if parent:
+        os.makedirs(parent, exist_ok=True)
@@ -0,0 +1,175 @@
+import functools
+import logging
+import os
+import time
+from collections import OrderedDict
+from contextvars import ContextVar
+from telegram import Update
+import metrics
+from data_dir import make_parent
+
+logger = logging.getLogger(__name__)
+
+# Updates remembered at most, and for how many seconds. Telegram gives up
+# redelivering an update after a day
+DEDUPE_SIZE = int(os.getenv("DEDUPE_SIZE", "100000"))
+DEDUPE_TTL = float(os.getenv("DEDUPE_TTL", "86400"))
+# File keeping handled updates across restarts, off by default
+DEDUPE_PATH = os.getenv("DEDUPE_PATH")
+
+
+# Key of the change an update asks for: a new message is identified by its
+# chat and message id, so its redelivery under a new update_id is still
+# caught. Other updates, like button presses, are keyed by update_id in chat
+# 0, which no real chat has
+def update_key(update: Update) -> tuple[int, int]:
+    if update.message is not None:
+        return update.message.chat_id, update.message.message_id
+    return 0, update.update_id
+
+
+# Bounded index of handled updates. Keys are kept in the order they were
+# claimed, which is also the order they expire in, so eviction by age and by
+# size both pop the oldest key in O(1). With a file, handled keys are appended
+# to it and read back on start, and it is rewritten with the live keys once
+# it has grown by max_size lines
+class DedupeIndex:
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        # key -> wall clock time it was claimed, comparable across restarts
+        self._keys: OrderedDict[tuple[int, int], float] = OrderedDict()
+        self._pending: set[tuple[int, int]] = set()
+        self._path = None
+        self._file = None
+        self._appended = 0
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def _evict(self, now: float):
+        deadline = now - self.ttl
+        while self._keys:
+            key, claimed_at = next(iter(self._keys.items()))
+            if claimed_at > deadline and len(self._keys) <= self.max_size:
+                return
+            self._keys.popitem(last=False)
+            self._pending.discard(key)
+
+    # True if the key is new, it then counts as seen until released
+    def claim(self, key: tuple[int, int]) -> bool:
+        if self.max_size <= 0:
+            return True
+        now = time.time()
+        if key in self._keys and self._keys[key] > now - self.ttl:
+            return False
+        self._keys[key] = now
+        self._keys.move_to_end(key)
+        self._pending.add(key)
+        self._evict(now)
+        return True
+
+    # Forgets a claimed key whose handling failed, so a redelivery is handled
+    def release(self, key: tuple[int, int]):
+        self._pending.discard(key)
+        self._keys.pop(key, None)
+
+    # Marks a claimed key as handled and writes it to the file
+    def commit(self, key: tuple[int, int]):
+        self._pending.discard(key)
+        claimed_at = self._keys.get(key)
+        if self._file is None or claimed_at is None:
+            return
+        self._file.write(f"{key[0]} {key[1]} {claimed_at}\n")
+        self._file.flush()
+        self._appended += 1
+        if self._appended >= self.max_size:
+            self._compact()
+
+    def open(self, path: str):
+        make_parent(path)
+        self._path = path
+        now = time.time()
+        if os.path.exists(path):
+            with open(path) as file:
+                for line in file:
+                    try:
+                        chat_id, message_id, claimed_at = line.split()
+                        key = (int(chat_id), int(message_id))
+                        claimed_at = float(claimed_at)
+                    except ValueError:
+                        # A line cut short by a crash
+                        continue
+                    if claimed_at > now - self.ttl:
+                        self._keys[key] = claimed_at
+                        self._keys.move_to_end(key)
+            self._evict(now)
+        logger.info(f"Loaded {len(self._keys)} handled updates from {path}")
+        self._compact()
+
+    # Rewrites the file with the handled keys still in the index
+    def _compact(self):
+        if self._file is not None:
+            self._file.close()
+        temporary_path = f"{self._path}.tmp"
+        with open(temporary_path, "w") as file:
+            for key, claimed_at in self._keys.items():
+                if key not in self._pending:
+                    file.write(f"{key[0]} {key[1]} {claimed_at}\n")
+        os.replace(temporary_path, self._path)
+        self._file = open(self._path, "a")
+        self._appended = 0
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+index = DedupeIndex(DEDUPE_SIZE, DEDUPE_TTL)
+
+# Set by exactly_once for the update being handled, flipped by
+# report_failure()
+_failed: ContextVar[list[bool] | None] = ContextVar("dedupe_failed", default=None)
+
+
+# Tells exactly_once that a change of the update being handled failed.
+# Handlers answer their own errors and return normally, so without this the
+# update would count as handled and its redelivery would be skipped
+def report_failure():
+    failed = _failed.get()
+    if failed is not None:
+        failed[0] = True
+
+
+# Decorator for handlers that change state: a redelivered update is skipped,
+# also while the first delivery is still being handled. An update whose
+# handler raised or reported a failure is forgotten, so it is handled again
+# when Telegram redelivers it
+def exactly_once(func):
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(update, context):
+        key = update_key(update)
+        if not index.claim(key):
+            logger.info(f"Skipping {name} for already handled update {key}")
+            metrics.duplicate_updates.inc(name)
+            return None
+        failed = [False]
+        token = _failed.set(failed)
+        try:
+            result = await func(update, context)
+        except BaseException:
+            index.release(key)
+            raise
+        finally:
+            _failed.reset(token)
+        if failed[0]:
+            logger.info(f"{name} failed for update {key}, it isn't marked handled")
+            index.release(key)
+        else:
+            index.commit(key)
+        return result
+
+    return wrapper
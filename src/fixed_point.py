@@ -0,0 +1,113 @@
+import functools
+from decimal import Decimal
+from budget import Category, is_amount
+
+# Most digits after the point a chat's amounts can have
+MAX_SCALE = 12
+
+
+# Chat data with limits and balances as integers in units of 10**-scale,
+# e.g. 87.5 is 8750 with scale 2. Arithmetic on them is exact and cheaper
+# than on Decimals, amounts are converted only when they are parsed or shown.
+# The scale grows when an amount with more digits after the point arrives
+class FixedPointData(dict):
+    __slots__ = ("scale",)
+
+    def __init__(self, scale: int, items=()):
+        super().__init__(items)
+        self.scale = scale
+
+    def copy(self) -> "FixedPointData":
+        return FixedPointData(self.scale, self)
+
+    # An amount in this data's units, rescaling the data if it needs more
+    # digits after the point
+    def minor(self, amount: Decimal) -> int:
+        if -amount.as_tuple().exponent > self.scale:
+            scale = _decimal_places(amount)
+            if scale > self.scale:
+                self.rescale(scale)
+        return int(amount.scaleb(self.scale))
+
+    # Raises ValueError for an amount with more digits after the point than
+    # any scale can keep, without changing anything
+    def check(self, amount: Decimal):
+        if -amount.as_tuple().exponent > MAX_SCALE:
+            if _decimal_places(amount) > MAX_SCALE:
+                raise ValueError(f"More than {MAX_SCALE} digits after the point")
+
+    def rescale(self, scale: int):
+        if scale > MAX_SCALE:
+            raise ValueError(f"More than {MAX_SCALE} digits after the point")
+        factor = 10 ** (scale - self.scale)
+        for info in self.values():
+            info.limit *= factor
+            info.balance *= factor
+        self.scale = scale
+
+    def amount(self, value: int) -> Decimal:
+        return Decimal(format_minor(value, self.scale))
+
+
+def _decimal_places(amount: Decimal) -> int:
+    return max(0, -amount.normalize().as_tuple().exponent)
+
+
+# Shows 8750 with scale 2 as "87.5", without going through Decimal. Most
+# amounts don't change between two summaries, so their text is memoized
+@functools.lru_cache(maxsize=65536)
+def format_minor(value: int, scale: int) -> str:
+    if scale == 0:
+        return str(value)
+    digits = str(value)
+    sign = ""
+    if value < 0:
+        sign = "-"
+        digits = digits[1:]
+    digits = digits.zfill(scale + 1)
+    rest = digits[-scale:].rstrip("0")
+    if rest:
+        return f"{sign}{digits[:-scale]}.{rest}"
+    return f"{sign}{digits[:-scale]}"
+
+
+def _is_budget(info: object) -> bool:
+    if not isinstance(info, Category):
+        return False
+    return is_amount(info.limit) and is_amount(info.balance)
+
+
+# Data with Decimal amounts as FixedPointData with at least the given scale.
+# Data that isn't only limits and balances is returned as it is
+def to_fixed_point(data: object, scale: int) -> object:
+    if isinstance(data, FixedPointData) or not isinstance(data, dict):
+        return data
+    if not all(_is_budget(info) for info in data.values()):
+        return data
+    for info in data.values():
+        for value in (info.limit, info.balance):
+            scale = max(scale, _decimal_places(value))
+    if scale > MAX_SCALE:
+        return data
+    return FixedPointData(
+        scale,
+        (
+            (
+                type,
+                Category(
+                    int(info.limit.scaleb(scale)), int(info.balance.scaleb(scale))
+                ),
+            )
+            for type, info in data.items()
+        ),
+    )
+
+
+# FixedPointData as a plain dict with Decimal amounts
+def to_decimals(data: object) -> object:
+    if not isinstance(data, FixedPointData):
+        return data
+    return {
+        type: Category(data.amount(info.limit), data.amount(info.balance))
+        for type, info in data.items()
+    }
@@ -0,0 +1,71 @@
+import time
+from decimal import Decimal
+from typing import NamedTuple
+from budget import MAX_AMOUNT_DIGITS, Category
+from fixed_point import FixedPointData
+
+# Journal operations
+SPEND = "s"
+LIMIT = "l"
+UPSERT = "u"
+DELETE = "d"
+RESET = "r"
+# Whole data replaced, e.g. by /set_custom_json_balance. Always snapshotted
+REPLACE = "j"
+
+OP_NAMES = {
+    SPEND: "spend",
+    LIMIT: "limit",
+    UPSERT: "upsert",
+    DELETE: "delete",
+    RESET: "reset",
+    REPLACE: "set",
+}
+
+
+class Event(NamedTuple):
+    op: str
+    type: str | None = None
+    amount: Decimal | None = None
+    ts: float = 0.0
+
+
+def new_event(op: str, type: str | None = None, amount: Decimal | None = None):
+    return Event(op, type, amount, time.time())
+
+
+# Raises ValueError for an amount the data can't keep: Infinity, NaN, more
+# than MAX_AMOUNT_DIGITS digits before the point, or more digits after the
+# point than FixedPointData can have
+def check_amount(data: dict, amount: Decimal):
+    if not amount.is_finite():
+        raise ValueError(f"Amount must be finite: {amount}")
+    if amount.adjusted() >= MAX_AMOUNT_DIGITS:
+        raise ValueError(f"More than {MAX_AMOUNT_DIGITS} digits before the point")
+    if isinstance(data, FixedPointData):
+        data.check(amount)
+
+
+# Applies one journal event to chat data in place, the only place where
+# balances change, so live updates and journal replay always agree. Events
+# keep Decimal amounts, FixedPointData gets them in its own units
+def apply_event(data: dict, event: Event) -> dict:
+    op = event.op
+    amount = event.amount
+    if amount is not None and isinstance(data, FixedPointData):
+        amount = data.minor(amount)
+    if op == SPEND:
+        data[event.type].balance -= amount
+    elif op == LIMIT:
+        info = data[event.type]
+        info.balance -= amount - info.limit
+        info.limit = amount
+    elif op == UPSERT:
+        data[event.type] = Category(amount, amount)
+    elif op == DELETE:
+        del data[event.type]
+    elif op == RESET:
+        for info in data.values():
+            if isinstance(info, Category):
+                info.balance = info.limit
+    return data
@@ -1,21 +1,42 @@
+import asyncio
+import io
 import json
 import os
+import tempfile
+import time
 import logging
+from datetime import datetime
 from dotenv import load_dotenv
 from telegram import Update
+from telegram.error import Forbidden
 from telegram.ext import (
     Application,
+    CallbackQueryHandler,
     CommandHandler,
     ContextTypes,
     MessageHandler,
     filters,
 )
 from decimal import Decimal, InvalidOperation
+import dedupe
+import ledger
+import metrics
+from budget import MAX_AMOUNT_DIGITS, is_amount
+from chat_state import ChatState
+import outbound
+import quick
+import schedules
+import spend_filter
+import spending
+
+# Every handler needs state, and it takes a few ms of the import next to
+# telegram, so it isn't deferred like backup and sharding
 import state
 import tg_helper
 
 logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
 )
 
 logger = logging.getLogger(__name__)
@@ -29,26 +50,108 @@ def check_env_variables():
         raise ValueError("TELEGRAM_BOT_KEY is not set in environment variables")
 
 
-check_env_variables()
-
 TELEGRAM_BOT_KEY = os.getenv("TELEGRAM_BOT_KEY")
 WEB_HOOK_HOST = os.getenv("WEB_HOOK_HOST")
-app = Application.builder().token(TELEGRAM_BOT_KEY).build()
+HISTORY_DEFAULT_LIMIT = 20
+HISTORY_MAX_LIMIT = 100
+REPORT_DEFAULT_TOP = 5
+# Weeks or months shown by "/report weeks" and "/report months" by default
+REPORT_DEFAULT_PERIODS = 6
+REPORT_MAX_COUNT = 60
+# Updates of different chats are handled in parallel, state.py keeps
+# updates of the same chat in order
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "256"))
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+WEB_HOOK_PORT = int(os.getenv("WEB_HOOK_PORT", "5000"))
+WEB_HOOK_SECRET = os.getenv("WEB_HOOK_SECRET")
+# With more than one worker, webhook updates are handled by worker processes
+# that each own the chats with chat_id % WEB_HOOK_WORKERS equal to their index
+WEB_HOOK_WORKERS = int(os.getenv("WEB_HOOK_WORKERS", "1"))
+WEB_HOOK_QUEUE_SIZE = int(os.getenv("WEB_HOOK_QUEUE_SIZE", "1000"))
+# Load the state of this many chats with the latest spends right after the
+# start, PREWARM_CONCURRENCY at a time, so their first update after a deploy
+# doesn't wait for the storage
+PREWARM_CHATS = int(os.getenv("PREWARM_CHATS", "0"))
+PREWARM_CONCURRENCY = int(os.getenv("PREWARM_CONCURRENCY", "8"))
+ADMIN_USER_IDS = {
+    int(user_id) for user_id in os.getenv("ADMIN_USER_IDS", "").split(",") if user_id
+}
+
+
+# Serve Prometheus metrics when a metrics port is set, load the updates
+# handled before a restart and start warming up in the background. Every
+# step is timed as a phase of the startup
+async def post_init(application: Application) -> None:
+    if application.bot_data["metrics_port"]:
+        with metrics.startup_phase("metrics"):
+            metrics.start_server(application.bot_data["metrics_port"])
+    if application.bot_data["dedupe_path"]:
+        with metrics.startup_phase("dedupe"):
+            dedupe.index.open(application.bot_data["dedupe_path"])
+    with metrics.startup_phase("schedules"):
+        schedules.store.open(application.bot_data["schedules_path"])
+    with metrics.startup_phase("outbox"):
+        state.open_outbox(application.bot, application.bot_data["outbox_path"])
+    with metrics.startup_phase("spending"):
+        spending.store.open(spending.SPENDING_PATH)
+    if application.job_queue is None:
+        logger.warning("No JobQueue, scheduled resets are off.")
+    else:
+        application.job_queue.run_repeating(
+            run_scheduled_resets, interval=schedules.RESET_CHECK_INTERVAL, first=0
+        )
+    logger.info(f"Started: {metrics.startup_summary()}")
+    application.bot_data["prewarm"] = asyncio.create_task(prewarm(application))
+
+
+# Load the state of the chats with the latest spends and the modules reports
+# need, while the first updates are already handled
+async def prewarm(application: Application) -> None:
+    shard = application.bot_data["shard"]
+    count = min(PREWARM_CHATS, state.STATE_CACHE_SIZE)
+    try:
+        with metrics.startup_phase("prewarm"):
+            if spending.store.enabled:
+                await asyncio.to_thread(spending.preload)
+            chat_ids = spending.store.recent_chats(
+                count, lambda chat_id: shard is None or chat_id % shard[1] == shard[0]
+            )
+            context = application.context_types.context(application)
+            loaded = await state.prewarm(context, chat_ids, PREWARM_CONCURRENCY)
+    except Exception as e:
+        logger.error(f"Failed to prewarm: {e}")
+        return
+    seconds = metrics.startup_phases["prewarm"]
+    logger.info(
+        f"Prewarmed {loaded} of {len(chat_ids)} recent chats in {seconds * 1000:.0f} ms"
+    )
+
+
+# Write deferred state updates and close the storage before the bot goes down
+async def post_stop(application: Application) -> None:
+    task = application.bot_data.get("prewarm")
+    if task is not None and not task.done():
+        task.cancel()
+    await state.shutdown()
+    dedupe.index.close()
 
 
 # Define command handlers
+@metrics.timed_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a welcome message when the /start command is issued."""
     logger.info(f"/start command received from user {update.effective_user.id}")
     user = update.effective_user
     try:
         await tg_helper.reply_html(
-            update, app, rf"Hi {user.mention_html()}! Welcome to the Balance Bot."
+            update,
+            context.application,
+            rf"Hi {user.mention_html()}! Welcome to the Balance Bot.",
         )
         logger.debug(f"Sent welcome message to user {user.id}")
         await tg_helper.reply_text(
             update,
-            app,
+            context.application,
             "I can help you keep track of your balance in this chat. "
             "Use /help to see the available commands.",
         )
@@ -57,6 +160,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         logger.error(f"Error in /start handler: {e}")
 
 
+@metrics.timed_handler
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a help message when the /help command is issued."""
     logger.info(f"/help command received from user {update.effective_user.id}")
@@ -70,30 +174,32 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         "/delete_balance <type> - Delete balance with type.\n"
         "/reset_limits - Reset all balances.\n"
         "/set_custom_json_balance <json> - Set custom json balance.\n"
-        "Simply send a message with a number and type to count that amount and update the balance."
+        "/history [count] - Show the latest changes.\n"
+        "/quick - Spend with buttons.\n"
+        "/report [week|month] - Show spending per category and the daily burn rate.\n"
+        "/report top [count] [week|month] - Show the categories with the most spent.\n"
+        "/report weeks|months [count] - Show spending of the latest weeks or months.\n"
+        "/export [csv|jsonl] - Export balances and spending history as a file.\n"
+        "/import - Send with an exported file, or as a reply to one, to replace balances and spending history.\n"
+        "/reset_schedule [monthly [day] | weekly [weekday] | off] [timezone] - Reset all balances on a schedule.\n"
+        "/stats - Show bot performance statistics (admins only).\n"
+        "Simply send a message with a number and type to count that amount and update the balance. "
+        "Put several of them on separate lines or separate them with commas to count them at once. "
+        "Types with dots, like food.week1, are grouped, and amounts can be spent from a group, like food."
     )
     try:
-        await tg_helper.reply_text(update, app, help_text)
+        await tg_helper.reply_text(update, context.application, help_text)
         logger.debug(f"Sent help text to user {update.effective_user.id}")
     except Exception as e:
         logger.error(f"Error in /help handler: {e}")
 
 
 def print_to_string_balance_info(balance_info):
-    all_limit = Decimal("0")
-    all_balance = Decimal("0")
-    result_string = ""
-    for type, info in balance_info.items():
-        if isinstance(info, dict) and "balance" in info and "limit" in info:
-            result_string += f"{type}: {info['balance']} / {info['limit']}\n"
-            all_limit += info["limit"]
-            all_balance += info["balance"]
-    result_string += f"\nLeft: {all_balance} / {all_limit}"
-    result_string += f"\nSpent: {all_limit - all_balance} / {all_limit}"
-    return result_string
+    return ChatState(balance_info).summary()
 
 
 # Handler for /get_all_balance_info command
+@metrics.timed_handler
 async def get_all_balance_info(
     update: Update, context: ContextTypes.DEFAULT_TYPE
 ) -> None:
@@ -108,24 +214,28 @@ async def get_all_balance_info(
     )
     chat_id = update.effective_chat.id
     try:
-        balance_info = await state.get_balance_info(context, chat_id)
-        if balance_info:
-            result_string = (
-                f"Balance info:\n{print_to_string_balance_info(balance_info)}"
-            )
-            await tg_helper.reply_text(update, app, result_string)
+        summary = await state.get_balance_summary(context, chat_id)
+        if summary:
+            result_string = f"Balance info:\n{summary}"
+            await tg_helper.reply_text(update, context.application, result_string)
             logger.debug(f"Sent balance info to chat {chat_id}")
         else:
-            await tg_helper.reply_text(update, app, "No balances found.")
+            await tg_helper.reply_text(
+                update, context.application, "No balances found."
+            )
             logger.debug(f"No balances found for chat {chat_id}")
     except Exception as e:
         logger.error(f"Error in /get_all_balance_info handler: {e}")
         await tg_helper.reply_text(
-            update, app, "An error occurred while fetching balance information."
+            update,
+            context.application,
+            "An error occurred while fetching balance information.",
         )
 
 
 # Handler for /upsert_balance command
+@metrics.timed_handler
+@dedupe.exactly_once
 async def upsert_balance(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Upsert balance."""
     if update.message is None:
@@ -138,29 +248,39 @@ async def upsert_balance(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     args = update.message.text.strip().split()[1:]
     if len(args) != 2:
         await tg_helper.reply_text(
-            update, app, "Please provide two arguments: <limit> <type>."
+            update, context.application, "Please provide two arguments: <limit> <type>."
         )
         logger.warning(f"Invalid arguments for /upsert_balance: {args}")
         return
     limit, type = args
     try:
         limit = Decimal(limit)
+        if not is_amount(limit):
+            raise ValueError("Limit must be finite and not too big")
     except (InvalidOperation, ValueError):
-        await tg_helper.reply_text(update, app, "Limit must be a number.")
+        await tg_helper.reply_text(
+            update,
+            context.application,
+            f"Limit must be a number with at most {MAX_AMOUNT_DIGITS} digits before the point.",
+        )
         logger.warning(f"Invalid limit value: {limit}")
         return
     try:
         await state.upsert_balance_type(context, chat_id, type, limit)
-        await tg_helper.reply_text(update, app, f"Balance for '{type}' set to {limit}.")
+        await tg_helper.reply_text(
+            update, context.application, f"Balance for '{type}' set to {limit}."
+        )
         logger.info(f"Balance for '{type}' upserted to {limit} in chat {chat_id}")
     except Exception as e:
         logger.error(f"Error in /upsert_balance handler: {e}")
         await tg_helper.reply_text(
-            update, app, "An error occurred while setting the balance."
+            update, context.application, "An error occurred while setting the balance."
         )
 
 
 # Handler for /change_limit command
+@metrics.timed_handler
+@dedupe.exactly_once
 async def change_limit(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Change limit."""
     if update.message is None:
@@ -173,35 +293,47 @@ async def change_limit(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     args = update.message.text.strip().split()[1:]
     if len(args) != 2:
         await tg_helper.reply_text(
-            update, app, "Please provide two arguments: <new_limit> <type>."
+            update,
+            context.application,
+            "Please provide two arguments: <new_limit> <type>.",
         )
         logger.warning(f"Invalid arguments for /change_limit: {args}")
         return
     limit, type = args
     try:
         limit = Decimal(limit)
+        if not is_amount(limit):
+            raise ValueError("Limit must be finite and not too big")
     except (InvalidOperation, ValueError):
-        await tg_helper.reply_text(update, app, "Limit must be a number.")
+        await tg_helper.reply_text(
+            update,
+            context.application,
+            f"Limit must be a number with at most {MAX_AMOUNT_DIGITS} digits before the point.",
+        )
         logger.warning(f"Invalid limit value: {limit}")
         return
     try:
         result = await state.change_limit_for_type(context, chat_id, type, limit)
         if result:
             await tg_helper.reply_text(
-                update, app, f"Limit for '{type}' changed to {limit}."
+                update, context.application, f"Limit for '{type}' changed to {limit}."
             )
             logger.info(f"Limit for '{type}' changed to {limit} in chat {chat_id}")
         else:
-            await tg_helper.reply_text(update, app, f"No balance found for '{type}'.")
+            await tg_helper.reply_text(
+                update, context.application, f"No balance found for '{type}'."
+            )
             logger.warning(f"No balance found for type '{type}' in chat {chat_id}")
     except Exception as e:
         logger.error(f"Error in /change_limit handler: {e}")
         await tg_helper.reply_text(
-            update, app, "An error occurred while changing the limit."
+            update, context.application, "An error occurred while changing the limit."
         )
 
 
 # Handler for /delete_balance command
+@metrics.timed_handler
+@dedupe.exactly_once
 async def delete_balance(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Delete balance."""
     if update.message is None:
@@ -214,26 +346,46 @@ async def delete_balance(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     args = update.message.text.strip().split()[1:]
     if len(args) != 1:
-        await tg_helper.reply_text(update, app, "Please provide one argument: <type>.")
+        await tg_helper.reply_text(
+            update, context.application, "Please provide one argument: <type>."
+        )
         logger.warning(f"Invalid arguments for /delete_balance: {args}")
         return
     type = args[0]
     try:
         result = await state.delete_balance_type(context, chat_id, type)
         if result:
-            await tg_helper.reply_text(update, app, f"Balance for '{type}' deleted.")
+            await tg_helper.reply_text(
+                update, context.application, f"Balance for '{type}' deleted."
+            )
             logger.info(f"Balance for '{type}' deleted in chat {chat_id}")
         else:
-            await tg_helper.reply_text(update, app, f"No balance found for '{type}'.")
+            await tg_helper.reply_text(
+                update, context.application, f"No balance found for '{type}'."
+            )
             logger.warning(f"No balance found for type '{type}' in chat {chat_id}")
     except Exception as e:
         logger.error(f"Error in /delete_balance handler: {e}")
         await tg_helper.reply_text(
-            update, app, "An error occurred while deleting the balance."
+            update, context.application, "An error occurred while deleting the balance."
         )
 
 
+def print_to_string_reset_result(chat_id: int, result) -> str:
+    if not result:
+        logger.info(f"No balances to reset in chat {chat_id}")
+        return "No balances found."
+    if "error" in result:
+        logger.info(f"Reset limits result: {result['error']}")
+        return result["error"]
+    logger.info(f"Balances reset successfully in chat {chat_id}")
+    old_info = print_to_string_balance_info(result["old"])
+    return f"Old balances:\n{old_info}\nBalances have been reset to their limits."
+
+
 # Handler for /reset_limits command
+@metrics.timed_handler
+@dedupe.exactly_once
 async def reset_limits(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Reset limits."""
     if update.message is None:
@@ -244,85 +396,214 @@ async def reset_limits(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     chat_id = update.effective_chat.id
     try:
         result = await state.reset_limits_for_chat(context, chat_id)
-        if result:
-            if "error" in result:
-                result_string = result["error"]
-                logger.info(f"Reset limits result: {result_string}")
+        result_string = print_to_string_reset_result(chat_id, result)
+        await tg_helper.reply_text(update, context.application, result_string)
+    except Exception as e:
+        logger.error(f"Error in /reset_limits handler: {e}")
+        await tg_helper.reply_text(
+            update, context.application, "An error occurred while resetting the limits."
+        )
+
+
+# Handler for /reset_schedule command
+@metrics.timed_handler
+async def reset_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show or change the reset schedule."""
+    if update.message is None:
+        logger.info(
+            f"/reset_schedule command received in chat {update.effective_chat.id}, but update.message is None"
+        )
+        return
+    logger.info(f"/reset_schedule command received in chat {update.effective_chat.id}")
+    chat_id = update.effective_chat.id
+    args = update.message.text.strip().split()[1:]
+    try:
+        if not args:
+            schedule = schedules.store.get(chat_id)
+            if schedule is None:
+                result_string = "No reset schedule."
             else:
-                old_info = print_to_string_balance_info(result["old"])
-                result_string = f"Old balances:\n{old_info}\nBalances have been reset to their limits."
-                logger.info(f"Balances reset successfully in chat {chat_id}")
+                result_string = f"Balances are reset {schedules.describe(schedule)}."
+        elif args == ["off"]:
+            schedules.store.remove(chat_id)
+            result_string = "Scheduled resets are off."
+            logger.info(f"Reset schedule removed in chat {chat_id}")
         else:
-            result_string = "No balances found."
-            logger.info(f"No balances to reset in chat {chat_id}")
-        await tg_helper.reply_text(update, app, result_string)
+            try:
+                schedule = schedules.parse_schedule(args)
+            except ValueError:
+                await tg_helper.reply_text(
+                    update,
+                    context.application,
+                    "Please send 'monthly [day] [timezone]', 'weekly [weekday] [timezone]' or 'off', "
+                    "e.g., '/reset_schedule monthly 1 Europe/Berlin'.",
+                )
+                logger.warning(f"Invalid arguments for /reset_schedule: {args}")
+                return
+            schedules.store.set(chat_id, schedule)
+            result_string = f"Balances will be reset {schedules.describe(schedule)}."
+            logger.info(f"Reset schedule set in chat {chat_id}: {schedule}")
+        await tg_helper.reply_text(update, context.application, result_string)
     except Exception as e:
-        logger.error(f"Error in /reset_limits handler: {e}")
+        logger.error(f"Error in /reset_schedule handler: {e}")
         await tg_helper.reply_text(
-            update, app, "An error occurred while resetting the limits."
+            update,
+            context.application,
+            "An error occurred while changing the reset schedule.",
         )
 
 
+# Job resetting the chats whose scheduled reset is due. Chats are reset a few
+# at a time and their summaries are sent after replies to users, so thousands
+# of chats due at midnight don't hit the Telegram API at once
+async def run_scheduled_resets(context: ContextTypes.DEFAULT_TYPE) -> None:
+    chat_ids = schedules.store.pop_due(time.time())
+    if not chat_ids:
+        return
+    logger.info(f"Running scheduled resets in {len(chat_ids)} chats")
+
+    async def reset(chat_id: int):
+        try:
+            result = await state.reset_limits_for_chat(context, chat_id)
+            result_string = print_to_string_reset_result(chat_id, result)
+            await tg_helper.send_text(
+                context.application,
+                chat_id,
+                f"Scheduled reset.\n{result_string}",
+                outbound.BULK,
+            )
+        except Forbidden:
+            # The bot was removed from the chat, there is nothing to reset
+            logger.info(f"Removing the reset schedule of inaccessible chat {chat_id}")
+            schedules.store.remove(chat_id)
+
+    try:
+        await schedules.run_batch(chat_ids, reset, schedules.RESET_CONCURRENCY)
+    finally:
+        schedules.store.save()
+
+
+# Text about the types that don't mean exactly one category, empty if all do
+def print_to_string_unresolved(resolutions, items_count: int) -> str:
+    lines = []
+    for type, resolution in resolutions.items():
+        if resolution.name is not None:
+            continue
+        if resolution.candidates:
+            candidates = ", ".join(f"'{name}'" for name in resolution.candidates)
+            lines.append(f"'{type}' matches several balances: {candidates}.")
+        elif items_count == 1:
+            lines.append(f"No balance found for '{type}', or insufficient funds.")
+        else:
+            lines.append(f"No balance found for '{type}'.")
+    if lines and items_count > 1:
+        lines.append("Nothing was spent.")
+    return "\n".join(lines)
+
+
 # Handler for spending money via messages
+@metrics.timed_handler
+@dedupe.exactly_once
 async def spend(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Spend money."""
     if update.message is None:
         logger.info(
-            f"Spend command received in chat {update.effective_chat.id} with message: '{update.message.text.strip()}, but update.message is empty'"
+            "Spend command received in chat %s, but update.message is empty",
+            update.effective_chat.id,
         )
         return
-    logger.info(
-        f"Spend command received in chat {update.effective_chat.id} with message: '{update.message.text.strip()}'"
-    )
-
     chat_id = update.effective_chat.id
-
     message_text = update.message.text.strip()
+    # This handler runs for every spend message, so log lazily
+    logger.info(
+        "Spend command received in chat %s with message: '%s'", chat_id, message_text
+    )
     try:
-        parts = message_text.split()
-        if len(parts) < 2:
+        # Set by spend_filter.SPEND, which has already parsed the message
+        items = getattr(context, "spend_items", None)
+        if items is None:
+            items = spend_filter.parse_spend_items(message_text)
+        if items is None:
             await tg_helper.reply_text(
                 update,
-                app,
-                "Please send a message with a number and type, e.g., '50 groceries'.",
+                context.application,
+                "Please send a valid number followed by the type, e.g., '50 groceries'.",
             )
-            logger.warning(f"Invalid message format: '{message_text}'")
+            logger.warning("Invalid message format: '%s'", message_text)
             return
-        amount_str = parts[0]
-        type = parts[1]
-        amount = Decimal(amount_str)
-        logger.debug(f"Parsed amount: {amount}, type: '{type}'")
-        new_balance = await state.spend_balance_for_type(context, chat_id, type, amount)
-        if new_balance is None:
-            await tg_helper.reply_text(
-                update, app, f"No balance found for '{type}', or insufficient funds."
-            )
-            logger.warning(
-                f"Failed to spend {amount} from type '{type}' in chat {chat_id}"
+        logger.debug("Parsed spend items: %s", items)
+        resolutions = await state.resolve_types(
+            context, chat_id, list(dict.fromkeys(type for _, type in items))
+        )
+        unresolved = print_to_string_unresolved(resolutions, len(items))
+        if unresolved:
+            await tg_helper.reply_text(update, context.application, unresolved)
+            logger.warning("Unresolved types in spend message: '%s'", message_text)
+            return
+        items = [(amount, resolutions[type].name) for amount, type in items]
+        if len(items) == 1:
+            amount, type = items[0]
+            result = await state.spend_balance_for_type(context, chat_id, type, amount)
+            if result is None:
+                await tg_helper.reply_text(
+                    update,
+                    context.application,
+                    f"No balance found for '{type}', or insufficient funds.",
+                )
+                logger.warning(
+                    "Failed to spend %s from type '%s' in chat %s",
+                    amount,
+                    type,
+                    chat_id,
+                )
+            else:
+                new_balance, footer = result
+                await tg_helper.reply_text(
+                    update,
+                    context.application,
+                    f"Spent {amount} for '{type}'. Current balance is {new_balance}.\n{footer}",
+                )
+                logger.info(
+                    "Spent %s from type '%s'. New balance: %s",
+                    amount,
+                    type,
+                    new_balance,
+                )
+            return
+        result = await state.spend_balance_for_types(
+            context, chat_id, [(type, amount) for amount, type in items]
+        )
+        if result is None:
+            balance_info = await state.get_balance_info(context, chat_id) or {}
+            missing = ", ".join(
+                f"'{type}'" for _, type in items if type not in balance_info
             )
-        else:
             await tg_helper.reply_text(
                 update,
-                app,
-                f"Spent {amount} for '{type}'. Current balance is {new_balance}.",
+                context.application,
+                f"No balance found for {missing}. Nothing was spent.",
             )
-            logger.info(
-                f"Spent {amount} from type '{type}'. New balance: {new_balance}"
+            logger.warning("Failed to spend %s items in chat %s", len(items), chat_id)
+        else:
+            new_balances, footer = result
+            result_string = "\n".join(
+                f"Spent {amount} for '{type}'. Current balance is {new_balance}."
+                for (amount, type), new_balance in zip(items, new_balances)
             )
-    except (InvalidOperation, ValueError):
-        await tg_helper.reply_text(
-            update,
-            app,
-            "Please send a valid number followed by the type, e.g., '50 groceries'.",
-        )
-        logger.warning(f"Invalid amount value in message: '{message_text}'")
+            result_string += f"\n{footer}"
+            await tg_helper.reply_text(update, context.application, result_string)
+            logger.info("Spent %s items in chat %s", len(items), chat_id)
     except Exception as e:
-        logger.error(f"Error in spend handler: {e}")
+        logger.error("Error in spend handler: %s", e)
         await tg_helper.reply_text(
-            update, app, "An error occurred while processing your request."
+            update,
+            context.application,
+            "An error occurred while processing your request.",
         )
 
 
+@metrics.timed_handler
+@dedupe.exactly_once
 async def set_custom_json_balance(
     update: Update, context: ContextTypes.DEFAULT_TYPE
 ) -> None:
@@ -338,50 +619,526 @@ async def set_custom_json_balance(
         json_str = json_str.replace("/set_custom_json_balance", "").strip()
         try:
             json_data = json.loads(json_str, parse_float=Decimal, parse_int=Decimal)
-        except json.JSONDecodeError:
+            if not isinstance(json_data, dict):
+                raise ValueError("Balances must be a JSON object")
+        except ValueError:
             await tg_helper.reply_text(
                 update,
-                app,
+                context.application,
                 'Please send a valid JSON string followed by the type, e.g., \'{"groceries": {"limit": 100, "balance": 50}}\'.',
             )
             logger.warning(f"Invalid JSON string: '{json_str}'")
             return
         await state.set_custom_json_balance(context, chat_id, json_data)
-        await tg_helper.reply_text(update, app, "Custom JSON balance set successfully.")
+        await tg_helper.reply_text(
+            update, context.application, "Custom JSON balance set successfully."
+        )
         logger.info(f"Custom JSON balance set in chat {chat_id}")
     except Exception as e:
         logger.error(f"Error in /set_custom_json_balance handler: {e}")
         await tg_helper.reply_text(
-            update, app, "An error occurred while processing your request."
+            update,
+            context.application,
+            "An error occurred while processing your request.",
         )
 
 
-# Register command handlers
-app.add_handler(CommandHandler("start", start))
-app.add_handler(CommandHandler("help", help_command))
-app.add_handler(CommandHandler("get_all_balance_info", get_all_balance_info))
-app.add_handler(CommandHandler("upsert_balance", upsert_balance))
-app.add_handler(CommandHandler("change_limit", change_limit))
-app.add_handler(CommandHandler("reset_limits", reset_limits))
-app.add_handler(CommandHandler("delete_balance", delete_balance))
-app.add_handler(CommandHandler("set_custom_json_balance", set_custom_json_balance))
+def print_to_string_history(events):
+    lines = []
+    for event in events:
+        line = f"{datetime.fromtimestamp(event.ts):%Y-%m-%d %H:%M} {ledger.OP_NAMES[event.op]}"
+        if event.type is not None:
+            line += f" {event.type}"
+        if event.amount is not None:
+            line += f" {event.amount}"
+        lines.append(line)
+    return "\n".join(lines)
 
-# on non command i.e message - handle spending
-app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, spend))
 
-# Run the bot
-if WEB_HOOK_HOST:
-    logger.info("Starting bot with webhook.")
+# Handler for /history command
+@metrics.timed_handler
+async def history(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show the latest changes."""
+    if update.message is None:
+        logger.info(
+            f"/history command received in chat {update.effective_chat.id}, but update.message is None"
+        )
+        return
+    logger.info(f"/history command received in chat {update.effective_chat.id}")
+    chat_id = update.effective_chat.id
+    args = update.message.text.strip().split()[1:]
+    try:
+        limit = int(args[0]) if args else HISTORY_DEFAULT_LIMIT
+    except ValueError:
+        await tg_helper.reply_text(
+            update, context.application, "Count must be a whole number."
+        )
+        logger.warning(f"Invalid arguments for /history: {args}")
+        return
+    limit = max(1, min(limit, HISTORY_MAX_LIMIT))
+    try:
+        events = await state.get_history(context, chat_id, limit)
+        if events is None:
+            result_string = "History is only kept with the sqlite storage."
+        elif events:
+            result_string = f"History:\n{print_to_string_history(events)}"
+        else:
+            result_string = "No history found."
+        await tg_helper.reply_text(update, context.application, result_string)
+        logger.debug(f"Sent history to chat {chat_id}")
+    except Exception as e:
+        logger.error(f"Error in /history handler: {e}")
+        await tg_helper.reply_text(
+            update, context.application, "An error occurred while fetching the history."
+        )
+
+
+# Parses "/report" arguments into (kind, period, count). Raises ValueError
+# for invalid ones
+def parse_report_args(args: list[str]) -> tuple[str, str, int]:
+    if args and args[0] in ("weeks", "months"):
+        if len(args) > 2:
+            raise ValueError(f"Invalid report: {args}")
+        count = int(args[1]) if len(args) > 1 else REPORT_DEFAULT_PERIODS
+        return "periods", args[0][:-1], max(1, min(count, REPORT_MAX_COUNT))
+    kind = "categories"
+    count = REPORT_DEFAULT_TOP
+    if args and args[0] == "top":
+        kind = "top"
+        args = args[1:]
+        if args and args[0].isdigit():
+            count = max(1, min(int(args[0]), REPORT_MAX_COUNT))
+            args = args[1:]
+    if len(args) > 1 or (args and args[0] not in spending.PERIODS):
+        raise ValueError(f"Invalid report: {args}")
+    return kind, args[0] if args else spending.MONTH, count
+
+
+# Handler for /quick command
+@metrics.timed_handler
+async def quick_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show the quick spend keyboard."""
+    if update.message is None:
+        logger.info(
+            f"/quick command received in chat {update.effective_chat.id}, but update.message is None"
+        )
+        return
+    logger.info(f"/quick command received in chat {update.effective_chat.id}")
+    chat_id = update.effective_chat.id
+    try:
+        balances = await state.get_balances(context, chat_id)
+        if not balances:
+            await tg_helper.reply_text(
+                update,
+                context.application,
+                "No balances found. Add one with /upsert_balance first.",
+            )
+            return
+        await tg_helper.reply_keyboard(
+            update, "Choose a category.", quick.categories_keyboard(list(balances))
+        )
+    except Exception as e:
+        logger.error(f"Error in /quick handler: {e}")
+        await tg_helper.reply_text(
+            update,
+            context.application,
+            "An error occurred while processing your request.",
+        )
+
+
+# Handler for the buttons of /quick. Every press is answered right away and
+# the /quick message is edited in place instead of sending a new reply
+@metrics.timed_handler
+@dedupe.exactly_once
+async def quick_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Spend with the quick spend keyboard."""
+    query = update.callback_query
+    if query is None or query.message is None:
+        return
+    chat_id = update.effective_chat.id
+    try:
+        action, type, amount = quick.parse_callback(query.data)
+    except ValueError:
+        logger.warning(f"Invalid quick button data: {query.data}")
+        await tg_helper.answer_callback(query)
+        return
+    logger.debug("Quick button %s received in chat %s", query.data, chat_id)
+    try:
+        if action == quick.SPEND:
+            result = await state.spend_balance_for_type(context, chat_id, type, amount)
+            if result is None:
+                await tg_helper.answer_callback(
+                    query, f"No balance found for '{type}'."
+                )
+                return
+            new_balance, footer = result
+            await tg_helper.answer_callback(query, f"Spent {amount} for '{type}'.")
+            await tg_helper.edit_keyboard_message(
+                query,
+                f"Spent {amount} for '{type}'. Current balance is {new_balance}.\n"
+                f"{footer}\n\nChoose an amount.",
+                quick.amounts_keyboard(type),
+            )
+            logger.info(
+                "Spent %s from type '%s'. New balance: %s", amount, type, new_balance
+            )
+            return
+        await tg_helper.answer_callback(query)
+        info = None
+        if action == quick.CATEGORY:
+            info = await state.get_balance_info_by_type(context, chat_id, type)
+        if info is not None:
+            await tg_helper.edit_keyboard_message(
+                query,
+                f"{type}: {info.balance} / {info.limit}\nChoose an amount.",
+                quick.amounts_keyboard(type),
+            )
+        else:
+            balances = await state.get_balances(context, chat_id)
+            await tg_helper.edit_keyboard_message(
+                query, "Choose a category.", quick.categories_keyboard(list(balances))
+            )
+    except Exception as e:
+        logger.error(f"Error in quick button handler: {e}")
+        await tg_helper.answer_callback(
+            query, "An error occurred while processing your request."
+        )
+
+
+# Handler for /report command
+@metrics.timed_handler
+async def report(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show spending reports."""
+    if update.message is None:
+        logger.info(
+            f"/report command received in chat {update.effective_chat.id}, but update.message is None"
+        )
+        return
+    logger.info(f"/report command received in chat {update.effective_chat.id}")
+    chat_id = update.effective_chat.id
+    args = update.message.text.strip().split()[1:]
+    try:
+        kind, period, count = parse_report_args(args)
+    except ValueError:
+        await tg_helper.reply_text(
+            update,
+            context.application,
+            "Please send '/report [week|month]', '/report top [count] [week|month]' "
+            "or '/report weeks|months [count]'.",
+        )
+        logger.warning(f"Invalid arguments for /report: {args}")
+        return
+    try:
+        columns = spending.store.get(chat_id)
+        if columns is None:
+            result_string = "Spending history is turned off."
+        elif not len(columns):
+            result_string = "No spending found."
+        else:
+            schedule = schedules.store.get(chat_id)
+            timezone = schedule.timezone if schedule else schedules.RESET_TIMEZONE
+            now = time.time()
+            if kind == "periods":
+                result_string = spending.period_report(
+                    columns, period, now, timezone, count
+                )
+            elif kind == "top":
+                result_string = spending.top_report(
+                    columns, period, now, timezone, count
+                )
+            else:
+                limits = await state.get_limits(context, chat_id)
+                result_string = spending.category_report(
+                    columns,
+                    period,
+                    now,
+                    timezone,
+                    {type: float(limit) for type, limit in limits.items()},
+                )
+        await tg_helper.reply_text(update, context.application, result_string)
+        logger.debug(f"Sent {kind} report to chat {chat_id}")
+    except Exception as e:
+        logger.error(f"Error in /report handler: {e}")
+        await tg_helper.reply_text(
+            update, context.application, "An error occurred while building the report."
+        )
+
+
+# Handler for /export command
+@metrics.timed_handler
+async def export(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Export balances and spending history."""
+    # csv and numpy aren't needed before the first export or import
+    import backup
+
+    if update.message is None:
+        logger.info(
+            f"/export command received in chat {update.effective_chat.id}, but update.message is None"
+        )
+        return
+    logger.info(f"/export command received in chat {update.effective_chat.id}")
+    chat_id = update.effective_chat.id
+    args = update.message.text.strip().split()[1:]
+    format = args[0].lower() if args else backup.CSV
+    if len(args) > 1 or format not in backup.FORMATS:
+        await tg_helper.reply_text(
+            update, context.application, "Please send '/export [csv|jsonl]'."
+        )
+        logger.warning(f"Invalid arguments for /export: {args}")
+        return
+    try:
+        balances = await state.get_balances(context, chat_id)
+        columns = spending.store.get(chat_id)
+        if not balances and not columns:
+            await tg_helper.reply_text(
+                update, context.application, "Nothing to export."
+            )
+            return
+        # The export is written to disk chunk by chunk instead of into memory
+        with tempfile.TemporaryFile() as file:
+            await backup.write_export(file, format, balances, columns)
+            await tg_helper.reply_document(
+                update, file, f"money-counter-{chat_id}.{format}"
+            )
+        logger.info(f"Exported {len(balances)} balances of chat {chat_id}")
+    except Exception as e:
+        logger.error(f"Error in /export handler: {e}")
+        await tg_helper.reply_text(
+            update, context.application, "An error occurred while exporting."
+        )
+
+
+async def _download(context: ContextTypes.DEFAULT_TYPE, document, file):
+    async with metrics.api_call("get_file"):
+        telegram_file = await context.bot.get_file(document.file_id)
+    await telegram_file.download_to_memory(file)
+    file.seek(0)
+
+
+# Handler for /import, sent as the caption of a document or as a reply to one.
+# The whole file is validated before anything changes, then the balances are
+# replaced with a single write and the spends are appended in batches
+@metrics.timed_handler
+@dedupe.exactly_once
+async def import_data(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Import balances and spending history."""
+    import backup
+
+    message = update.message
+    if message is None:
+        logger.info(
+            f"/import command received in chat {update.effective_chat.id}, but update.message is None"
+        )
+        return
+    logger.info(f"/import command received in chat {update.effective_chat.id}")
+    chat_id = update.effective_chat.id
+    document = message.document
+    if document is None and message.reply_to_message is not None:
+        document = message.reply_to_message.document
+    if document is None:
+        await tg_helper.reply_text(
+            update,
+            context.application,
+            "Please send a file from /export with the caption /import, or reply /import to one.",
+        )
+        logger.warning(f"No document for /import in chat {chat_id}")
+        return
+    if document.file_size and document.file_size > backup.IMPORT_MAX_SIZE:
+        await tg_helper.reply_text(
+            update, context.application, "The file is too big, bots can read 20 MB."
+        )
+        logger.warning(f"Document of {document.file_size} bytes for /import")
+        return
+    format = backup.format_for(document.file_name)
     try:
-        app.bot.set_webhook(WEB_HOOK_HOST, allowed_updates=Update.ALL_TYPES)
-        app.run_webhook(port=5000, listen="0.0.0.0", webhook_url=WEB_HOOK_HOST)
-        logger.info("Webhook is set and bot is running.")
+        with tempfile.TemporaryFile() as file:
+            await _download(context, document, file)
+            text = io.TextIOWrapper(file, encoding="utf-8", newline="")
+            try:
+                summary = await asyncio.to_thread(backup.validate, text, format)
+            except (ValueError, UnicodeDecodeError) as e:
+                await tg_helper.reply_text(
+                    update, context.application, f"Nothing was imported. {e}."
+                )
+                logger.warning(f"Invalid document for /import in chat {chat_id}: {e}")
+                return
+            if not summary.balances and not summary.spends:
+                await tg_helper.reply_text(
+                    update, context.application, "Nothing to import."
+                )
+                return
+            spend_batches = None
+            if summary.spends:
+                text.seek(0)
+                spend_batches = backup.spend_batches(text, format)
+            await state.import_chat_data(
+                context, chat_id, summary.balances, spend_batches
+            )
+        result_string = f"Imported {len(summary.balances)} balances"
+        if spending.store.enabled:
+            result_string += f" and {summary.spends} spends."
+        else:
+            result_string += ", spending history is turned off."
+        await tg_helper.reply_text(update, context.application, result_string)
+        logger.info(
+            f"Imported {len(summary.balances)} balances and {summary.spends} spends in chat {chat_id}"
+        )
     except Exception as e:
-        logger.error(f"Failed to set webhook: {e}")
-else:
-    logger.info("Starting bot with long polling.")
+        logger.error(f"Error in /import handler: {e}")
+        await tg_helper.reply_text(
+            update, context.application, "An error occurred while importing."
+        )
+
+
+# Handler for /stats command, only for users from ADMIN_USER_IDS
+@metrics.timed_handler
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show performance statistics."""
+    if update.message is None:
+        return
+    user_id = update.effective_user.id
+    logger.info(f"/stats command received from user {user_id}")
+    if user_id not in ADMIN_USER_IDS:
+        await tg_helper.reply_text(
+            update, context.application, "This command is only for admins."
+        )
+        logger.warning(f"User {user_id} is not allowed to see stats")
+        return
     try:
-        app.run_polling(allowed_updates=Update.ALL_TYPES)
-        logger.info("Bot is polling for updates.")
+        await tg_helper.reply_text(update, context.application, metrics.summary())
     except Exception as e:
-        logger.error(f"Failed to start polling: {e}")
+        logger.error(f"Error in /stats handler: {e}")
+
+
+# Build the application and register command handlers
+def create_app(
+    token: str,
+    metrics_port: int = METRICS_PORT,
+    dedupe_path: str | None = dedupe.DEDUPE_PATH,
+    schedules_path: str = schedules.RESET_SCHEDULES_PATH,
+    base_url: str | None = None,
+    outbox_path: str | None = state.STATE_OUTBOX_PATH,
+    shard: tuple[int, int] | None = None,
+) -> Application:
+    builder = (
+        Application.builder()
+        .token(token)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .post_init(post_init)
+        .post_stop(post_stop)
+    )
+    if base_url is not None:
+        # Another Bot API server, like a local one or a load test stand-in
+        builder = builder.base_url(base_url)
+    app = builder.build()
+    app.bot_data["metrics_port"] = metrics_port
+    app.bot_data["dedupe_path"] = dedupe_path
+    app.bot_data["schedules_path"] = schedules_path
+    app.bot_data["outbox_path"] = outbox_path
+    # (index, workers) of a webhook worker, which prewarms only its own chats
+    app.bot_data["shard"] = shard
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("help", help_command))
+    app.add_handler(CommandHandler("get_all_balance_info", get_all_balance_info))
+    app.add_handler(CommandHandler("upsert_balance", upsert_balance))
+    app.add_handler(CommandHandler("change_limit", change_limit))
+    app.add_handler(CommandHandler("reset_limits", reset_limits))
+    app.add_handler(CommandHandler("reset_schedule", reset_schedule))
+    app.add_handler(CommandHandler("delete_balance", delete_balance))
+    app.add_handler(CommandHandler("set_custom_json_balance", set_custom_json_balance))
+    app.add_handler(CommandHandler("history", history))
+    app.add_handler(CommandHandler("quick", quick_command))
+    app.add_handler(CallbackQueryHandler(quick_button, pattern=quick.PATTERN))
+    app.add_handler(CommandHandler("report", report))
+    app.add_handler(CommandHandler("export", export))
+    app.add_handler(CommandHandler("import", import_data))
+    app.add_handler(
+        MessageHandler(
+            filters.Document.ALL & filters.CaptionRegex(r"^/import(@\w+)?(\s|$)"),
+            import_data,
+        )
+    )
+    app.add_handler(CommandHandler("stats", stats))
+
+    # on spend messages - handle spending, other messages never reach a handler
+    app.add_handler(
+        MessageHandler(filters.UpdateType.MESSAGE & spend_filter.SPEND, spend)
+    )
+    return app
+
+
+# Application of a webhook worker process, worker i serves its metrics on
+# METRICS_PORT + 1 + i, and keeps its handled updates, the reset schedules
+# and the unwritten changes of its chats in DEDUPE_PATH.i,
+# RESET_SCHEDULES_PATH.i and STATE_OUTBOX_PATH.i
+def create_worker_app(index: int) -> Application:
+    return create_app(
+        TELEGRAM_BOT_KEY,
+        METRICS_PORT and METRICS_PORT + 1 + index,
+        dedupe.DEDUPE_PATH and f"{dedupe.DEDUPE_PATH}.{index}",
+        f"{schedules.RESET_SCHEDULES_PATH}.{index}",
+        outbox_path=state.STATE_OUTBOX_PATH and f"{state.STATE_OUTBOX_PATH}.{index}",
+        shard=(index, WEB_HOOK_WORKERS),
+    )
+
+
+# Run the receiver in front of WEB_HOOK_WORKERS worker processes
+def run_sharded_webhook():
+    import sharding
+
+    # The workers share Telegram's global limit
+    os.environ["OUTBOUND_GLOBAL_RATE"] = str(
+        outbound.OUTBOUND_GLOBAL_RATE / WEB_HOOK_WORKERS
+    )
+    receiver = sharding.ShardedWebhook(
+        create_worker_app, WEB_HOOK_WORKERS, WEB_HOOK_QUEUE_SIZE
+    )
+    asyncio.run(
+        receiver.serve(
+            TELEGRAM_BOT_KEY,
+            WEB_HOOK_HOST,
+            "0.0.0.0",
+            WEB_HOOK_PORT,
+            secret_token=WEB_HOOK_SECRET,
+        )
+    )
+
+
+# Run the bot
+def main():
+    # CPU time of the interpreter start and the imports so far
+    metrics.startup_phases["imports"] = time.process_time()
+    check_env_variables()
+    if WEB_HOOK_HOST and WEB_HOOK_WORKERS > 1:
+        logger.info(f"Starting bot with webhook and {WEB_HOOK_WORKERS} workers.")
+        try:
+            run_sharded_webhook()
+        except Exception as e:
+            logger.error(f"Failed to run webhook workers: {e}")
+        return
+    with metrics.startup_phase("build"):
+        app = create_app(TELEGRAM_BOT_KEY)
+    if WEB_HOOK_HOST:
+        logger.info("Starting bot with webhook.")
+        try:
+            # run_webhook sets the webhook before it starts serving
+            app.run_webhook(
+                port=WEB_HOOK_PORT,
+                listen="0.0.0.0",
+                webhook_url=WEB_HOOK_HOST,
+                allowed_updates=Update.ALL_TYPES,
+                secret_token=WEB_HOOK_SECRET,
+            )
+        except Exception as e:
+            logger.error(f"Failed to set webhook: {e}")
+    else:
+        logger.info("Starting bot with long polling.")
+        try:
+            app.run_polling(allowed_updates=Update.ALL_TYPES)
+            logger.info("Bot is polling for updates.")
+        except Exception as e:
+            logger.error(f"Failed to start polling: {e}")
+
+
+if __name__ == "__main__":
+    main()
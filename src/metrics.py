@@ -0,0 +1,257 @@
+import functools
+import logging
+import time
+from bisect import bisect_left
+from contextlib import asynccontextmanager, contextmanager
+from telegram.error import RetryAfter
+
+logger = logging.getLogger(__name__)
+
+PREFIX = "money_counter_"
+# Upper bounds of latency histogram buckets in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# A chat is active if it had an update within this many seconds
+ACTIVE_CHAT_WINDOW = 300
+
+_metrics = []
+
+
+class Counter:
+    def __init__(self, name: str, help: str, label: str | None = None):
+        self.name = PREFIX + name
+        self.help = help
+        self.label = label
+        self.values: dict[str, float] = {}
+        _metrics.append(self)
+
+    def inc(self, label_value: str = "", amount: float = 1) -> None:
+        self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def get(self, label_value: str = "") -> float:
+        return self.values.get(label_value, 0)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for label_value, value in self.values.items():
+            lines.append(f"{self.name}_total{_labels(self.label, label_value)} {value}")
+        return lines
+
+
+class _Series:
+    __slots__ = ("buckets", "sum", "count")
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, label: str):
+        self.name = PREFIX + name
+        self.help = help
+        self.label = label
+        self.series: dict[str, _Series] = {}
+        _metrics.append(self)
+
+    def observe(self, label_value: str, value: float) -> None:
+        series = self.series.get(label_value)
+        if series is None:
+            series = self.series[label_value] = _Series()
+        series.buckets[bisect_left(BUCKETS, value)] += 1
+        series.sum += value
+        series.count += 1
+
+    # Upper bound of the bucket holding the q-quantile, inf past the last one
+    def quantile(self, label_value: str, q: float) -> float:
+        series = self.series.get(label_value)
+        if series is None or series.count == 0:
+            return 0.0
+        rank = q * series.count
+        seen = 0
+        for bound, count in zip(BUCKETS, series.buckets):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label_value, series in self.series.items():
+            seen = 0
+            for bound, count in zip(BUCKETS, series.buckets):
+                seen += count
+                labels = _labels(self.label, label_value, le=str(bound))
+                lines.append(f"{self.name}_bucket{labels} {seen}")
+            labels = _labels(self.label, label_value, le="+Inf")
+            lines.append(f"{self.name}_bucket{labels} {series.count}")
+            labels = _labels(self.label, label_value)
+            lines.append(f"{self.name}_sum{labels} {series.sum}")
+            lines.append(f"{self.name}_count{labels} {series.count}")
+        return lines
+
+
+def _labels(label: str | None, value: str, le: str | None = None) -> str:
+    pairs = []
+    if label is not None:
+        escaped = value.replace("\\", "\\\\").replace('"', '\\"')
+        pairs.append(f'{label}="{escaped}"')
+    if le is not None:
+        pairs.append(f'le="{le}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+handler_latency = Histogram(
+    "handler_latency_seconds", "Time spent in update handlers.", "handler"
+)
+api_latency = Histogram(
+    "telegram_api_latency_seconds", "Latency of Telegram Bot API calls.", "method"
+)
+api_calls = Counter("telegram_api_calls", "Telegram Bot API calls.", "method")
+api_errors = Counter("telegram_api_errors", "Failed Telegram Bot API calls.", "method")
+api_rate_limited = Counter(
+    "telegram_api_rate_limited", "Telegram Bot API calls answered with 429.", "method"
+)
+api_retries = Counter(
+    "telegram_api_retries", "Retried Telegram Bot API calls.", "method"
+)
+duplicate_updates = Counter(
+    "duplicate_updates", "Redelivered updates skipped by handlers.", "handler"
+)
+cache_requests = Counter(
+    "state_cache_requests", "State cache lookups by result.", "result"
+)
+
+# chat_id -> monotonic time of its latest update
+_chat_last_seen: dict[int, float] = {}
+# Seconds every phase of the startup took, in the order they ran
+startup_phases: dict[str, float] = {}
+
+
+def touch_chat(chat_id: int) -> None:
+    _chat_last_seen[chat_id] = time.monotonic()
+
+
+def active_chats() -> int:
+    deadline = time.monotonic() - ACTIVE_CHAT_WINDOW
+    for chat_id in [c for c, seen in _chat_last_seen.items() if seen < deadline]:
+        del _chat_last_seen[chat_id]
+    return len(_chat_last_seen)
+
+
+# Decorator recording the latency of an update handler and its chat
+def timed_handler(func):
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(update, context):
+        if update.effective_chat is not None:
+            touch_chat(update.effective_chat.id)
+        started = time.perf_counter()
+        try:
+            return await func(update, context)
+        finally:
+            handler_latency.observe(name, time.perf_counter() - started)
+
+    return wrapper
+
+
+# Context manager counting and timing one Telegram Bot API call
+@asynccontextmanager
+async def api_call(method: str):
+    api_calls.inc(method)
+    started = time.perf_counter()
+    try:
+        yield
+    except RetryAfter:
+        api_rate_limited.inc(method)
+        api_errors.inc(method)
+        raise
+    except Exception:
+        api_errors.inc(method)
+        raise
+    finally:
+        api_latency.observe(method, time.perf_counter() - started)
+
+
+# Context manager recording how long a phase of the startup took
+@contextmanager
+def startup_phase(name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_phases[name] = time.perf_counter() - started
+
+
+# "imports 310 ms, build 12 ms, ..." of the phases recorded so far
+def startup_summary() -> str:
+    return ", ".join(
+        f"{name} {seconds * 1000:.0f} ms" for name, seconds in startup_phases.items()
+    )
+
+
+def cache_hit_rate() -> float | None:
+    hits = cache_requests.get("hit")
+    total = hits + cache_requests.get("miss")
+    return hits / total if total else None
+
+
+# All metrics in the Prometheus text exposition format
+def render() -> str:
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    name = PREFIX + "active_chats"
+    lines.append(
+        f"# HELP {name} Chats with an update in the last {ACTIVE_CHAT_WINDOW}s."
+    )
+    lines.append(f"# TYPE {name} gauge")
+    lines.append(f"{name} {active_chats()}")
+    if startup_phases:
+        name = PREFIX + "startup_seconds"
+        lines.append(f"# HELP {name} Time spent in every phase of the startup.")
+        lines.append(f"# TYPE {name} gauge")
+        for phase, seconds in startup_phases.items():
+            lines.append(f"{name}{_labels('phase', phase)} {seconds:g}")
+    return "\n".join(lines) + "\n"
+
+
+# Short human readable summary for the /stats command
+def summary() -> str:
+    lines = ["Handlers (count, p50 ms, p99 ms):"]
+    for name, series in sorted(handler_latency.series.items()):
+        p50 = handler_latency.quantile(name, 0.5) * 1000
+        p99 = handler_latency.quantile(name, 0.99) * 1000
+        lines.append(f"{name}: {series.count}, <{p50:g}, <{p99:g}")
+    lines.append("\nTelegram API (calls, avg ms, errors, 429s, retries):")
+    for method, series in sorted(api_latency.series.items()):
+        average = series.sum / series.count * 1000 if series.count else 0.0
+        lines.append(
+            f"{method}: {series.count}, {average:.1f}, {api_errors.get(method):g}, "
+            f"{api_rate_limited.get(method):g}, {api_retries.get(method):g}"
+        )
+    hit_rate = cache_hit_rate()
+    if hit_rate is not None:
+        lines.append(f"\nState cache hit rate: {hit_rate:.1%}")
+    lines.append(f"Active chats: {active_chats()}")
+    if startup_phases:
+        lines.append(f"Startup: {startup_summary()}")
+    duplicates = sum(duplicate_updates.values.values())
+    if duplicates:
+        lines.append(f"Redelivered updates skipped: {duplicates:g}")
+    return "\n".join(lines)
+
+
+# Serves render() at /metrics on its own port next to the webhook server
+def start_server(port: int):
+    import tornado.web
+
+    class MetricsHandler(tornado.web.RequestHandler):
+        def get(self):
+            self.set_header("Content-Type", "text/plain; version=0.0.4")
+            self.write(render())
+
+    server = tornado.web.Application([("/metrics", MetricsHandler)]).listen(port)
+    logger.info(f"Serving metrics on port {port}")
+    return server
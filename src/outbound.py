@@ -0,0 +1,220 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+from datetime import timedelta
+from typing import Awaitable, Callable
+from telegram.error import RetryAfter
+import metrics
+from cache import ChatCache
+from codec import MESSAGE_MAX_LENGTH
+
+logger = logging.getLogger(__name__)
+
+# Telegram allows about one message per second in a chat with short bursts,
+# and about 30 messages per second overall. 0 disables a limit
+OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE", "1"))
+OUTBOUND_CHAT_BURST = float(os.getenv("OUTBOUND_CHAT_BURST", "3"))
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "30"))
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", "3"))
+
+# Priority classes, lower is sent first
+STATE = 0
+REPLY = 1
+# Messages nobody is waiting for, like scheduled reset summaries
+BULK = 2
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    # Seconds until a token is available, 0 if one was taken
+    def take(self) -> float:
+        if self.rate <= 0:
+            return 0.0
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    async def acquire(self):
+        while (wait := self.take()) > 0:
+            await asyncio.sleep(wait)
+
+
+# Token bucket whose waiters get tokens in priority order
+class PriorityTokenBucket(TokenBucket):
+    def __init__(self, rate: float, burst: float):
+        super().__init__(rate, burst)
+        self._waiters = []
+        self._order = itertools.count()
+        self._task = None
+
+    async def acquire(self, priority: int = 0):
+        if not self._waiters and self.take() == 0:
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._order), future))
+        if self._task is None:
+            self._task = asyncio.create_task(self._grant())
+        await future
+
+    async def _grant(self):
+        try:
+            while self._waiters:
+                wait = self.take()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                    continue
+                _, _, future = heapq.heappop(self._waiters)
+                if not future.done():
+                    future.set_result(None)
+        finally:
+            self._task = None
+
+
+class _Job:
+    __slots__ = ("priority", "order", "method", "call", "text", "merge_key", "futures")
+
+    def __init__(self, priority, order, method, call, text, merge_key):
+        self.priority = priority
+        self.order = order
+        self.method = method
+        self.call = call
+        self.text = text
+        self.merge_key = merge_key
+        self.futures = [asyncio.get_running_loop().create_future()]
+
+    def __lt__(self, other):
+        return (self.priority, self.order) < (other.priority, other.order)
+
+
+# Central queue for everything the bot sends. Each chat with pending jobs has
+# a worker sending them in priority order within the chat's token bucket, all
+# workers share a global bucket that serves state writes before replies.
+# Pending replies with the same merge key are sent as one message, and calls
+# answered with 429 are retried after the delay Telegram asks for
+class OutboundScheduler:
+    def __init__(self, chat_rate, chat_burst, global_rate, max_retries):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._global = PriorityTokenBucket(global_rate, max(1.0, global_rate))
+        # An idle chat's bucket is full again after burst / rate seconds
+        bucket_ttl = chat_burst / chat_rate if chat_rate > 0 else 0
+        self._buckets = ChatCache(100_000, bucket_ttl)
+        self._queues: dict[int, list[_Job]] = {}
+        # Worker task of every chat with pending jobs
+        self._workers: dict[int, asyncio.Task] = {}
+        self._order = itertools.count()
+
+    def __len__(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    # Sends through `call`, which is given the text to send. Replies with the
+    # same merge_key that wait in the queue together are merged into one
+    async def send(
+        self,
+        chat_id: int,
+        priority: int,
+        method: str,
+        call: Callable[[str | None], Awaitable],
+        text: str | None = None,
+        merge_key: object = None,
+    ):
+        job = _Job(priority, next(self._order), method, call, text, merge_key)
+        queue = self._queues.get(chat_id)
+        if queue is None:
+            queue = self._queues[chat_id] = []
+            worker = asyncio.create_task(self._run(chat_id, queue))
+            self._workers[chat_id] = worker
+            worker.add_done_callback(lambda task: self._forget(chat_id, task))
+        heapq.heappush(queue, job)
+        return await job.futures[0]
+
+    def _forget(self, chat_id: int, worker: asyncio.Task):
+        # A new worker may have started for the chat meanwhile
+        if self._workers.get(chat_id) is worker:
+            del self._workers[chat_id]
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        entry = self._buckets.get(chat_id)
+        if entry is not None:
+            return entry.value
+        bucket = TokenBucket(self.chat_rate, self.chat_burst)
+        self._buckets.put(chat_id, bucket)
+        return bucket
+
+    def _merge(self, job: _Job, queue: list[_Job]):
+        if job.merge_key is None:
+            return
+        merged = []
+        length = len(job.text)
+        for other in sorted(queue):
+            if other.merge_key != job.merge_key:
+                continue
+            length += len(other.text) + 2
+            if length > MESSAGE_MAX_LENGTH:
+                break
+            merged.append(other)
+        if not merged:
+            return
+        queue[:] = [other for other in queue if other not in merged]
+        heapq.heapify(queue)
+        job.text = "\n\n".join([job.text] + [other.text for other in merged])
+        for other in merged:
+            job.futures.extend(other.futures)
+        logger.debug(f"Merged {len(merged) + 1} {job.method} calls")
+
+    async def _run(self, chat_id: int, queue: list[_Job]):
+        try:
+            while queue:
+                await self._bucket(chat_id).acquire()
+                job = heapq.heappop(queue)
+                self._merge(job, queue)
+                await self._global.acquire(job.priority)
+                try:
+                    result = await self._call(job)
+                except Exception as e:
+                    for future in job.futures:
+                        if not future.done():
+                            future.set_exception(e)
+                else:
+                    for future in job.futures:
+                        if not future.done():
+                            future.set_result(result)
+        finally:
+            if self._queues.get(chat_id) is queue:
+                del self._queues[chat_id]
+
+    async def _call(self, job: _Job):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await job.call(job.text)
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = e.retry_after
+                if isinstance(delay, timedelta):
+                    delay = delay.total_seconds()
+                logger.warning(f"{job.method} hit the rate limit, retry in {delay}s")
+                metrics.api_retries.inc(job.method)
+                await asyncio.sleep(delay)
+                await self._global.acquire(job.priority)
+
+
+scheduler = OutboundScheduler(
+    OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST, OUTBOUND_GLOBAL_RATE, OUTBOUND_MAX_RETRIES
+)
@@ -0,0 +1,88 @@
+import json
+import logging
+import os
+from data_dir import make_parent
+
+logger = logging.getLogger(__name__)
+
+# Rewrite the file once it has this many more lines than pending chats
+COMPACT_SLACK = 1000
+
+
+# Local journal of state writes that haven't reached Telegram yet, so they
+# survive a crash or restart during an API outage. Every line is the latest
+# data of a chat, or a mark that the chat's data was written. Lines are
+# fsynced before the change is acknowledged, and the file is rewritten with
+# only the pending chats once it has grown by COMPACT_SLACK lines
+class Outbox:
+    def __init__(self):
+        self._path = None
+        self._file = None
+        # chat_id -> serialized data waiting to be written
+        self._pending: dict[int, str] = {}
+        self._lines = 0
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    @property
+    def enabled(self) -> bool:
+        return self._file is not None
+
+    # Opens the file and returns the serialized data of the chats whose
+    # writes were still pending
+    def open(self, path: str) -> dict[int, str]:
+        make_parent(path)
+        self._path = path
+        if os.path.exists(path):
+            with open(path) as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A line cut short by a crash
+                        continue
+                    if "d" in entry:
+                        self._pending[entry["c"]] = entry["d"]
+                    else:
+                        self._pending.pop(entry["c"], None)
+        logger.info(f"Loaded {len(self._pending)} pending state writes from {path}")
+        self._compact()
+        return dict(self._pending)
+
+    def _write(self, entry: dict):
+        self._file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._lines += 1
+        if self._lines > len(self._pending) + COMPACT_SLACK:
+            self._compact()
+
+    def add(self, chat_id: int, data_json: str):
+        if self._file is None:
+            return
+        self._pending[chat_id] = data_json
+        self._write({"c": chat_id, "d": data_json})
+
+    def done(self, chat_id: int):
+        if self._file is None or self._pending.pop(chat_id, None) is None:
+            return
+        self._write({"c": chat_id})
+
+    def _compact(self):
+        if self._file is not None:
+            self._file.close()
+        temporary_path = f"{self._path}.tmp"
+        with open(temporary_path, "w") as file:
+            for chat_id, data_json in self._pending.items():
+                file.write(json.dumps({"c": chat_id, "d": data_json}) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, self._path)
+        self._file = open(self._path, "a")
+        self._lines = len(self._pending)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,81 @@
+import os
+from decimal import Decimal, InvalidOperation
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from budget import is_amount
+
+# Amounts offered for a category by /quick
+QUICK_AMOUNTS = [
+    Decimal(amount)
+    for amount in os.getenv("QUICK_AMOUNTS", "1,5,10,20,50,100").split(",")
+    if amount
+]
+# Telegram allows 100 buttons per keyboard and 64 bytes of callback data
+QUICK_MAX_CATEGORIES = 99
+CALLBACK_DATA_MAX_BYTES = 64
+_ROW_SIZE = 3
+_LONGEST_AMOUNT = max((str(amount) for amount in QUICK_AMOUNTS), key=len, default="")
+
+# Callback data: "q:c:<type>" picks a category, "q:s:<amount>:<type>" spends
+# and "q:b" goes back to the categories
+PREFIX = "q:"
+PATTERN = r"^q:"
+CATEGORY = "c"
+SPEND = "s"
+BACK = "b"
+
+
+def _rows(buttons: list[InlineKeyboardButton]) -> list[list[InlineKeyboardButton]]:
+    rows = []
+    for button in buttons:
+        if not rows or len(rows[-1]) == _ROW_SIZE:
+            rows.append([])
+        rows[-1].append(button)
+    return rows
+
+
+def _fits(data: str) -> bool:
+    return len(data.encode()) <= CALLBACK_DATA_MAX_BYTES
+
+
+# Keyboard of the categories. Categories whose names don't fit into callback
+# data are left out
+def categories_keyboard(types: list[str]) -> InlineKeyboardMarkup:
+    buttons = []
+    for type in types:
+        data = f"{PREFIX}{CATEGORY}:{type}"
+        if _fits(f"{PREFIX}{SPEND}:{_LONGEST_AMOUNT}:{type}"):
+            buttons.append(InlineKeyboardButton(type, callback_data=data))
+        if len(buttons) == QUICK_MAX_CATEGORIES:
+            break
+    return InlineKeyboardMarkup(_rows(buttons))
+
+
+# Keyboard of the amounts for one category, with a button back
+def amounts_keyboard(type: str) -> InlineKeyboardMarkup:
+    buttons = [
+        InlineKeyboardButton(
+            str(amount), callback_data=f"{PREFIX}{SPEND}:{amount}:{type}"
+        )
+        for amount in QUICK_AMOUNTS
+    ]
+    back = InlineKeyboardButton("« Categories", callback_data=f"{PREFIX}{BACK}")
+    return InlineKeyboardMarkup(_rows(buttons) + [[back]])
+
+
+# Parses callback data into (action, type, amount). Raises ValueError for
+# data this module didn't make, clients can send any callback data
+def parse_callback(data: str) -> tuple[str, str | None, Decimal | None]:
+    action, _, rest = data.removeprefix(PREFIX).partition(":")
+    if action == BACK:
+        return BACK, None, None
+    if action == CATEGORY and rest:
+        return CATEGORY, rest, None
+    if action == SPEND:
+        amount, _, type = rest.partition(":")
+        try:
+            amount = Decimal(amount)
+        except InvalidOperation:
+            amount = None
+        if type and is_amount(amount):
+            return SPEND, type, amount
+    raise ValueError(f"Invalid callback data: {data}")
@@ -0,0 +1,179 @@
+import asyncio
+import heapq
+import json
+import logging
+import os
+import time
+from calendar import monthrange
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, NamedTuple
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from data_dir import data_path, make_parent
+
+logger = logging.getLogger(__name__)
+
+# File keeping the reset schedules of all chats
+RESET_SCHEDULES_PATH = os.getenv(
+    "RESET_SCHEDULES_PATH", data_path("reset-schedules.json")
+)
+RESET_TIMEZONE = os.getenv("RESET_TIMEZONE", "UTC")
+# Chats reset at the same time, their summaries are paced by the outbound
+# scheduler
+RESET_CONCURRENCY = int(os.getenv("RESET_CONCURRENCY", "8"))
+# Seconds between checks for chats with a due reset
+RESET_CHECK_INTERVAL = 60
+
+MONTHLY = "monthly"
+WEEKLY = "weekly"
+WEEKDAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+
+
+class Schedule(NamedTuple):
+    period: str
+    # Day of the month for monthly resets, index in WEEKDAYS for weekly ones
+    day: int
+    timezone: str
+
+
+# Parses "monthly [day] [timezone]" or "weekly [weekday] [timezone]" command
+# arguments. Raises ValueError for invalid ones
+def parse_schedule(args: list[str]) -> Schedule:
+    if not args or args[0] not in (MONTHLY, WEEKLY) or len(args) > 3:
+        raise ValueError(f"Invalid schedule: {args}")
+    period = args[0]
+    if period == MONTHLY:
+        day = int(args[1]) if len(args) > 1 else 1
+        if not 1 <= day <= 31:
+            raise ValueError(f"Invalid day of the month: {day}")
+    else:
+        weekday = args[1].lower()[:3] if len(args) > 1 else WEEKDAYS[0]
+        if weekday not in WEEKDAYS:
+            raise ValueError(f"Invalid weekday: {weekday}")
+        day = WEEKDAYS.index(weekday)
+    timezone = args[2] if len(args) > 2 else RESET_TIMEZONE
+    try:
+        ZoneInfo(timezone)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise ValueError(f"Unknown timezone: {timezone}")
+    return Schedule(period, day, timezone)
+
+
+def describe(schedule: Schedule) -> str:
+    if schedule.period == MONTHLY:
+        when = f"every month on day {schedule.day}"
+    else:
+        when = f"every {WEEKDAYS[schedule.day]}"
+    return f"{when} at 00:00 {schedule.timezone}"
+
+
+# Timestamp of the first reset after the given one: midnight in the
+# schedule's timezone. Monthly resets on days a month doesn't have happen on
+# its last day
+def next_reset(schedule: Schedule, after: float) -> float:
+    timezone = ZoneInfo(schedule.timezone)
+    now = datetime.fromtimestamp(after, timezone)
+    if schedule.period == WEEKLY:
+        days = (schedule.day - now.weekday()) % 7
+        midnight = datetime(now.year, now.month, now.day, tzinfo=timezone)
+        candidate = midnight + timedelta(days=days)
+        if candidate.timestamp() <= after:
+            candidate += timedelta(days=7)
+        return candidate.timestamp()
+    year, month = now.year, now.month
+    while True:
+        day = min(schedule.day, monthrange(year, month)[1])
+        candidate = datetime(year, month, day, tzinfo=timezone)
+        if candidate.timestamp() > after:
+            return candidate.timestamp()
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+# Reset schedules of all chats with a heap of their next resets, so due chats
+# are found without looking at the others
+class ScheduleStore:
+    def __init__(self):
+        self._path = None
+        self._schedules: dict[int, Schedule] = {}
+        self._next: dict[int, float] = {}
+        # (next reset, chat_id), entries of changed schedules are skipped
+        self._due: list[tuple[float, int]] = []
+
+    def __len__(self) -> int:
+        return len(self._schedules)
+
+    def open(self, path: str):
+        make_parent(path)
+        self._path = path
+        if os.path.exists(path):
+            with open(path) as file:
+                for chat_id, (period, day, timezone, next_at) in json.load(
+                    file
+                ).items():
+                    self._add(int(chat_id), Schedule(period, day, timezone), next_at)
+        logger.info(f"Loaded {len(self._schedules)} reset schedules from {path}")
+
+    def save(self):
+        if self._path is None:
+            return
+        schedules = {
+            chat_id: [*schedule, self._next[chat_id]]
+            for chat_id, schedule in self._schedules.items()
+        }
+        temporary_path = f"{self._path}.tmp"
+        with open(temporary_path, "w") as file:
+            json.dump(schedules, file)
+        os.replace(temporary_path, self._path)
+
+    def _add(self, chat_id: int, schedule: Schedule, next_at: float):
+        self._schedules[chat_id] = schedule
+        self._next[chat_id] = next_at
+        heapq.heappush(self._due, (next_at, chat_id))
+
+    def get(self, chat_id: int) -> Schedule | None:
+        return self._schedules.get(chat_id)
+
+    def set(self, chat_id: int, schedule: Schedule):
+        self._add(chat_id, schedule, next_reset(schedule, time.time()))
+        self.save()
+
+    def remove(self, chat_id: int) -> bool:
+        if self._schedules.pop(chat_id, None) is None:
+            return False
+        del self._next[chat_id]
+        self.save()
+        return True
+
+    # Chats whose reset is due, each is due again after its next reset
+    def pop_due(self, now: float) -> list[int]:
+        chat_ids = []
+        while self._due and self._due[0][0] <= now:
+            next_at, chat_id = heapq.heappop(self._due)
+            if self._next.get(chat_id) != next_at:
+                continue
+            chat_ids.append(chat_id)
+            self._add(
+                chat_id,
+                self._schedules[chat_id],
+                next_reset(self._schedules[chat_id], now),
+            )
+        return chat_ids
+
+
+store = ScheduleStore()
+
+
+# Runs func for every chat, at most `concurrency` at a time. A chat that
+# fails is logged and doesn't stop the others
+async def run_batch(
+    chat_ids: list[int], func: Callable[[int], Awaitable], concurrency: int
+):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(chat_id: int):
+        async with semaphore:
+            try:
+                await func(chat_id)
+            except Exception as e:
+                logger.error(f"Scheduled reset failed in chat {chat_id}: {e}")
+
+    await asyncio.gather(*(run(chat_id) for chat_id in chat_ids))
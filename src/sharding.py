@@ -0,0 +1,272 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import queue
+import signal
+import threading
+import time
+from typing import Callable
+from telegram import Bot, Update
+from telegram.ext import Application
+
+logger = logging.getLogger(__name__)
+
+# Seconds between checks that every worker process is alive
+SUPERVISE_INTERVAL = 1.0
+# Seconds a stopping worker gets to write its pending state
+STOP_TIMEOUT = 30.0
+
+# Keys of updates whose object has a "chat", in the order PTB checks them
+_CHAT_KEYS = (
+    "message",
+    "edited_message",
+    "channel_post",
+    "edited_channel_post",
+    "business_message",
+    "edited_business_message",
+    "my_chat_member",
+    "chat_member",
+    "chat_join_request",
+    "message_reaction",
+    "message_reaction_count",
+    "chat_boost",
+    "removed_chat_boost",
+)
+
+
+# Chat of a raw webhook update, or the sender for updates without a chat
+# (inline queries and such), 0 if there is neither
+def update_chat_id(update: dict) -> int:
+    for key in _CHAT_KEYS:
+        obj = update.get(key)
+        if obj is not None:
+            return obj["chat"]["id"]
+    callback_query = update.get("callback_query")
+    if callback_query is not None and "message" in callback_query:
+        return callback_query["message"]["chat"]["id"]
+    for obj in update.values():
+        if isinstance(obj, dict) and "from" in obj:
+            return obj["from"]["id"]
+    return 0
+
+
+# Updates of one chat always go to the same worker, which keeps them in order
+# and keeps the chat's state in that worker's cache
+def shard_for(chat_id: int, workers: int) -> int:
+    return chat_id % workers
+
+
+# Runs in a worker process: handles raw updates read from its pipe until it
+# gets an empty message. A new update is read only when one of the app's
+# concurrent update slots is free, so a slow worker fills its pipe and then
+# its queue in the receiver instead of buffering updates in memory
+def _worker_main(index: int, app_factory: Callable[[int], Application], conn):
+    # The receiver handles Ctrl+C and stops the workers through their pipes
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_run_worker(index, app_factory(index), conn))
+
+
+async def _run_worker(index: int, app: Application, conn) -> None:
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(app.update_processor.max_concurrent_updates)
+    tasks = set()
+
+    async def handle(update: Update):
+        try:
+            await app.process_update(update)
+        finally:
+            slots.release()
+
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await app.start()
+    logger.info(f"Worker {index} started")
+    try:
+        while True:
+            await slots.acquire()
+            try:
+                raw = await loop.run_in_executor(None, conn.recv_bytes)
+            except EOFError:
+                break
+            if not raw:
+                break
+            try:
+                update = Update.de_json(json.loads(raw), app.bot)
+            except Exception as e:
+                logger.error(f"Worker {index} dropped a malformed update: {e}")
+                slots.release()
+                continue
+            task = asyncio.create_task(handle(update))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        await app.stop()
+        if app.post_stop:
+            await app.post_stop(app)
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+        logger.info(f"Worker {index} stopped")
+
+
+# One worker process, the bounded queue of updates routed to it and the
+# thread writing them into the worker's pipe. Every worker has its own pipe,
+# so a worker that is killed can't leave a lock behind for its replacement
+class _Shard:
+    def __init__(self, index: int, context, app_factory, queue_size: int):
+        self.index = index
+        self.context = context
+        self.app_factory = app_factory
+        self.queue = queue.Queue(queue_size)
+        self.process = None
+        self.conn = None
+        self.feeder = threading.Thread(
+            target=self._feed, name=f"webhook-feeder-{index}", daemon=True
+        )
+
+    def start(self):
+        reader, writer = self.context.Pipe(duplex=False)
+        process = self.context.Process(
+            target=_worker_main,
+            args=(self.index, self.app_factory, reader),
+            name=f"webhook-worker-{self.index}",
+            daemon=True,
+        )
+        process.start()
+        # Only the worker keeps the reading end, so writes to a dead worker fail
+        reader.close()
+        self.process, self.conn = process, writer
+        if not self.feeder.is_alive():
+            self.feeder.start()
+
+    # An update whose worker died while it was written is written again to the
+    # restarted worker
+    def _feed(self):
+        while True:
+            body = self.queue.get()
+            while True:
+                try:
+                    self.conn.send_bytes(body or b"")
+                    break
+                except OSError:
+                    time.sleep(SUPERVISE_INTERVAL)
+            if body is None:
+                return
+
+    # Sent after the updates already queued
+    def request_stop(self):
+        self.queue.put(None)
+
+    def join(self):
+        self.feeder.join(STOP_TIMEOUT)
+        self.process.join(STOP_TIMEOUT)
+        if self.process.is_alive():
+            logger.error(f"Worker {self.index} did not stop in time, terminating")
+            self.process.terminate()
+
+
+# Front receiver of the webhook. It accepts Telegram's POSTs and puts each
+# update into the bounded queue of the worker owning its chat. A full queue
+# is answered with 503, so Telegram retries the update later instead of the
+# receiver buffering without bound. Dead workers are restarted and get the
+# updates still waiting in their queue
+class ShardedWebhook:
+    def __init__(
+        self,
+        app_factory: Callable[[int], Application],
+        workers: int,
+        queue_size: int,
+    ):
+        context = multiprocessing.get_context("spawn")
+        self.shards = [
+            _Shard(index, context, app_factory, queue_size) for index in range(workers)
+        ]
+
+    # Index of the worker that took the update, None if its queue is full
+    def route(self, body: bytes) -> int | None:
+        index = shard_for(update_chat_id(json.loads(body)), len(self.shards))
+        try:
+            self.shards[index].queue.put_nowait(body)
+        except queue.Full:
+            return None
+        return index
+
+    def start_workers(self):
+        for shard in self.shards:
+            shard.start()
+
+    def restart_dead_workers(self):
+        for shard in self.shards:
+            if not shard.process.is_alive():
+                logger.error(
+                    f"Worker {shard.index} exited with code "
+                    f"{shard.process.exitcode}, restarting"
+                )
+                shard.start()
+
+    def stop_workers(self):
+        for shard in self.shards:
+            shard.request_stop()
+        for shard in self.shards:
+            shard.join()
+
+    async def _supervise(self):
+        while True:
+            await asyncio.sleep(SUPERVISE_INTERVAL)
+            self.restart_dead_workers()
+
+    async def serve(
+        self,
+        token: str,
+        webhook_url: str,
+        listen: str,
+        port: int,
+        secret_token: str | None = None,
+    ):
+        import tornado.web
+
+        receiver = self
+
+        class WebhookHandler(tornado.web.RequestHandler):
+            def post(self):
+                header = self.request.headers.get("X-Telegram-Bot-Api-Secret-Token")
+                if secret_token and header != secret_token:
+                    self.set_status(403)
+                    return
+                try:
+                    index = receiver.route(self.request.body)
+                except (ValueError, KeyError, TypeError) as e:
+                    logger.warning(f"Rejected a malformed update: {e}")
+                    self.set_status(400)
+                    return
+                if index is None:
+                    logger.warning("Worker queue is full, asking Telegram to retry")
+                    self.set_status(503)
+
+        self.start_workers()
+        stopped = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stopped.set)
+        server = tornado.web.Application([(r"/.*", WebhookHandler)]).listen(
+            port, listen
+        )
+        supervisor = asyncio.create_task(self._supervise())
+        try:
+            async with Bot(token) as bot:
+                await bot.set_webhook(
+                    webhook_url,
+                    allowed_updates=Update.ALL_TYPES,
+                    secret_token=secret_token,
+                )
+            logger.info(
+                f"Webhook is set, routing updates to {len(self.shards)} workers"
+            )
+            await stopped.wait()
+        finally:
+            supervisor.cancel()
+            server.stop()
+            await loop.run_in_executor(None, self.stop_workers)
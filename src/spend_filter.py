@@ -0,0 +1,64 @@
+import re
+from decimal import Decimal
+from telegram import Message
+from telegram.ext import filters
+from budget import is_amount
+
+# One spend item: "<amount> <type> [comment]". The amount is anything
+# Decimal() reads except NaN, Infinity and exponents of more than two digits,
+# "1e999999 food" isn't a spend. The type is the next word
+_ITEM = re.compile(
+    r"\s*([+-]?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][+-]?\d{1,2})?)\s+(\S+)(?:\s.*)?"
+)
+
+
+def _parse_line(line: str) -> list[tuple[Decimal, str]] | None:
+    pieces = line.split(",")
+    if len(pieces) > 1:
+        matches = [_ITEM.fullmatch(piece) for piece in pieces]
+        if all(matches):
+            return [(Decimal(m[1]), m[2]) for m in matches]
+    # A line whose comma-separated pieces aren't all items is one item with
+    # a comment
+    match = _ITEM.fullmatch(line)
+    if match is None:
+        return None
+    return [(Decimal(match[1]), match[2])]
+
+
+# Parses "<amount> <type> [comment]" items, one per line or comma-separated.
+# Returns None unless every non-empty line is made of items whose amounts
+# have at most MAX_AMOUNT_DIGITS digits before the point
+def parse_spend_items(text: str) -> list[tuple[Decimal, str]] | None:
+    items = []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        line_items = _parse_line(line)
+        if line_items is None:
+            return None
+        items.extend(line_items)
+    if not all(is_amount(amount) for amount, _ in items):
+        return None
+    return items or None
+
+
+# Data filter passing only messages that are spends, with the parsed items
+# in context.spend_items. Other messages of a group are rejected before a
+# handler task is created for them
+class SpendFilter(filters.MessageFilter):
+    __slots__ = ()
+
+    def __init__(self):
+        super().__init__(name="SpendFilter", data_filter=True)
+
+    def filter(self, message: Message) -> dict[str, list] | None:
+        if not message.text:
+            return None
+        items = parse_spend_items(message.text)
+        if items is None:
+            return None
+        return {"spend_items": items}
+
+
+SPEND = SpendFilter()
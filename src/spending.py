@@ -0,0 +1,392 @@
+import heapq
+import json
+import logging
+import os
+from array import array
+from calendar import monthrange
+from datetime import datetime, timedelta
+from typing import TYPE_CHECKING, Callable, NamedTuple
+from zoneinfo import ZoneInfo
+import ledger
+from cache import ChatCache
+from data_dir import data_path
+from ledger import Event
+
+if TYPE_CHECKING:
+    import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Directory keeping the spending history of every chat, "" turns it off
+SPENDING_PATH = os.getenv("SPENDING_PATH", data_path("spending"))
+# How many chats keep their history in memory, and for how many seconds
+SPENDING_CACHE_SIZE = int(os.getenv("SPENDING_CACHE_SIZE", "256"))
+SPENDING_CACHE_TTL = float(os.getenv("SPENDING_CACHE_TTL", "3600"))
+
+WEEK = "week"
+MONTH = "month"
+PERIODS = (WEEK, MONTH)
+
+# Columns of SpendColumns, also the suffixes of their files
+_COLUMNS = ("ts", "category", "amount")
+
+
+# Spends of one chat as columns, one row per spend in the order they were
+# made. Categories are kept as indexes into names. Amounts are floats: the
+# balances stay exact in the chat data, reports only sum them up. Until a
+# report needs them the columns stay on disk and only the names are loaded
+class SpendColumns:
+    __slots__ = ("ts", "category", "amount", "names", "_ids", "loaded")
+
+    def __init__(self):
+        self.ts = array("d")
+        self.category = array("I")
+        self.amount = array("d")
+        self.names: list[str] = []
+        self._ids: dict[str, int] = {}
+        self.loaded = False
+
+    def __len__(self) -> int:
+        return len(self.ts)
+
+    def _add_name(self, name: str) -> int:
+        self._ids[name] = len(self.names)
+        self.names.append(name)
+        return self._ids[name]
+
+    # Appends the rows and returns the category names seen for the first time
+    def append(self, rows: list[tuple[float, str, float]]) -> list[str]:
+        new_names = []
+        for ts, name, amount in rows:
+            category = self._ids.get(name)
+            if category is None:
+                category = self._add_name(name)
+                new_names.append(name)
+            self.ts.append(ts)
+            self.category.append(category)
+            self.amount.append(amount)
+        return new_names
+
+    # numpy views of the columns without copying them. They must be dropped
+    # before the next append, an array can't grow while it is viewed
+    def views(self) -> tuple["np.ndarray", "np.ndarray", "np.ndarray"]:
+        import numpy as np
+
+        return (
+            np.frombuffer(self.ts, dtype=np.float64),
+            np.frombuffer(self.category, dtype=np.uint32),
+            np.frombuffer(self.amount, dtype=np.float64),
+        )
+
+
+# Append-only spending history, every column of a chat in its own file that
+# only ever grows by the bytes of new rows, and the category names one JSON
+# string per line. Histories of recently used chats are kept in memory
+class SpendingStore:
+    def __init__(self, cache_size: int, cache_ttl: float):
+        self._path = None
+        self._columns = ChatCache(cache_size, cache_ttl)
+
+    @property
+    def enabled(self) -> bool:
+        return self._path is not None
+
+    def open(self, path: str):
+        if not path:
+            return
+        os.makedirs(path, exist_ok=True)
+        self._path = path
+        logger.info(f"Keeping spending history in {path}")
+
+    def _file(self, chat_id: int, suffix: str) -> str:
+        return os.path.join(self._path, f"{chat_id}.{suffix}")
+
+    def _size(self, chat_id: int, suffix: str) -> int:
+        try:
+            return os.path.getsize(self._file(chat_id, suffix))
+        except FileNotFoundError:
+            return 0
+
+    # Cuts the columns and their files to the rows, so new rows line up in
+    # every column
+    def _cut(self, chat_id: int, columns: SpendColumns, rows: int):
+        for suffix in _COLUMNS:
+            column = getattr(columns, suffix)
+            del column[rows:]
+            path = self._file(chat_id, suffix)
+            size = rows * column.itemsize
+            if os.path.exists(path) and os.path.getsize(path) != size:
+                os.truncate(path, size)
+
+    # Category names of the chat's history, which is all an append needs.
+    # The column files are cut to the rows they all have first
+    def _open(self, chat_id: int) -> SpendColumns:
+        entry = self._columns.get(chat_id)
+        if entry is not None:
+            return entry.value
+        columns = SpendColumns()
+        names_path = self._file(chat_id, "names")
+        if os.path.exists(names_path):
+            with open(names_path) as file:
+                lines = file.read().split("\n")
+            # The last line is empty, or was cut short by a crash
+            for line in lines[:-1]:
+                columns._add_name(json.loads(line))
+            if lines[-1]:
+                with open(names_path, "w") as file:
+                    file.writelines(json.dumps(name) + "\n" for name in columns.names)
+        # A crash between the writes of a row leaves some columns longer
+        rows = min(
+            self._size(chat_id, suffix) // getattr(columns, suffix).itemsize
+            for suffix in _COLUMNS
+        )
+        self._cut(chat_id, columns, rows)
+        if rows:
+            # or has rows whose category name was lost, the last ones
+            with open(self._file(chat_id, "category"), "rb") as file:
+                file.seek((rows - 1) * columns.category.itemsize)
+                last = array("I", file.read(columns.category.itemsize))[0]
+            if last >= len(columns.names):
+                self._fill(chat_id, columns)
+        else:
+            columns.loaded = True
+        self._columns.put(chat_id, columns)
+        return columns
+
+    # Reads the columns of the history, cut to the rows with a name
+    def _fill(self, chat_id: int, columns: SpendColumns):
+        import numpy as np
+
+        for suffix in _COLUMNS:
+            column = getattr(columns, suffix)
+            with open(self._file(chat_id, suffix), "rb") as file:
+                column.frombytes(file.read())
+        unnamed = np.frombuffer(columns.category, dtype=np.uint32) >= len(columns.names)
+        if unnamed.any():
+            self._cut(chat_id, columns, int(np.argmax(unnamed)))
+        columns.loaded = True
+
+    # History of the chat with its columns
+    def _load(self, chat_id: int) -> SpendColumns:
+        columns = self._open(chat_id)
+        if not columns.loaded:
+            try:
+                self._fill(chat_id, columns)
+            except Exception:
+                self._columns.invalidate(chat_id)
+                raise
+        return columns
+
+    def _write(self, chat_id: int, columns: SpendColumns, first: int, new_names):
+        # Names first, so every written row has the name of its category
+        if new_names:
+            with open(self._file(chat_id, "names"), "a") as file:
+                file.writelines(json.dumps(name) + "\n" for name in new_names)
+        for suffix in _COLUMNS:
+            with open(self._file(chat_id, suffix), "ab") as file:
+                file.write(getattr(columns, suffix)[first:].tobytes())
+
+    # Records the spend events of a change. A failed write is logged, the
+    # balances have already changed
+    def record(self, chat_id: int, events: list[Event]):
+        if self._path is None:
+            return
+        rows = [
+            (event.ts, event.type, float(event.amount))
+            for event in events
+            if event.op == ledger.SPEND
+        ]
+        if not rows:
+            return
+        try:
+            self.append(chat_id, rows)
+        except OSError as e:
+            logger.error(f"Failed to record spending of chat {chat_id}: {e}")
+
+    # Appends (ts, category, amount) rows to the history of the chat
+    def append(self, chat_id: int, rows: list[tuple[float, str, float]]):
+        if self._path is None:
+            return
+        try:
+            columns = self._open(chat_id)
+            first = len(columns)
+            new_names = columns.append(rows)
+            self._write(chat_id, columns, first, new_names)
+            if not columns.loaded:
+                # Written, the columns stay on disk until a report loads them
+                for suffix in _COLUMNS:
+                    del getattr(columns, suffix)[:]
+        except OSError:
+            self._columns.invalidate(chat_id)
+            raise
+
+    # Chats with the latest spends first, at most `count` of those `keep`
+    # accepts, told by when their history was last written
+    def recent_chats(
+        self, count: int, keep: Callable[[int], bool] = lambda chat_id: True
+    ) -> list[int]:
+        if self._path is None or count <= 0:
+            return []
+        written = []
+        with os.scandir(self._path) as entries:
+            for entry in entries:
+                name, _, suffix = entry.name.partition(".")
+                try:
+                    chat_id = int(name)
+                    if suffix == "ts" and keep(chat_id):
+                        written.append((entry.stat().st_mtime, chat_id))
+                except (ValueError, OSError):
+                    continue
+        return [chat_id for _, chat_id in heapq.nlargest(count, written)]
+
+    # Deletes the history of the chat
+    def clear(self, chat_id: int):
+        if self._path is None:
+            return
+        self._columns.invalidate(chat_id)
+        for suffix in ("names", *_COLUMNS):
+            try:
+                os.remove(self._file(chat_id, suffix))
+            except FileNotFoundError:
+                pass
+
+    # History of the chat, None if no history is kept
+    def get(self, chat_id: int) -> SpendColumns | None:
+        if self._path is None:
+            return None
+        return self._load(chat_id)
+
+
+store = SpendingStore(SPENDING_CACHE_SIZE, SPENDING_CACHE_TTL)
+
+
+# Imports numpy, which reports and the first load of a history need and
+# which takes a while, ahead of them
+def preload():
+    import numpy  # noqa: F401
+
+
+# Start of the week or month holding the timestamp, and of the ones after it
+def period_start(period: str, ts: float, timezone: str, shift: int = 0) -> float:
+    now = datetime.fromtimestamp(ts, ZoneInfo(timezone))
+    midnight = datetime(now.year, now.month, now.day, tzinfo=now.tzinfo)
+    if period == WEEK:
+        return (midnight + timedelta(days=7 * shift - now.weekday())).timestamp()
+    months = now.year * 12 + now.month - 1 + shift
+    return datetime(months // 12, months % 12 + 1, 1, tzinfo=now.tzinfo).timestamp()
+
+
+def period_days(period: str, start: float, timezone: str) -> int:
+    if period == WEEK:
+        return 7
+    day = datetime.fromtimestamp(start, ZoneInfo(timezone))
+    return monthrange(day.year, day.month)[1]
+
+
+class CategoryTotals(NamedTuple):
+    names: list[str]
+    # Spent per category, in the order of names
+    spent: "np.ndarray"
+    count: int
+
+
+# Spent per category between the timestamps, summed over the columns at once
+def category_totals(columns: SpendColumns, start: float, end: float) -> CategoryTotals:
+    import numpy as np
+
+    ts, category, amount = columns.views()
+    selected = (ts >= start) & (ts < end)
+    spent = np.bincount(
+        category[selected], weights=amount[selected], minlength=len(columns.names)
+    )
+    return CategoryTotals(columns.names, spent, int(np.count_nonzero(selected)))
+
+
+# Spent in each of the periods between consecutive boundaries
+def period_totals(columns: SpendColumns, boundaries: list[float]) -> "np.ndarray":
+    import numpy as np
+
+    ts, _, amount = columns.views()
+    edges = np.asarray(boundaries, dtype=np.float64)
+    index = np.searchsorted(edges, ts, side="right") - 1
+    selected = (index >= 0) & (index < len(edges) - 1)
+    return np.bincount(
+        index[selected], weights=amount[selected], minlength=len(edges) - 1
+    )
+
+
+def _show(value: float) -> str:
+    text = f"{value:.2f}".rstrip("0").rstrip(".")
+    return "0" if text == "-0" else text
+
+
+# Spent per category in the current week or month against the limits, and
+# the daily burn rate against what the limits allow per day
+def category_report(
+    columns: SpendColumns,
+    period: str,
+    now: float,
+    timezone: str,
+    limits: dict[str, float],
+) -> str:
+    start = period_start(period, now, timezone)
+    end = period_start(period, now, timezone, 1)
+    totals = category_totals(columns, start, end)
+    spent = dict(zip(totals.names, totals.spent.tolist()))
+    lines = [f"Spending this {period}, {totals.count} spends:"]
+    for name, limit in limits.items():
+        lines.append(f"{name}: {_show(spent.pop(name, 0.0))} / {_show(limit)}")
+    # Categories deleted since
+    lines += [f"{name}: {_show(value)}" for name, value in spent.items() if value]
+    total = float(totals.spent.sum())
+    limit = sum(limits.values())
+    days = period_days(period, start, timezone)
+    elapsed_days = max((now - start) / 86400, 1.0)
+    rate = total / elapsed_days
+    lines.append(f"\nSpent: {_show(total)} / {_show(limit)}")
+    lines.append(
+        f"Burn rate: {_show(rate)} per day, limits allow {_show(limit / days)} per day."
+    )
+    lines.append(f"At this rate: {_show(rate * days)} by the end of the {period}.")
+    return "\n".join(lines)
+
+
+# Categories with the most spent in the current week or month, with their
+# share of the total unless refunds took the total to zero or below
+def top_report(
+    columns: SpendColumns, period: str, now: float, timezone: str, count: int
+) -> str:
+    start = period_start(period, now, timezone)
+    end = period_start(period, now, timezone, 1)
+    totals = category_totals(columns, start, end)
+    total = float(totals.spent.sum())
+    order = (-totals.spent).argsort(kind="stable")[:count]
+    lines = [f"Top categories this {period}:"]
+    for index in order.tolist():
+        value = float(totals.spent[index])
+        if value <= 0:
+            break
+        line = f"{totals.names[index]}: {_show(value)}"
+        if total > 0:
+            line += f" ({value / total:.0%})"
+        lines.append(line)
+    if len(lines) == 1:
+        return f"Nothing spent this {period}."
+    return "\n".join(lines)
+
+
+# Spent in each of the last `count` weeks or months, the current one last
+def period_report(
+    columns: SpendColumns, period: str, now: float, timezone: str, count: int
+) -> str:
+    boundaries = [
+        period_start(period, now, timezone, shift) for shift in range(1 - count, 2)
+    ]
+    totals = period_totals(columns, boundaries).tolist()
+    label = "%Y-%m-%d" if period == WEEK else "%Y-%m"
+    zone = ZoneInfo(timezone)
+    lines = [f"Spending by {period}:"]
+    for start, value in zip(boundaries, totals):
+        lines.append(f"{datetime.fromtimestamp(start, zone):{label}}: {_show(value)}")
+    lines.append(f"\nAverage: {_show(sum(totals) / count)}")
+    return "\n".join(lines)
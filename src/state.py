@@ -1,112 +1,384 @@
-import json
+import asyncio
+import functools
 import logging
+import os
+from typing import Iterable
 from telegram.ext import ContextTypes
-from telegram.constants import ParseMode
 from decimal import Decimal
+from budget import Category, Group
+from cache import ChatCache
+from category_index import Resolution
+from chat_locks import chat_lock
+from chat_state import ChatState
+import budget
+import dedupe
+import fixed_point
+import ledger
+import metrics
+import spending
+from ledger import Event
+from data_dir import data_path
+from codec import dumps_data, loads_data, normalize_data_to_decimals
+from fixed_point import FixedPointData
+from outbox import Outbox
+from storage import PinnedMessageStorage, SqliteStorage, Storage, is_outage
+from write_behind import CircuitBreaker, WriteBehind
 
 logger = logging.getLogger(__name__)
 
+STATE_CACHE_SIZE = int(os.getenv("STATE_CACHE_SIZE", "1024"))
+STATE_CACHE_TTL = float(os.getenv("STATE_CACHE_TTL", "3600"))
+# With a positive delay pinned message edits are coalesced per chat
+STATE_WRITE_DELAY = float(os.getenv("STATE_WRITE_DELAY", "0"))
+STATE_WRITE_MAX_DELAY = float(os.getenv("STATE_WRITE_MAX_DELAY", "10"))
+# "pinned" keeps balances only in the pinned message, "sqlite" keeps them in a
+# local database and the pinned message becomes an optional mirror
+STATE_STORAGE = os.getenv("STATE_STORAGE", "pinned")
+STATE_SQLITE_PATH = os.getenv("STATE_SQLITE_PATH", data_path("money-counter.db"))
+STATE_PINNED_MIRROR = os.getenv("STATE_PINNED_MIRROR", "1") == "1"
+STATE_SNAPSHOT_EVERY = int(os.getenv("STATE_SNAPSHOT_EVERY", "100"))
+# Keep amounts as integers with STATE_FIXED_POINT_SCALE or more digits after
+# the point instead of Decimals
+STATE_FIXED_POINT = os.getenv("STATE_FIXED_POINT", "0") == "1"
+STATE_FIXED_POINT_SCALE = int(os.getenv("STATE_FIXED_POINT_SCALE", "2"))
+# Pinned message writes failed during a Telegram outage are retried after
+# STATE_RETRY_DELAY seconds, doubled after every failure up to
+# STATE_RETRY_MAX_DELAY, and kept in STATE_OUTBOX_PATH until they succeed
+STATE_OUTBOX_PATH = os.getenv("STATE_OUTBOX_PATH", data_path("state-outbox.jsonl"))
+STATE_RETRY_DELAY = float(os.getenv("STATE_RETRY_DELAY", "1"))
+STATE_RETRY_MAX_DELAY = float(os.getenv("STATE_RETRY_MAX_DELAY", "60"))
+# After this many failed writes in a row changes stop waiting for Telegram,
+# and a single write is tried every STATE_BREAKER_COOLDOWN seconds
+STATE_BREAKER_THRESHOLD = int(os.getenv("STATE_BREAKER_THRESHOLD", "5"))
+STATE_BREAKER_COOLDOWN = float(os.getenv("STATE_BREAKER_COOLDOWN", "30"))
+# How an amount spent from a group is split between its categories: "first"
+# takes it from them in their order, "most_left" from the ones with the most
+# left first. Each gives at most what is left of it and the last one the rest
+GROUP_SPEND_RULE = os.getenv("GROUP_SPEND_RULE", "first")
+if GROUP_SPEND_RULE not in ("first", "most_left"):
+    raise ValueError(f"Unknown GROUP_SPEND_RULE: {GROUP_SPEND_RULE}")
 
-def _to_decimal(value):
-    if isinstance(value, Decimal):
-        return value
-    if isinstance(value, (int, float)):
-        return Decimal(str(value))
-    if isinstance(value, str):
-        return Decimal(value)
+_pinned = PinnedMessageStorage(STATE_CACHE_SIZE, STATE_CACHE_TTL)
+if STATE_STORAGE == "sqlite":
+    _storage: Storage = SqliteStorage(STATE_SQLITE_PATH, STATE_SNAPSHOT_EVERY)
+    _mirror = _pinned if STATE_PINNED_MIRROR else None
+elif STATE_STORAGE == "pinned":
+    _storage = _pinned
+    _mirror = None
+else:
+    raise ValueError(f"Unknown STATE_STORAGE: {STATE_STORAGE}")
+
+# ChatState of parsed chat data, kept in sync on every write
+_cache = ChatCache(STATE_CACHE_SIZE, STATE_CACHE_TTL)
+# Pinned message writes of all chats, open while Telegram is down
+_breaker = CircuitBreaker(STATE_BREAKER_THRESHOLD, STATE_BREAKER_COOLDOWN)
+# Pinned message edits waiting for their debounce window or for a retry
+_writes = WriteBehind(
+    STATE_WRITE_DELAY,
+    STATE_WRITE_MAX_DELAY,
+    is_outage,
+    STATE_RETRY_DELAY,
+    STATE_RETRY_MAX_DELAY,
+    _breaker,
+)
+# Pending pinned message writes, kept on disk across restarts
+_outbox = Outbox()
+
+
+# Decorator that runs a state mutator under the per-chat lock, so concurrent
+# updates of one chat don't overwrite each other's read-modify-write. The
+# cached state of a failed mutator may be half changed and is loaded again,
+# and the update asking for the change isn't marked handled
+def _serialized(func):
+    @functools.wraps(func)
+    async def wrapper(context: ContextTypes.DEFAULT_TYPE, chat_id: int, *args):
+        async with chat_lock(chat_id):
+            try:
+                return await func(context, chat_id, *args)
+            except Exception:
+                _cache.invalidate(chat_id)
+                dedupe.report_failure()
+                raise
+
+    return wrapper
+
+
+# Function to drop cached data for one chat or for all chats
+def invalidate_cache(chat_id: int | None = None):
+    logger.debug(f"Invalidating state cache for chat_id: {chat_id}")
+    _cache.invalidate(chat_id)
+
+
+# Function to bring data to the representation STATE_FIXED_POINT asks for
+def _representation(data: object) -> object:
+    if STATE_FIXED_POINT:
+        return fixed_point.to_fixed_point(data, STATE_FIXED_POINT_SCALE)
+    return fixed_point.to_decimals(data)
+
+
+# Function to show an amount of chat data as a Decimal
+def _amount(data: object, value) -> Decimal:
+    if isinstance(data, FixedPointData):
+        return data.amount(value)
     return value
 
 
-def _normalize_data_to_decimals(data: object) -> object:
-    if not isinstance(data, dict):
-        return data
-    for type_key, info in list(data.items()):
-        if isinstance(info, dict):
-            if "limit" in info:
-                info["limit"] = _to_decimal(info["limit"])
-            if "balance" in info:
-                info["balance"] = _to_decimal(info["balance"])
-    return data
+# Function to get the chat's state from the cache, falling back to the
+# storage, under the chat's lock. Returns None if the chat has no data
+async def _get_chat(
+    context: ContextTypes.DEFAULT_TYPE, chat_id: int
+) -> ChatState | None:
+    entry = _cache.get(chat_id)
+    if entry is not None:
+        metrics.cache_requests.inc("hit")
+        return entry.value
+    metrics.cache_requests.inc("miss")
+    return await _load_chat(context, chat_id)
 
 
-# Function to get data from pinned messages
-async def _get_data_from_pinned_messages(
+# Function to get the chat's state outside of the chat's lock, for reading.
+# A cold load takes the lock, so it can't replace the state a mutator has
+# just cached with data read before the mutator wrote it
+async def _read_chat(
     context: ContextTypes.DEFAULT_TYPE, chat_id: int
-) -> object:
-    logger.debug(f"Fetching pinned messages for chat_id: {chat_id}")
-    chat = await context.bot.get_chat(chat_id)
-    pinned_message = chat.pinned_message
-    if pinned_message and "Data for money-counter" in pinned_message.text:
-        logger.debug("Pinned message found with expected text.")
-        try:
-            data_json = pinned_message.text.split("\n", 1)[1]
-            data = json.loads(data_json, parse_float=Decimal, parse_int=Decimal)
-            data = _normalize_data_to_decimals(data)
-            logger.debug("Successfully parsed data from pinned message.")
-            return data
-        except (IndexError, ValueError, json.JSONDecodeError) as e:
-            logger.error(f"Error parsing pinned message: {e}")
-    else:
-        logger.debug("No relevant pinned message found.")
-    return None
+) -> ChatState | None:
+    entry = _cache.get(chat_id)
+    if entry is not None:
+        metrics.cache_requests.inc("hit")
+        return entry.value
+    async with chat_lock(chat_id):
+        return await _get_chat(context, chat_id)
 
 
-# Function to update pinned message with data
-async def _update_data_from_pinned_messages(
-    context: ContextTypes.DEFAULT_TYPE, chat_id: int, data: object
-):
-    logger.debug(f"Updating pinned message for chat_id: {chat_id}")
-    chat = await context.bot.get_chat(chat_id)
-    pinned_message = chat.pinned_message
-    message_text = f"Data for money-counter\n{json.dumps(data, default=str)}"
+# Function to load the chat's state into the cache, from a pending write or
+# from the storage. Called under the chat's lock
+async def _load_chat(
+    context: ContextTypes.DEFAULT_TYPE, chat_id: int
+) -> ChatState | None:
+    if _writes.has_pending(chat_id):
+        logger.debug(f"Using data with pending write for chat_id: {chat_id}")
+        chat = ChatState(_writes.pending_value(chat_id))
+        _cache.put(chat_id, chat)
+        return chat
+    data = await _storage.load(context.bot, chat_id)
+    if data is None and _storage is not _pinned:
+        # Chats from before the local storage still have their data pinned
+        data = await _pinned.load(context.bot, chat_id)
+        if data is not None:
+            logger.info(f"Imported pinned message data for chat_id: {chat_id}")
+            await _storage.save(context.bot, chat_id, data)
+    if data is None:
+        _cache.put(chat_id, None)
+        return None
+    chat = ChatState(_representation(data))
+    _cache.put(chat_id, chat)
+    return chat
 
-    if pinned_message and "Data for money-counter" in pinned_message.text:
-        logger.debug("Editing existing pinned message.")
+
+# Function to save the chat's data after the changes described by the events
+# and record its spends in the spending history. The pinned message is written
+# in the background when it is a mirror, when STATE_WRITE_DELAY defers the
+# edits and while Telegram is down, reads are served from memory meanwhile.
+# Deferred writes of the pinned storage go to the outbox first
+async def _update_data(
+    context: ContextTypes.DEFAULT_TYPE,
+    chat_id: int,
+    chat: ChatState,
+    events: list[Event],
+):
+    _cache.put(chat_id, chat)
+    data = chat.data
+    # A write pending for the chat must not be overtaken by this one
+    deferred = _storage is _pinned and (
+        STATE_WRITE_DELAY > 0 or not _breaker.closed or _writes.has_pending(chat_id)
+    )
+    if deferred:
+        # Data the message can't hold fails now like a direct write would,
+        # not when the user was already told it is saved
         try:
-            await context.bot.edit_message_text(
-                chat_id=chat_id,
-                message_id=pinned_message.message_id,
-                text=message_text,
-                parse_mode=ParseMode.HTML,
-            )
-            logger.info("Pinned message updated successfully.")
-        except Exception as e:
-            logger.error(f"Failed to edit pinned message: {e}")
+            _pinned.encode(chat_id, data)
+        except Exception:
+            _cache.invalidate(chat_id)
             raise
     else:
-        logger.debug("No existing pinned message found. Sending a new one.")
         try:
-            sent_message = await context.bot.send_message(
-                chat_id, message_text, parse_mode=ParseMode.HTML
+            await _storage.append(context.bot, chat_id, events, data)
+        except Exception as e:
+            if _storage is not _pinned or not is_outage(e):
+                _cache.invalidate(chat_id)
+                raise
+            _breaker.record_failure()
+            logger.warning(
+                f"Failed to write state of chat_id {chat_id}, retrying later: {e}"
             )
-            await context.bot.pin_chat_message(chat_id, sent_message.message_id)
-            logger.info("New pinned message sent and pinned successfully.")
+            deferred = True
+        else:
+            if _storage is _pinned:
+                _breaker.record_success()
+    if deferred and _outbox.enabled:
+        _outbox.add(chat_id, dumps_data(data))
+    spending.store.record(chat_id, events)
+    if not deferred and _mirror is None:
+        return
+    logger.debug(f"Deferring pinned message update for chat_id: {chat_id}")
+    # A copy, the next change of the chat is made in place and may fail. The
+    # state is then loaded again from the pending write
+    _writes.schedule(
+        chat_id,
+        budget.snapshot(data),
+        functools.partial(_flush_pending_write, context.bot, chat_id),
+    )
+
+
+async def _flush_pending_write(bot, chat_id: int, data: object):
+    async with chat_lock(chat_id):
+        try:
+            await _pinned.save(bot, chat_id, data)
         except Exception as e:
-            logger.error(f"Failed to send or pin message: {e}")
+            # Keep serving the unsaved data until the retry or the next change
+            if _storage is _pinned and not _writes.has_pending(chat_id):
+                _cache.put(chat_id, ChatState(data))
+                if not is_outage(e):
+                    _outbox.done(chat_id)
             raise
+        if _storage is _pinned and not _writes.has_pending(chat_id):
+            _outbox.done(chat_id)
+
+
+# Function to open the outbox and write the changes it kept from before a
+# restart in the background, serving them from memory meanwhile
+def open_outbox(bot, path: str | None):
+    if not path or _storage is not _pinned:
+        return
+    for chat_id, data_json in _outbox.open(path).items():
+        data = _representation(loads_data(data_json))
+        _cache.put(chat_id, ChatState(data))
+        _writes.schedule(
+            chat_id, data, functools.partial(_flush_pending_write, bot, chat_id)
+        )
+
+
+# Function to write all pending deferred updates, called on shutdown
+async def flush_pending_writes():
+    logger.info(f"Flushing {len(_writes)} pending pinned message updates.")
+    await _writes.flush()
+
+
+# Function to write pending updates and close the storage
+async def shutdown():
+    await flush_pending_writes()
+    await _storage.close()
+    _outbox.close()
+
+
+# Function to load the state of the chats into the cache ahead of their first
+# update, at most `concurrency` of them at a time. Returns how many of them
+# have data
+async def prewarm(
+    context: ContextTypes.DEFAULT_TYPE, chat_ids: list[int], concurrency: int
+) -> int:
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
+    loaded = 0
+
+    async def load(chat_id: int):
+        nonlocal loaded
+        async with semaphore, chat_lock(chat_id):
+            # An update may have loaded or changed it meanwhile
+            entry = _cache.get(chat_id)
+            if entry is not None:
+                loaded += entry.value is not None
+                return
+            try:
+                chat = await _load_chat(context, chat_id)
+            except Exception as e:
+                logger.warning(f"Failed to prewarm state of chat_id {chat_id}: {e}")
+                return
+            loaded += chat is not None
+
+    await asyncio.gather(*(load(chat_id) for chat_id in chat_ids))
+    return loaded
+
 
+# Function to find the category of the chat with the type or, failing that,
+# the group
+def _find(chat: ChatState, type: str) -> Category | Group | None:
+    info = chat.data.get(type)
+    if isinstance(info, Category):
+        return info
+    return chat.groups().get(type)
 
-# Function to get current balance from pinned message per type
+
+# Function to split an amount spent from a group between its categories by
+# GROUP_SPEND_RULE. A refund gives back what was spent, the other way round
+def _allocate(
+    chat: ChatState, group: Group, amount: Decimal
+) -> list[tuple[str, Decimal]]:
+    data = chat.data
+    refund = amount < 0
+    members = [(type, data[type]) for type in group.members]
+    if refund:
+        members.reverse()
+
+    # What a category can give, or take back
+    def room(info: Category) -> Decimal:
+        if refund:
+            return _amount(data, info.limit - info.balance)
+        return _amount(data, info.balance)
+
+    if GROUP_SPEND_RULE == "most_left":
+        members.sort(key=lambda member: room(member[1]), reverse=True)
+    rest = abs(amount)
+    parts = []
+    for i, (type, info) in enumerate(members):
+        part = rest if i == len(members) - 1 else min(rest, max(room(info), 0))
+        if part:
+            parts.append((type, -part if refund else part))
+            rest -= part
+        if not rest:
+            break
+    return parts
+
+
+# Function to spend from a category or a group of the chat. Returns the
+# events applied to it
+def _spend(chat: ChatState, type: str, target, amount: Decimal) -> list[Event]:
+    if isinstance(target, Group):
+        parts = _allocate(chat, target, amount)
+    else:
+        parts = [(type, amount)]
+    events = [
+        ledger.new_event(ledger.SPEND, part_type, part) for part_type, part in parts
+    ]
+    for event in events:
+        chat.apply(event)
+    return events
+
+
+# Function to get current balance per type, with Decimal amounts
 async def get_balance_info_by_type(
     context: ContextTypes.DEFAULT_TYPE, chat_id: int, type: str
-) -> object:
+) -> Category | None:
     logger.debug(f"Getting balance info for type '{type}' in chat_id: {chat_id}")
-    data = await _get_data_from_pinned_messages(context, chat_id)
-    if data is None:
-        logger.warning("No data found in pinned messages.")
+    chat = await _read_chat(context, chat_id)
+    if chat is None:
+        logger.warning("No data found for chat.")
         return None
-    if type not in data:
+    data = chat.data
+    info = data.get(type)
+    if not isinstance(info, Category):
         logger.warning(f"Type '{type}' not found in data.")
         return None
-    balance = data[type]
+    balance = Category(_amount(data, info.limit), _amount(data, info.balance))
     logger.info(f"Retrieved balance for type '{type}': {balance}")
     return balance
 
 
-# Function to get full info about balance from pinned message
+# Function to get full info about balance, with Decimal amounts like
+# get_balances
 async def get_balance_info(context: ContextTypes.DEFAULT_TYPE, chat_id: int) -> object:
     logger.debug(f"Getting full balance info for chat_id: {chat_id}")
-    data = await _get_data_from_pinned_messages(context, chat_id)
+    chat = await _read_chat(context, chat_id)
+    data = fixed_point.to_decimals(chat.data) if chat is not None else None
     if data:
         logger.info("Retrieved full balance info.")
     else:
@@ -114,107 +386,194 @@ async def get_balance_info(context: ContextTypes.DEFAULT_TYPE, chat_id: int) ->
     return data
 
 
+# Function to get the balance summary text, rendered again only after a
+# change. Returns None if the chat has no balances
+async def get_balance_summary(
+    context: ContextTypes.DEFAULT_TYPE, chat_id: int
+) -> str | None:
+    logger.debug(f"Getting balance summary for chat_id: {chat_id}")
+    chat = await _read_chat(context, chat_id)
+    if chat is None or not chat.data:
+        logger.warning("No balance info found.")
+        return None
+    return chat.summary()
+
+
+# Function to find the categories the types asked by a user mean, allowing
+# other case, plurals, prefixes and typos. Types are resolved to themselves
+# when they exist
+async def resolve_types(
+    context: ContextTypes.DEFAULT_TYPE, chat_id: int, types: list[str]
+) -> dict[str, Resolution]:
+    chat = await _read_chat(context, chat_id)
+    if chat is None:
+        return {type: Resolution(None, []) for type in types}
+    resolutions = {}
+    for type in types:
+        if _find(chat, type) is not None:
+            resolutions[type] = Resolution(type, [])
+        else:
+            resolutions[type] = chat.categories().resolve(type)
+            logger.debug(f"Resolved type '{type}': {resolutions[type]}")
+    return resolutions
+
+
 # Function to upsert balance type info with some limit
+@_serialized
 async def upsert_balance_type(
     context: ContextTypes.DEFAULT_TYPE, chat_id: int, type: str, limit: Decimal
 ):
     logger.debug(
         f"Upserting balance type '{type}' with limit {limit} in chat_id: {chat_id}"
     )
-    data = await _get_data_from_pinned_messages(context, chat_id)
-    if data is None:
-        data = {}
+    chat = await _get_chat(context, chat_id)
+    if chat is None:
+        chat = ChatState(_representation({}))
         logger.debug("No existing data. Initializing new data dictionary.")
-    if type in data and data[type]["limit"] == limit and data[type]["balance"] == limit:
+    data = chat.data
+    info = data.get(type)
+    if isinstance(info, Category) and (
+        _amount(data, info.limit) == _amount(data, info.balance) == limit
+    ):
         logger.info(f"Balance wasn't updated with '{type}': no changes.")
         return
-    data[type] = {"limit": limit, "balance": limit}
-    await _update_data_from_pinned_messages(context, chat_id, data)
+    event = ledger.new_event(ledger.UPSERT, type, limit)
+    chat.apply(event)
+    await _update_data(context, chat_id, chat, [event])
     logger.info(f"Balance type '{type}' upserted with limit {limit}.")
 
 
 # Function to change limit for type. Returns True if limit was changed, False otherwise
+@_serialized
 async def change_limit_for_type(
     context: ContextTypes.DEFAULT_TYPE, chat_id: int, type: str, limit: Decimal
 ) -> bool:
     logger.debug(f"Changing limit for type '{type}' to {limit} in chat_id: {chat_id}")
-    data = await _get_data_from_pinned_messages(context, chat_id)
-    if data is None:
+    chat = await _get_chat(context, chat_id)
+    if chat is None:
         logger.warning("No data found to change limit.")
         return False
-    if type not in data:
+    if not isinstance(chat.data.get(type), Category):
         logger.warning(f"Type '{type}' not found in data.")
         return False
-    data[type]["balance"] = data[type]["balance"] - (limit - data[type]["limit"])
-    data[type]["limit"] = limit
-    await _update_data_from_pinned_messages(context, chat_id, data)
+    event = ledger.new_event(ledger.LIMIT, type, limit)
+    chat.apply(event)
+    await _update_data(context, chat_id, chat, [event])
     logger.info(f"Limit for type '{type}' changed to {limit}.")
     return True
 
 
-# Function to change balance for type. Returns new balance if changed, None otherwise
+# Function to change balance for type, a category or a group of them.
+# Returns the new balance and the "Left: <balance> / <limit>" footer of all
+# categories, None if the type wasn't found
+@_serialized
 async def spend_balance_for_type(
     context: ContextTypes.DEFAULT_TYPE, chat_id: int, type: str, spent_balance: Decimal
-) -> object:
-    logger.debug(f"Spending {spent_balance} from type '{type}' in chat_id: {chat_id}")
-    data = await _get_data_from_pinned_messages(context, chat_id)
-    if data is None:
+) -> tuple[Decimal, str] | None:
+    logger.debug(
+        "Spending %s from type '%s' in chat_id: %s", spent_balance, type, chat_id
+    )
+    chat = await _get_chat(context, chat_id)
+    if chat is None:
         logger.warning("No data found to spend balance.")
         return None
-    if type not in data:
+    data = chat.data
+    target = _find(chat, type)
+    if target is None:
         logger.warning(f"Type '{type}' not found in data.")
         return None
     if spent_balance == 0:
         logger.info(f"Balance '{type}' didn't change")
-        return data[type]["balance"] - spent_balance
+        return _amount(data, target.balance), chat.footer()
+
+    events = _spend(chat, type, target, spent_balance)
+    new_balance = _amount(data, target.balance)
+    await _update_data(context, chat_id, chat, events)
+    logger.info("New balance for type '%s': %s", type, new_balance)
+    return new_balance, chat.footer()
+
 
-    new_balance = data[type]["balance"] - spent_balance
-    data[type]["balance"] = new_balance
-    await _update_data_from_pinned_messages(context, chat_id, data)
-    logger.info(f"New balance for type '{type}': {new_balance}")
-    return new_balance
+# Function to spend several amounts at once, from categories or groups:
+# either all of them are applied with a single write or none. Returns new
+# balances in the order of items and the footer of all categories, None if
+# there is no data or some type wasn't found
+@_serialized
+async def spend_balance_for_types(
+    context: ContextTypes.DEFAULT_TYPE,
+    chat_id: int,
+    items: list[tuple[str, Decimal]],
+) -> tuple[list, str] | None:
+    logger.debug("Spending %s items in chat_id: %s", len(items), chat_id)
+    chat = await _get_chat(context, chat_id)
+    if chat is None:
+        logger.warning("No data found to spend balance.")
+        return None
+    data = chat.data
+    targets = [_find(chat, type) for type, _ in items]
+    missing = [type for (type, _), target in zip(items, targets) if target is None]
+    if missing:
+        logger.warning(f"Types {missing} not found in data.")
+        return None
+    # All of them are checked before any is applied
+    for _, spent_balance in items:
+        ledger.check_amount(data, spent_balance)
+    events = []
+    new_balances = []
+    for (type, spent_balance), target in zip(items, targets):
+        if spent_balance != 0:
+            events.extend(_spend(chat, type, target, spent_balance))
+        new_balances.append(_amount(data, target.balance))
+    if events:
+        await _update_data(context, chat_id, chat, events)
+    logger.info("Spent %s items in chat_id: %s", len(events), chat_id)
+    return new_balances, chat.footer()
 
 
 # Function to delete balance type. Returns True if balance was deleted, False otherwise
+@_serialized
 async def delete_balance_type(
     context: ContextTypes.DEFAULT_TYPE, chat_id: int, type: str
 ) -> bool:
     logger.debug(f"Deleting balance type '{type}' in chat_id: {chat_id}")
-    data = await _get_data_from_pinned_messages(context, chat_id)
-    if data is None:
+    chat = await _get_chat(context, chat_id)
+    if chat is None:
         logger.warning("No data found to delete.")
         return False
-    if type not in data:
+    if type not in chat.data:
         logger.warning(f"Type '{type}' not found in data.")
         return False
-    del data[type]
-    await _update_data_from_pinned_messages(context, chat_id, data)
+    event = ledger.new_event(ledger.DELETE, type)
+    chat.apply(event)
+    await _update_data(context, chat_id, chat, [event])
     logger.info(f"Balance type '{type}' deleted successfully.")
     return True
 
 
 # Function to reset all balances. Return old and new data
+@_serialized
 async def reset_limits_for_chat(
     context: ContextTypes.DEFAULT_TYPE, chat_id: int
 ) -> object:
     logger.debug(f"Resetting all balances in chat_id: {chat_id}")
-    data = await _get_data_from_pinned_messages(context, chat_id)
-    if data is None:
+    chat = await _get_chat(context, chat_id)
+    if chat is None:
         logger.warning("No data found to reset.")
         return None
-    old_data = data.copy()
+    data = chat.data
     have_changes = False
-    for type in data:
-        if "balance" not in data[type] or "limit" not in data[type]:
+    for type, info in data.items():
+        if not isinstance(info, Category):
             continue
-        if data[type]["balance"] != data[type]["limit"]:
+        if info.balance != info.limit:
             have_changes = True
             logger.debug(
-                f"Resetting balance for type '{type}' from {data[type]['balance']} to {data[type]['limit']}."
+                f"Resetting balance for type '{type}' from {info.balance} to {info.limit}."
             )
-        data[type]["balance"] = data[type]["limit"]
     if have_changes:
-        await _update_data_from_pinned_messages(context, chat_id, data)
+        old_data = budget.snapshot(data)
+        event = ledger.new_event(ledger.RESET)
+        chat.apply(event)
+        await _update_data(context, chat_id, chat, [event])
         logger.info("All balances reset successfully.")
         return {"old": old_data, "new": data}
     else:
@@ -222,11 +581,72 @@ async def reset_limits_for_chat(
         return {"error": "No changes."}
 
 
+async def _replace_data(context: ContextTypes.DEFAULT_TYPE, chat_id: int, data: object):
+    chat = ChatState(_representation(normalize_data_to_decimals(data)))
+    await _update_data(context, chat_id, chat, [ledger.new_event(ledger.REPLACE)])
+
+
 # Function for custom setting json as balances
+@_serialized
 async def set_custom_json_balance(
     context: ContextTypes.DEFAULT_TYPE, chat_id: int, data: object
 ):
     logger.debug(f"Setting custom json balance in chat_id: {chat_id}")
-    data = _normalize_data_to_decimals(data)
-    await _update_data_from_pinned_messages(context, chat_id, data)
+    await _replace_data(context, chat_id, data)
     logger.info("Custom json balance set successfully.")
+
+
+# Function to replace the balances, unless there are none, and the spending
+# history, unless spend_batches is None, with imported ones. Both happen
+# under the chat's lock, so no spend of the chat lands between the history
+# being cleared and filled again
+@_serialized
+async def import_chat_data(
+    context: ContextTypes.DEFAULT_TYPE,
+    chat_id: int,
+    balances: dict,
+    spend_batches: Iterable[list[tuple[float, str, float]]] | None,
+):
+    logger.debug(f"Importing data in chat_id: {chat_id}")
+    if balances:
+        await _replace_data(context, chat_id, balances)
+    if spend_batches is not None and spending.store.enabled:
+        spending.store.clear(chat_id)
+        for batch in spend_batches:
+            spending.store.append(chat_id, batch)
+            await asyncio.sleep(0)
+    logger.info("Data imported successfully.")
+
+
+# Function to get the latest changes of the chat, newest first. Returns None
+# if the storage keeps no history
+async def get_history(
+    context: ContextTypes.DEFAULT_TYPE, chat_id: int, limit: int
+) -> list[Event] | None:
+    logger.debug(f"Getting {limit} history entries for chat_id: {chat_id}")
+    return await _storage.history(chat_id, limit)
+
+
+# Function to get the limit and balance of every category with Decimal
+# amounts, empty if the chat has no data
+async def get_balances(
+    context: ContextTypes.DEFAULT_TYPE, chat_id: int
+) -> dict[str, Category]:
+    logger.debug(f"Getting balances for chat_id: {chat_id}")
+    chat = await _read_chat(context, chat_id)
+    if chat is None:
+        return {}
+    data = chat.data
+    return {
+        type: Category(_amount(data, info.limit), _amount(data, info.balance))
+        for type, info in data.items()
+        if isinstance(info, Category)
+    }
+
+
+# Function to get the limit of every category, empty if the chat has no data
+async def get_limits(
+    context: ContextTypes.DEFAULT_TYPE, chat_id: int
+) -> dict[str, Decimal]:
+    balances = await get_balances(context, chat_id)
+    return {type: info.limit for type, info in balances.items()}
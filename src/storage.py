@@ -0,0 +1,280 @@
+import logging
+import sqlite3
+import time
+import zlib
+from decimal import Decimal
+from typing import Protocol
+from telegram import Bot
+from telegram.error import BadRequest, NetworkError, RetryAfter
+import metrics
+import outbound
+from cache import ChatCache
+from data_dir import make_parent
+from codec import (
+    DATA_HEADER,
+    MESSAGE_MAX_LENGTH,
+    decode_message,
+    dumps_data,
+    encode_message,
+    loads_data,
+)
+from ledger import REPLACE, Event, apply_event
+
+logger = logging.getLogger(__name__)
+
+
+# Where the balances of a chat are kept
+class Storage(Protocol):
+    async def load(self, bot: Bot, chat_id: int) -> object:
+        """Return the data of the chat, None if there is none."""
+
+    async def save(self, bot: Bot, chat_id: int, data: object) -> None:
+        """Replace the data of the chat."""
+
+    async def append(
+        self, bot: Bot, chat_id: int, events: list[Event], data: object
+    ) -> None:
+        """Record changes applied together, data is the state after them."""
+
+    async def history(self, chat_id: int, limit: int) -> list[Event] | None:
+        """Return the latest changes, newest first, None if not kept."""
+
+    async def close(self) -> None:
+        """Release the resources of the storage."""
+
+
+# Errors of a Telegram outage or overload, worth trying again later, unlike
+# a write Telegram refuses
+def is_outage(error: Exception) -> bool:
+    if isinstance(error, RetryAfter):
+        return True
+    return isinstance(error, NetworkError) and not isinstance(error, BadRequest)
+
+
+def _is_data_message(message) -> bool:
+    return bool(message and message.text and DATA_HEADER in message.text)
+
+
+# Balances as JSON in a pinned message of the chat itself
+class PinnedMessageStorage:
+    def __init__(self, cache_size: int, cache_ttl: float):
+        # Known ids of the pinned data messages, saves a get_chat per write
+        self._message_ids = ChatCache(cache_size, cache_ttl)
+
+    async def _get_chat(self, bot: Bot, chat_id: int):
+        async with metrics.api_call("get_chat"):
+            return await bot.get_chat(chat_id)
+
+    async def _find_message(self, bot: Bot, chat_id: int):
+        chat = await outbound.scheduler.send(
+            chat_id,
+            outbound.STATE,
+            "get_chat",
+            lambda _: self._get_chat(bot, chat_id),
+        )
+        pinned_message = chat.pinned_message
+        if not _is_data_message(pinned_message):
+            return None
+        self._message_ids.put(chat_id, pinned_message.message_id)
+        return pinned_message
+
+    async def _edit(self, bot: Bot, chat_id: int, message_id: int, text: str):
+        async with metrics.api_call("edit_message_text"):
+            return await bot.edit_message_text(
+                chat_id=chat_id, message_id=message_id, text=text
+            )
+
+    async def _send(self, bot: Bot, chat_id: int, text: str):
+        async with metrics.api_call("send_message"):
+            return await bot.send_message(chat_id, text)
+
+    async def _pin(self, bot: Bot, chat_id: int, message_id: int):
+        async with metrics.api_call("pin_chat_message"):
+            return await bot.pin_chat_message(chat_id, message_id)
+
+    async def load(self, bot: Bot, chat_id: int) -> object:
+        logger.debug(f"Fetching pinned messages for chat_id: {chat_id}")
+        pinned_message = await self._find_message(bot, chat_id)
+        if pinned_message is None:
+            logger.debug("No relevant pinned message found.")
+            return None
+        logger.debug("Pinned message found with expected text.")
+        try:
+            data = decode_message(pinned_message.text)
+            logger.debug("Successfully parsed data from pinned message.")
+            return data
+        except (IndexError, ValueError, TypeError, zlib.error) as e:
+            logger.error(f"Error parsing pinned message: {e}")
+        return None
+
+    # Text of the message holding the data. Raises ValueError if it is
+    # longer than a message can be
+    def encode(self, chat_id: int, data: object) -> str:
+        message_text = encode_message(data)
+        if len(message_text) > MESSAGE_MAX_LENGTH:
+            raise ValueError(
+                f"Data of chat {chat_id} takes {len(message_text)} characters, "
+                f"more than a message can hold"
+            )
+        return message_text
+
+    async def save(self, bot: Bot, chat_id: int, data: object) -> None:
+        logger.debug(f"Updating pinned message for chat_id: {chat_id}")
+        message_text = self.encode(chat_id, data)
+        entry = self._message_ids.get(chat_id)
+        if entry is not None:
+            message_id = entry.value
+        else:
+            pinned_message = await self._find_message(bot, chat_id)
+            message_id = pinned_message.message_id if pinned_message else None
+
+        if message_id is not None:
+            logger.debug("Editing existing pinned message.")
+            try:
+                await outbound.scheduler.send(
+                    chat_id,
+                    outbound.STATE,
+                    "edit_message_text",
+                    lambda text: self._edit(bot, chat_id, message_id, text),
+                    message_text,
+                )
+                logger.info("Pinned message updated successfully.")
+            except Exception as e:
+                self._message_ids.invalidate(chat_id)
+                logger.error(f"Failed to edit pinned message: {e}")
+                raise
+        else:
+            logger.debug("No existing pinned message found. Sending a new one.")
+            try:
+                sent_message = await outbound.scheduler.send(
+                    chat_id,
+                    outbound.STATE,
+                    "send_message",
+                    lambda text: self._send(bot, chat_id, text),
+                    message_text,
+                )
+                await outbound.scheduler.send(
+                    chat_id,
+                    outbound.STATE,
+                    "pin_chat_message",
+                    lambda _: self._pin(bot, chat_id, sent_message.message_id),
+                )
+                self._message_ids.put(chat_id, sent_message.message_id)
+                logger.info("New pinned message sent and pinned successfully.")
+            except Exception as e:
+                logger.error(f"Failed to send or pin message: {e}")
+                raise
+
+    async def append(
+        self, bot: Bot, chat_id: int, events: list[Event], data: object
+    ) -> None:
+        await self.save(bot, chat_id, data)
+
+    async def history(self, chat_id: int, limit: int) -> list[Event] | None:
+        return None
+
+    async def close(self) -> None:
+        self._message_ids.invalidate()
+
+
+# Balances in a local SQLite database in WAL mode. Every change is appended
+# to a journal; the data is rebuilt from the latest snapshot of the chat plus
+# the journal entries after it, and re-snapshotted every `snapshot_every`
+# entries. The journal itself is kept as the chat history. Queries take
+# microseconds, so they run on the event loop thread
+class SqliteStorage:
+    def __init__(self, path: str, snapshot_every: int = 100):
+        self.snapshot_every = snapshot_every
+        # Journal entries after the latest snapshot, per loaded chat
+        self._tail_lengths: dict[int, int] = {}
+        make_parent(path)
+        self._db = sqlite3.connect(path, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS journal ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER NOT NULL, "
+            "ts REAL NOT NULL, op TEXT NOT NULL, type TEXT, amount TEXT)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS journal_chat_id ON journal (chat_id, id)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS snapshots ("
+            "chat_id INTEGER PRIMARY KEY, journal_id INTEGER NOT NULL, data TEXT NOT NULL)"
+        )
+        logger.info(f"Opened SQLite storage at {path}")
+
+    async def load(self, bot: Bot, chat_id: int) -> object:
+        row = self._db.execute(
+            "SELECT journal_id, data FROM snapshots WHERE chat_id = ?", (chat_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        journal_id, data_json = row
+        data = loads_data(data_json)
+        tail = self._db.execute(
+            "SELECT op, type, amount, ts FROM journal "
+            "WHERE chat_id = ? AND id > ? ORDER BY id",
+            (chat_id, journal_id),
+        ).fetchall()
+        for op, type, amount, ts in tail:
+            amount = Decimal(amount) if amount is not None else None
+            apply_event(data, Event(op, type, amount, ts))
+        self._tail_lengths[chat_id] = len(tail)
+        return data
+
+    def _insert(self, chat_id: int, event: Event) -> int:
+        amount = str(event.amount) if event.amount is not None else None
+        cursor = self._db.execute(
+            "INSERT INTO journal (chat_id, ts, op, type, amount) VALUES (?, ?, ?, ?, ?)",
+            (chat_id, event.ts, event.op, event.type, amount),
+        )
+        return cursor.lastrowid
+
+    async def append(
+        self, bot: Bot, chat_id: int, events: list[Event], data: object
+    ) -> None:
+        # A chat without a snapshot yet gets one with its first change
+        tail_length = self._tail_lengths.get(chat_id, self.snapshot_every)
+        tail_length += len(events)
+        snapshot = tail_length > self.snapshot_every or any(
+            event.op == REPLACE for event in events
+        )
+        self._db.execute("BEGIN")
+        try:
+            for event in events:
+                journal_id = self._insert(chat_id, event)
+            if snapshot:
+                self._db.execute(
+                    "INSERT INTO snapshots (chat_id, journal_id, data) VALUES (?, ?, ?) "
+                    "ON CONFLICT (chat_id) DO UPDATE SET "
+                    "journal_id = excluded.journal_id, data = excluded.data",
+                    (chat_id, journal_id, dumps_data(data)),
+                )
+            self._db.execute("COMMIT")
+        except Exception:
+            self._db.execute("ROLLBACK")
+            raise
+        if snapshot:
+            self._tail_lengths[chat_id] = 0
+            logger.debug(f"Snapshotted data for chat_id: {chat_id}")
+        else:
+            self._tail_lengths[chat_id] = tail_length
+
+    async def save(self, bot: Bot, chat_id: int, data: object) -> None:
+        await self.append(bot, chat_id, [Event(REPLACE, ts=time.time())], data)
+
+    async def history(self, chat_id: int, limit: int) -> list[Event] | None:
+        rows = self._db.execute(
+            "SELECT op, type, amount, ts FROM journal "
+            "WHERE chat_id = ? ORDER BY id DESC LIMIT ?",
+            (chat_id, limit),
+        ).fetchall()
+        return [
+            Event(op, type, Decimal(amount) if amount is not None else None, ts)
+            for op, type, amount, ts in rows
+        ]
+
+    async def close(self) -> None:
+        self._db.close()
@@ -1,25 +1,161 @@
-from telegram import Update
+from typing import IO
+from telegram import CallbackQuery, InlineKeyboardMarkup, Update
 from telegram.constants import ParseMode
+from telegram.error import BadRequest
 from telegram.ext import Application
+import metrics
+import outbound
 
 
+async def _reply_text(update: Update, app, message: str):
+    async with metrics.api_call("send_message"):
+        if update.message is not None:
+            return await update.message.reply_text(message)
+        if update.edited_message is not None:
+            return await update.edited_message.reply_text(message)
+        return await app.bot.send_message(update.effective_chat.id, message)
+
+
+async def _reply_html(update: Update, app: Application, message: str):
+    async with metrics.api_call("send_message"):
+        if update.message is not None:
+            return await update.message.reply_html(message)
+        if update.edited_message is not None:
+            return await update.edited_message.reply_html(message)
+        return await app.bot.send_message(
+            update.effective_chat.id, message, parse_mode=ParseMode.HTML
+        )
+
+
+# Replies go through the outbound scheduler after state writes, and
+# replies waiting for the same chat are sent as one message
 async def reply_text(update: Update, app, message: str):
-    if update.message is not None:
-        await update.message.reply_text(message)
-        return
-    if update.edited_message is not None:
-        await update.edited_message.reply_text(message)
-        return
-    await app.bot.send_message(update.effective_chat.id, message)
+    chat_id = update.effective_chat.id
+    return await outbound.scheduler.send(
+        chat_id,
+        outbound.REPLY,
+        "send_message",
+        lambda text: _reply_text(update, app, text),
+        message,
+        merge_key=("text", chat_id, outbound.REPLY),
+    )
 
 
 async def reply_html(update: Update, app: Application, message: str):
-    if update.message is not None:
-        await reply_html(update, app, message)
-        return
-    if update.edited_message is not None:
-        await update.edited_message.reply_html(message)
-        return
-    await app.bot.send_message(
-        update.effective_chat.id, message, parse_mode=ParseMode.HTML
+    chat_id = update.effective_chat.id
+    return await outbound.scheduler.send(
+        chat_id,
+        outbound.REPLY,
+        "send_message",
+        lambda text: _reply_html(update, app, text),
+        message,
+        merge_key=("html", chat_id),
+    )
+
+
+async def _send_text(app: Application, chat_id: int, message: str):
+    async with metrics.api_call("send_message"):
+        return await app.bot.send_message(chat_id, message)
+
+
+# Sends a message that doesn't reply to an update. Only messages of the same
+# priority are merged, a reply isn't held back with bulk messages
+async def send_text(
+    app: Application, chat_id: int, message: str, priority: int = outbound.REPLY
+):
+    return await outbound.scheduler.send(
+        chat_id,
+        priority,
+        "send_message",
+        lambda text: _send_text(app, chat_id, text),
+        message,
+        merge_key=("text", chat_id, priority),
+    )
+
+
+async def _reply_document(update: Update, file: IO[bytes], file_name: str):
+    # Read again from the start when a rate limited call is retried
+    file.seek(0)
+    async with metrics.api_call("send_document"):
+        return await update.effective_chat.send_document(file, filename=file_name)
+
+
+# Sends the file as a document to the chat of the update
+async def reply_document(update: Update, file: IO[bytes], file_name: str):
+    return await outbound.scheduler.send(
+        update.effective_chat.id,
+        outbound.REPLY,
+        "send_document",
+        lambda _: _reply_document(update, file, file_name),
+    )
+
+
+async def _reply_keyboard(update: Update, message: str, markup: InlineKeyboardMarkup):
+    async with metrics.api_call("send_message"):
+        return await update.effective_chat.send_message(message, reply_markup=markup)
+
+
+# Sends a message with an inline keyboard, never merged with other replies
+async def reply_keyboard(update: Update, message: str, markup: InlineKeyboardMarkup):
+    return await outbound.scheduler.send(
+        update.effective_chat.id,
+        outbound.REPLY,
+        "send_message",
+        lambda text: _reply_keyboard(update, text, markup),
+        message,
+    )
+
+
+# Latest text and keyboard waiting to be written to a message, by (chat_id,
+# message_id)
+_pending_edits: dict[tuple[int, int], tuple[str, InlineKeyboardMarkup | None]] = {}
+
+
+async def _edit_keyboard_message(query: CallbackQuery, key: tuple[int, int]):
+    pending = _pending_edits.pop(key, None)
+    if pending is None:
+        # An earlier queued edit has already written the latest text
+        return None
+    message, markup = pending
+    async with metrics.api_call("edit_message_text"):
+        try:
+            return await query.edit_message_text(message, reply_markup=markup)
+        except BadRequest as e:
+            if "not modified" not in str(e):
+                raise
+            return None
+
+
+# Edits the message of the callback query in place. Edits of one message
+# waiting in the outbound queue together only write the latest text
+async def edit_keyboard_message(
+    query: CallbackQuery, message: str, markup: InlineKeyboardMarkup | None
+):
+    chat_id = query.message.chat.id
+    key = (chat_id, query.message.message_id)
+    _pending_edits[key] = (message, markup)
+    return await outbound.scheduler.send(
+        chat_id,
+        outbound.REPLY,
+        "edit_message_text",
+        lambda _: _edit_keyboard_message(query, key),
+    )
+
+
+async def _answer_callback(query: CallbackQuery, text: str | None):
+    async with metrics.api_call("answer_callback_query"):
+        return await query.answer(text)
+
+
+# Stops the spinner of the pressed button, with a short notice if text is set
+async def answer_callback(query: CallbackQuery, text: str | None = None):
+    if query.message is not None:
+        chat_id = query.message.chat.id
+    else:
+        chat_id = query.from_user.id
+    return await outbound.scheduler.send(
+        chat_id,
+        outbound.REPLY,
+        "answer_callback_query",
+        lambda _: _answer_callback(query, text),
     )
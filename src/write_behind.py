@@ -0,0 +1,215 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+
+# Stops calls to a failing service: opens after `threshold` failures in a row,
+# then lets a single call through every `cooldown` seconds and closes again
+# once one succeeds
+class CircuitBreaker:
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._failures = 0
+        self._opened_at: float | None = None
+        self._probing = False
+
+    @property
+    def closed(self) -> bool:
+        return self._opened_at is None
+
+    # Seconds until a call may be tried, 0 if it may be tried now
+    def wait_time(self) -> float:
+        if self._opened_at is None:
+            return 0.0
+        if self._probing:
+            return self.cooldown
+        return max(0.0, self._opened_at + self.cooldown - time.monotonic())
+
+    # Claims the call allowed while the breaker is open
+    def try_acquire(self) -> bool:
+        if self.wait_time() > 0:
+            return False
+        if self._opened_at is not None:
+            self._probing = True
+        return True
+
+    def record_success(self):
+        if self._opened_at is not None:
+            logger.info("Circuit breaker closed.")
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    def record_failure(self):
+        self._failures += 1
+        self._probing = False
+        if self._opened_at is not None or self._failures >= self.threshold:
+            if self._opened_at is None:
+                logger.warning(
+                    f"Circuit breaker opened after {self._failures} failures."
+                )
+            self._opened_at = time.monotonic()
+
+
+class _Pending:
+    __slots__ = ("value", "flush", "first_at", "last_at", "due", "attempts")
+
+    def __init__(self, value, flush, now: float, attempts: int = 0):
+        self.value = value
+        self.flush = flush
+        self.first_at = now
+        self.last_at = now
+        self.due = asyncio.Event()
+        # Failed writes of this key so far
+        self.attempts = attempts
+
+
+# Coalesces writes per key: a write is delayed until no new value arrived for
+# `delay` seconds, but never longer than `max_delay` after the first pending one.
+# Only the latest value of a key is flushed.
+#
+# Writes failing with an error `retriable` accepts are tried again after
+# `retry_delay` seconds, doubled with every failure up to `retry_max_delay`,
+# unless a newer value replaced them meanwhile. With a `breaker` no write is
+# tried while it is open.
+class WriteBehind:
+    def __init__(
+        self,
+        delay: float,
+        max_delay: float,
+        retriable: Callable[[Exception], bool] | None = None,
+        retry_delay: float = 1.0,
+        retry_max_delay: float = 60.0,
+        breaker: CircuitBreaker | None = None,
+    ):
+        self.delay = delay
+        self.max_delay = max(delay, max_delay)
+        self.retriable = retriable
+        self.retry_delay = retry_delay
+        self.retry_max_delay = max(retry_delay, retry_max_delay)
+        self.breaker = breaker
+        self._pending: dict[object, _Pending] = {}
+        self._tasks: dict[object, asyncio.Task] = {}
+        # Set while flush() writes everything once, failures aren't retried
+        self._flushing = False
+        # Set and replaced when the breaker closes, wakes the writes waiting
+        # for it
+        self._resumed = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def has_pending(self, key) -> bool:
+        return key in self._pending
+
+    def pending_value(self, key):
+        pending = self._pending.get(key)
+        return pending.value if pending is not None else None
+
+    def schedule(self, key, value, flush: Callable[[object], Awaitable[None]]):
+        now = time.monotonic()
+        pending = self._pending.get(key)
+        if pending is None:
+            self._pending[key] = _Pending(value, flush, now)
+        else:
+            pending.value = value
+            pending.flush = flush
+            pending.last_at = now
+        if key not in self._tasks:
+            self._tasks[key] = asyncio.create_task(self._run(key))
+
+    async def _run(self, key):
+        try:
+            while True:
+                pending = self._pending.get(key)
+                if pending is None:
+                    return
+                if pending.attempts:
+                    # Waiting out the backoff of a failed write
+                    flush_at = pending.first_at
+                else:
+                    flush_at = min(
+                        pending.last_at + self.delay,
+                        pending.first_at + self.max_delay,
+                    )
+                wait = flush_at - time.monotonic()
+                event = pending.due
+                if wait <= 0 and self.breaker is not None and not pending.due.is_set():
+                    if not self.breaker.try_acquire():
+                        wait, event = self.breaker.wait_time(), self._resumed
+                if wait > 0 and not pending.due.is_set():
+                    try:
+                        await asyncio.wait_for(event.wait(), wait)
+                    except TimeoutError:
+                        pass
+                    continue
+                del self._pending[key]
+                await self._flush(key, pending)
+        finally:
+            if self._tasks.get(key) is asyncio.current_task():
+                del self._tasks[key]
+
+    async def _flush(self, key, pending: _Pending):
+        try:
+            await pending.flush(pending.value)
+        except Exception as e:
+            retriable = self.retriable is not None and self.retriable(e)
+            if retriable and self.breaker is not None:
+                self.breaker.record_failure()
+            elif self.breaker is not None:
+                # The service is fine, only this write is bad
+                self._record_success()
+            if key in self._pending:
+                logger.warning(
+                    f"Deferred write for {key} failed, a newer one is due: {e}"
+                )
+                return
+            if not retriable or self._flushing:
+                logger.error(f"Deferred write for {key} failed: {e}")
+                return
+            self._retry(key, pending)
+            logger.warning(
+                f"Deferred write for {key} failed, attempt {pending.attempts + 1}, "
+                f"retrying: {e}"
+            )
+        else:
+            if self.breaker is not None:
+                self._record_success()
+
+    def _record_success(self):
+        was_closed = self.breaker.closed
+        self.breaker.record_success()
+        if not was_closed:
+            self._wake()
+
+    def _wake(self):
+        self._resumed.set()
+        self._resumed = asyncio.Event()
+
+    def _retry(self, key, pending: _Pending):
+        attempts = pending.attempts + 1
+        backoff = min(self.retry_delay * 2 ** (attempts - 1), self.retry_max_delay)
+        retry = _Pending(pending.value, pending.flush, time.monotonic(), attempts)
+        retry.first_at += backoff
+        self._pending[key] = retry
+
+    # Writes pending values right away and waits for them, e.g. on shutdown.
+    # Values that fail to write are dropped
+    async def flush(self, key=None):
+        keys = list(self._tasks) if key is None else [key]
+        for k in keys:
+            pending = self._pending.get(k)
+            if pending is not None:
+                pending.due.set()
+        self._wake()
+        tasks = [self._tasks[k] for k in keys if k in self._tasks]
+        if tasks:
+            self._flushing = True
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                self._flushing = False
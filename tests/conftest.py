@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The bot's modules are imported from src, as main.py does
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
@@ -0,0 +1,100 @@
+import asyncio
+import io
+from decimal import Decimal
+
+import pytest
+
+import backup
+import spending
+import state
+from budget import Category
+from chat_locks import chat_lock
+from spending import SpendColumns, SpendingStore
+
+BALANCES = {
+    "food": Category(Decimal("150"), Decimal("37.375")),
+    "rent, flat": Category(Decimal("500"), Decimal("-10")),
+}
+SPENDS = [(1760000000.5, "food", 12.5), (1760000100.0, "rent, flat", -3.0)]
+
+
+def export(format: str) -> io.TextIOWrapper:
+    columns = SpendColumns()
+    columns.append(SPENDS)
+    file = io.BytesIO()
+    asyncio.run(backup.write_export(file, format, BALANCES, columns))
+    file.seek(0)
+    return io.TextIOWrapper(file, encoding="utf-8", newline="")
+
+
+@pytest.mark.parametrize("format", backup.FORMATS)
+def test_export_round_trip(format):
+    text = export(format)
+    summary = backup.validate(text, format)
+    assert summary.balances == BALANCES
+    assert summary.spends == 2
+    text.seek(0)
+    assert list(backup.spend_batches(text, format)) == [SPENDS]
+
+
+def test_spends_are_read_in_batches(monkeypatch):
+    monkeypatch.setattr(backup, "IMPORT_BATCH", 1)
+    assert list(backup.spend_batches(export(backup.CSV), backup.CSV)) == [
+        [SPENDS[0]],
+        [SPENDS[1]],
+    ]
+
+
+def test_format_for():
+    assert backup.format_for("money.jsonl") == backup.JSONL
+    assert backup.format_for("money.CSV") == backup.CSV
+    assert backup.format_for(None) == backup.CSV
+
+
+@pytest.mark.parametrize(
+    "line, error",
+    [
+        ('{"record": "balance", "type": "x", "limit": 1}', "balance must be"),
+        ('{"record": "balance", "type": "", "limit": 1, "balance": 1}', "type must"),
+        ('{"record": "balance", "type": "x", "limit": "NaN", "balance": 1}', "limit"),
+        ('{"record": "balance", "type": "x", "limit": 1e20, "balance": 1}', "limit"),
+        ('{"record": "spend", "type": "x", "time": 5, "amount": 1}', "time must"),
+        ('{"record": "spend", "type": "x", "time": "2026-10-16", "amount": true}', ""),
+        ('{"record": "other", "type": "x"}', "record must"),
+        ("[1]", "a record must be an object"),
+        ("{", "invalid JSON"),
+    ],
+)
+def test_invalid_records_are_refused_with_their_line(line, error):
+    text = io.StringIO(
+        f'{{"record": "balance", "type": "a", "limit": 1, "balance": 1}}\n{line}\n'
+    )
+    with pytest.raises(ValueError, match=f"Line 2: {error}"):
+        backup.validate(text, backup.JSONL)
+
+
+def test_csv_needs_its_header():
+    with pytest.raises(ValueError, match="Line 1"):
+        backup.validate(io.StringIO("a,b\n1,2\n"), backup.CSV)
+
+
+def test_import_replaces_the_history_under_the_chat_lock(tmp_path, monkeypatch):
+    store = SpendingStore(10, 60)
+    store.open(str(tmp_path))
+    monkeypatch.setattr(spending, "store", store)
+    store.append(1, [(1.0, "old", 1.0)])
+
+    async def run():
+        async with chat_lock(1):
+            task = asyncio.create_task(
+                state.import_chat_data(None, 1, {}, iter([SPENDS]))
+            )
+            await asyncio.sleep(0.01)
+            # Waits for the lock, the old history is still there
+            assert store.get(1).names == ["old"]
+        await task
+
+    asyncio.run(run())
+    history = store.get(1)
+    assert history.names == ["food", "rent, flat"]
+    assert list(history.amount) == [12.5, -3.0]
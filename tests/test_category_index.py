@@ -0,0 +1,68 @@
+import pytest
+
+from category_index import CategoryIndex, Resolution
+
+NAMES = ["Groceries", "rent", "cat_food", "car", "card fees", "Restaurants"]
+
+
+@pytest.fixture
+def index() -> CategoryIndex:
+    return CategoryIndex(NAMES)
+
+
+@pytest.mark.parametrize(
+    "asked, name",
+    [
+        ("groceries", "Groceries"),
+        ("GROCERY", "Groceries"),
+        ("cat-food", "cat_food"),
+        ("Cat Food", "cat_food"),
+        ("rents", "rent"),
+        ("car", "car"),
+        ("resta", "Restaurants"),
+        ("grocreies", "Groceries"),
+        ("restuarants", "Restaurants"),
+        ("cardfee", "card fees"),
+    ],
+)
+def test_resolve(index, asked, name):
+    assert index.resolve(asked) == Resolution(name, [])
+
+
+def test_short_prefixes_are_not_resolved(index):
+    assert index.resolve("re") == Resolution(None, [])
+    assert index.resolve("res") == Resolution("Restaurants", [])
+
+
+def test_ambiguous_names_list_their_candidates():
+    index = CategoryIndex(["food.week1", "food.week2", "fuel"])
+    assert index.resolve("food.week") == Resolution(None, ["food.week1", "food.week2"])
+    assert index.resolve("food.week3") == Resolution(None, ["food.week1", "food.week2"])
+
+
+def test_unknown_and_empty_names(index):
+    assert index.resolve("zzz") == Resolution(None, [])
+    assert index.resolve(" - ") == Resolution(None, [])
+    # Far longer than every name, not looked up letter by letter
+    assert index.resolve("x" * 10_000) == Resolution(None, [])
+
+
+def test_added_and_removed_names(index):
+    index.add("Gifts")
+    assert index.resolve("gift").name == "Gifts"
+    index.remove("Gifts")
+    index.remove("rent")
+    assert index.resolve("gift").name is None
+    assert index.resolve("rent").name is None
+    assert "rent" not in index and "car" in index
+    assert index.resolve("car").name == "car"
+
+
+def test_a_name_is_indexed_once():
+    index = CategoryIndex(["food", "food"])
+    index.add("food")
+    assert index._lengths == {4: 1}
+    index.remove("food")
+    assert "food" not in index
+    assert (index._lengths, index._aliases, index._deletes) == ({}, {}, {})
+    assert not index._trie.children and not index._trie.names
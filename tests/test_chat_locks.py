@@ -0,0 +1,66 @@
+import asyncio
+
+import chat_locks
+from chat_locks import chat_lock
+
+
+async def hold(chat_id, name, order, release):
+    async with chat_lock(chat_id):
+        order.append(f"{name} in")
+        await release.wait()
+        order.append(f"{name} out")
+
+
+def test_same_chat_runs_one_at_a_time_in_order():
+    async def run():
+        order = []
+        release = asyncio.Event()
+        tasks = [asyncio.create_task(hold(1, name, order, release)) for name in "abc"]
+        await asyncio.sleep(0)
+        assert order == ["a in"]
+        release.set()
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(run()) == ["a in", "a out", "b in", "b out", "c in", "c out"]
+
+
+def test_other_chats_do_not_wait():
+    async def run():
+        order = []
+        release = asyncio.Event()
+        first = asyncio.create_task(hold(1, "a", order, release))
+        await asyncio.sleep(0)
+        async with chat_lock(2):
+            order.append("other chat")
+        release.set()
+        await first
+        return order
+
+    assert asyncio.run(run()) == ["a in", "other chat", "a out"]
+
+
+def test_locks_are_dropped_when_unused():
+    async def run():
+        release = asyncio.Event()
+        tasks = [asyncio.create_task(hold(1, "a", [], release)) for _ in range(3)]
+        await asyncio.sleep(0)
+        during = chat_locks.active_chats()
+        release.set()
+        await asyncio.gather(*tasks)
+        return during, chat_locks.active_chats()
+
+    assert asyncio.run(run()) == (1, 0)
+
+
+def test_lock_is_released_on_error():
+    async def run():
+        try:
+            async with chat_lock(1):
+                raise ValueError
+        except ValueError:
+            pass
+        async with chat_lock(1):
+            return chat_locks.active_chats()
+
+    assert asyncio.run(run()) == 1
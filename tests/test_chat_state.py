@@ -0,0 +1,145 @@
+from decimal import Decimal
+
+import pytest
+
+import fixed_point
+import ledger
+from budget import Category
+from chat_state import ChatState
+from ledger import Event
+from test_journal import EVENTS
+
+
+def fresh(data) -> ChatState:
+    return ChatState(data)
+
+
+def test_totals_follow_replay():
+    state = ChatState({})
+    for event in EVENTS:
+        state.apply(event)
+        recounted = fresh(state.data)
+        assert (state.limit, state.balance) == (recounted.limit, recounted.balance)
+    assert state.footer() == "Left: 547.375 / 650"
+
+
+def test_totals_follow_a_new_scale():
+    state = ChatState(fixed_point.to_fixed_point({}, 2))
+    for event in EVENTS:
+        state.apply(event)
+    assert state.data.scale == 3
+    assert (state.limit, state.balance) == (650000, 547375)
+    assert state.footer() == "Left: 547.375 / 650"
+
+
+def test_summary_shows_changed_lines_only():
+    state = ChatState({})
+    state.apply(Event(ledger.UPSERT, "food", Decimal("100")))
+    state.apply(Event(ledger.UPSERT, "rent", Decimal("500")))
+    state.summary()
+    rent_line = state._lines["rent"]
+    state.apply(Event(ledger.SPEND, "food", Decimal("10")))
+    assert "food" not in state._lines
+    assert state.summary() == (
+        "food: 90 / 100\nrent: 500 / 500\n\nLeft: 590 / 600\nSpent: 10 / 600"
+    )
+    assert state._lines["rent"] is rent_line
+
+
+def test_other_values_are_not_counted():
+    state = ChatState({"note": "hi", "food": Category(Decimal("10"), Decimal("4"))})
+    assert (state.limit, state.balance) == (Decimal("10"), Decimal("4"))
+    assert state.summary().startswith("food: 4 / 10\n\nLeft")
+
+
+def test_reset_sets_balances_to_limits():
+    state = ChatState({})
+    for event in EVENTS + [Event(ledger.RESET)]:
+        state.apply(event)
+    assert state.balance == state.limit == Decimal("650")
+
+
+@pytest.mark.parametrize("amount", ["Infinity", "1e5000", "-1e15"])
+@pytest.mark.parametrize("scale", [None, 2])
+def test_rejected_event_changes_nothing(scale, amount):
+    data = {"food": Category(Decimal("100"), Decimal("100"))}
+    if scale is not None:
+        data = fixed_point.to_fixed_point(data, scale)
+    state = ChatState(data)
+    state.categories()
+    before = (state.limit, state.balance, dict(state.data))
+    with pytest.raises(ValueError):
+        state.apply(Event(ledger.SPEND, "food", Decimal(amount)))
+    assert (state.limit, state.balance, dict(state.data)) == before
+    assert state.categories().resolve("food").name == "food"
+
+
+@pytest.mark.parametrize("scale", [None, 2])
+def test_huge_amounts_are_not_added(scale):
+    data = {} if scale is None else fixed_point.to_fixed_point({}, scale)
+    state = ChatState(data)
+    with pytest.raises(ValueError):
+        state.apply(Event(ledger.UPSERT, "big", Decimal("1e5000")))
+    assert state.data == {}
+    state.apply(Event(ledger.UPSERT, "big", Decimal("999999999999999.99")))
+    assert state.footer() == "Left: 999999999999999.99 / 999999999999999.99"
+
+
+def index_state(state: ChatState):
+    index = state.categories()
+    return dict(index._lengths), sorted(index._aliases)
+
+
+def test_group_and_category_with_the_same_name():
+    state = ChatState({"food": Category(Decimal("10"), Decimal("10"))})
+    state.categories()
+    state.apply(Event(ledger.UPSERT, "food.week1", Decimal("5")))
+    state.apply(Event(ledger.UPSERT, "food.week2", Decimal("5")))
+    assert index_state(state) == ({4: 1, 9: 2}, ["food", "foodweek1", "foodweek2"])
+    state.apply(Event(ledger.DELETE, "food.week1"))
+    state.apply(Event(ledger.DELETE, "food.week2"))
+    # The category is left
+    assert index_state(state) == ({4: 1}, ["food"])
+    assert state.categories().resolve("food").name == "food"
+    state.apply(Event(ledger.DELETE, "food"))
+    assert index_state(state) == ({}, [])
+
+
+def test_category_deleted_before_its_namesake_group():
+    state = ChatState(
+        {
+            "food": Category(Decimal("10"), Decimal("10")),
+            "food.week1": Category(Decimal("5"), Decimal("5")),
+        }
+    )
+    assert index_state(state) == ({4: 1, 9: 1}, ["food", "foodweek1"])
+    state.apply(Event(ledger.DELETE, "food"))
+    # The group is left
+    assert index_state(state) == ({4: 1, 9: 1}, ["food", "foodweek1"])
+    state.apply(Event(ledger.DELETE, "food.week1"))
+    assert index_state(state) == ({}, [])
+
+
+def test_groups_follow_their_categories():
+    state = ChatState({})
+    for event in [
+        Event(ledger.UPSERT, "food.week1", Decimal("100")),
+        Event(ledger.UPSERT, "rent", Decimal("500")),
+        Event(ledger.UPSERT, "food.week2", Decimal("100")),
+        Event(ledger.SPEND, "food.week2", Decimal("30")),
+    ]:
+        state.apply(event)
+    group = state.groups()["food"]
+    assert (group.limit, group.balance) == (Decimal("200"), Decimal("170"))
+    assert list(group.members) == ["food.week1", "food.week2"]
+    # A raised limit lowers the balance by as much
+    state.apply(Event(ledger.LIMIT, "food.week1", Decimal("150")))
+    assert (group.limit, group.balance) == (Decimal("250"), Decimal("120"))
+    assert state.summary() == (
+        "food.week1: 50 / 150\nrent: 500 / 500\nfood.week2: 70 / 100\n"
+        "\nfood: 120 / 250\n"
+        "\nLeft: 620 / 750\nSpent: 130 / 750"
+    )
+    state.apply(Event(ledger.DELETE, "food.week1"))
+    state.apply(Event(ledger.DELETE, "food.week2"))
+    assert state.groups() == {}
@@ -0,0 +1,118 @@
+from decimal import Decimal
+
+import pytest
+
+import codec
+import fixed_point
+from budget import Category
+from fixed_point import FixedPointData
+
+
+def triples_data():
+    return {
+        "food": Category(Decimal("100"), Decimal("87.5")),
+        'кот "cat"\\': Category(Decimal("20.00"), Decimal("-1E+2")),
+    }
+
+
+def test_v1_message_is_read():
+    text = (
+        "Data for money-counter\n"
+        '{"food": {"limit": 100, "balance": 87.5}, "cat": {"limit": "20", '
+        '"balance": "20"}, "note": "hi", "extra": {"limit": 1, "balance": 1, "x": 2}}'
+    )
+    data = codec.decode_message(text)
+    assert data == {
+        "food": Category(Decimal("100"), Decimal("87.5")),
+        "cat": Category(Decimal("20"), Decimal("20")),
+        "note": "hi",
+        "extra": {"limit": Decimal("1"), "balance": Decimal("1"), "x": Decimal("2")},
+    }
+    assert isinstance(data["food"].balance, Decimal)
+
+
+def test_v1_message_round_trip():
+    data = {"food": Category(Decimal("100"), Decimal("87.5")), "note": "hi"}
+    text = codec.encode_message(data)
+    assert text.startswith(f"{codec.DATA_HEADER}\n")
+    assert codec.decode_message(text) == data
+
+
+@pytest.mark.parametrize("count", [2, 500])
+def test_v2_message_round_trip(count):
+    data = triples_data()
+    data.update(
+        {f"cat_{i}": Category(Decimal(i), Decimal(i) / 4) for i in range(count)}
+    )
+    text = codec.encode_message(data)
+    assert text.startswith(f"{codec.V2_HEADER}\n")
+    decoded = codec.decode_message(text)
+    assert decoded == data
+    assert list(decoded) == list(data)
+    # Amounts keep their exponent, 20.00 stays 20.00
+    assert str(decoded['кот "cat"\\'].limit) == "20.00"
+
+
+def test_v2_message_is_compressed_when_shorter():
+    data = {f"cat_{i}": Category(Decimal(100), Decimal(100)) for i in range(200)}
+    payload = codec.encode_message(data).split("\n", 1)[1]
+    assert payload.startswith("z")
+    assert codec.decode_message(codec.encode_message(data)) == data
+
+
+def test_v3_message_round_trip():
+    data = fixed_point.to_fixed_point(triples_data(), 2)
+    text = codec.encode_message(data)
+    assert text.startswith(f"{codec.V3_HEADER}\n")
+    decoded = codec.decode_message(text)
+    assert isinstance(decoded, FixedPointData)
+    assert decoded.scale == data.scale
+    assert decoded == data
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        triples_data(),
+        fixed_point.to_fixed_point(triples_data(), 3),
+        {"food": Category(Decimal("1.5"), Decimal("1")), "note": ["a", 1]},
+    ],
+)
+def test_dumps_loads_round_trip(data):
+    loaded = codec.loads_data(codec.dumps_data(data))
+    assert type(loaded) is type(data)
+    assert loaded == data
+
+
+@pytest.mark.parametrize("value", ["Infinity", "-Infinity", "NaN", "sNaN"])
+def test_non_finite_amounts_fall_back_to_v1(value):
+    data = {
+        "food": Category(Decimal("100"), Decimal("95")),
+        "x": Category(Decimal(value), Decimal(value)),
+    }
+    text = codec.encode_message(data)
+    assert text.startswith(f"{codec.DATA_HEADER}\n")
+    decoded = codec.decode_message(text)
+    assert decoded["food"] == Category(Decimal("100"), Decimal("95"))
+    # Kept, but not as a category that would be counted
+    assert decoded["x"] == {"limit": value, "balance": value}
+    assert codec.loads_data(codec.dumps_data(data)) == decoded
+
+
+def test_non_finite_amounts_of_old_v2_messages_are_read():
+    text = f'{codec.V2_HEADER}\n[["food",100,95],["x",Infinity,NaN]]'
+    decoded = codec.decode_message(text)
+    assert decoded["food"] == Category(Decimal("100"), Decimal("95"))
+    assert not isinstance(decoded["x"], Category)
+    assert decoded["x"]["limit"] == Decimal("Infinity")
+
+
+def test_huge_amounts_are_not_categories():
+    decoded = codec.decode_message(f'{codec.V2_HEADER}\n[["big",1e5000,1]]')
+    assert not isinstance(decoded["big"], Category)
+    data = {"big": {"limit": Decimal("1e5000"), "balance": Decimal("1")}}
+    codec.normalize_data_to_decimals(data)
+    assert not isinstance(data["big"], Category)
+    assert fixed_point.to_fixed_point(
+        {"big": Category(Decimal("1e5000"), Decimal("1"))}, 2
+    ) == {"big": Category(Decimal("1e5000"), Decimal("1"))}
@@ -0,0 +1,116 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import dedupe
+from dedupe import DedupeIndex
+
+
+def message_update(message_id: int, update_id: int = 0):
+    message = SimpleNamespace(chat_id=1, message_id=message_id)
+    return SimpleNamespace(message=message, update_id=update_id)
+
+
+@pytest.fixture
+def index(monkeypatch):
+    fresh = DedupeIndex(100, 60)
+    monkeypatch.setattr(dedupe, "index", fresh)
+    return fresh
+
+
+def test_redelivered_message_is_the_same_key():
+    first = message_update(5, update_id=10)
+    again = message_update(5, update_id=11)
+    assert dedupe.update_key(first) == dedupe.update_key(again) == (1, 5)
+    button = SimpleNamespace(message=None, update_id=12)
+    assert dedupe.update_key(button) == (0, 12)
+
+
+def test_claimed_keys_are_refused_until_released():
+    index = DedupeIndex(100, 60)
+    assert index.claim((1, 1))
+    assert not index.claim((1, 1))
+    index.release((1, 1))
+    assert index.claim((1, 1))
+    index.commit((1, 1))
+    assert not index.claim((1, 1))
+
+
+def test_oldest_keys_are_evicted(monkeypatch):
+    index = DedupeIndex(2, 60)
+    for message_id in range(3):
+        index.claim((1, message_id))
+    assert len(index) == 2
+    assert index.claim((1, 0))
+    now = dedupe.time.time()
+    monkeypatch.setattr(dedupe.time, "time", lambda: now + 61)
+    assert index.claim((1, 2))
+
+
+def test_handled_keys_survive_a_restart(tmp_path):
+    path = str(tmp_path / "handled")
+    index = DedupeIndex(100, 60)
+    index.open(path)
+    index.claim((1, 1))
+    index.commit((1, 1))
+    # Claimed but never handled, e.g. the process died meanwhile
+    index.claim((1, 2))
+    index.close()
+    with open(path, "a") as file:
+        file.write("1 3")
+    restarted = DedupeIndex(100, 60)
+    restarted.open(path)
+    assert not restarted.claim((1, 1))
+    assert restarted.claim((1, 2))
+    assert restarted.claim((1, 3))
+    restarted.close()
+
+
+def test_duplicates_are_skipped_while_the_first_is_handled(index):
+    calls = []
+
+    @dedupe.exactly_once
+    async def handler(update, context):
+        calls.append(update.update_id)
+        await asyncio.sleep(0.01)
+        return "done"
+
+    async def run():
+        return await asyncio.gather(
+            handler(message_update(1, 1), None), handler(message_update(1, 2), None)
+        )
+
+    assert asyncio.run(run()) == ["done", None]
+    assert asyncio.run(handler(message_update(1, 3), None)) is None
+    assert calls == [1]
+
+
+def test_failed_updates_are_handled_again(index):
+    calls = []
+
+    @dedupe.exactly_once
+    async def raising(update, context):
+        calls.append("raised")
+        raise ValueError
+
+    @dedupe.exactly_once
+    async def reporting(update, context):
+        calls.append("reported")
+        # Like a handler answering the error of a failed change itself
+        dedupe.report_failure()
+
+    @dedupe.exactly_once
+    async def succeeding(update, context):
+        calls.append("handled")
+
+    with pytest.raises(ValueError):
+        asyncio.run(raising(message_update(1), None))
+    asyncio.run(reporting(message_update(1), None))
+    asyncio.run(succeeding(message_update(1), None))
+    asyncio.run(succeeding(message_update(1), None))
+    assert calls == ["raised", "reported", "handled"]
+
+
+def test_report_failure_outside_a_handler_does_nothing():
+    dedupe.report_failure()
@@ -0,0 +1,119 @@
+import asyncio
+from decimal import Decimal
+
+import fixed_point
+import ledger
+from budget import Category
+from ledger import Event
+from storage import SqliteStorage
+
+EVENTS = [
+    Event(ledger.UPSERT, "food", Decimal("100")),
+    Event(ledger.UPSERT, "cat", Decimal("20")),
+    Event(ledger.SPEND, "food", Decimal("12.5")),
+    Event(ledger.SPEND, "cat", Decimal("3")),
+    Event(ledger.LIMIT, "food", Decimal("150")),
+    Event(ledger.SPEND, "food", Decimal("0.125")),
+    Event(ledger.UPSERT, "rent", Decimal("500")),
+    Event(ledger.DELETE, "cat"),
+    Event(ledger.SPEND, "rent", Decimal("-10")),
+]
+# A limit raised by 50 lowers the balance by 50, as the bot always did
+EXPECTED = {
+    "food": Category(Decimal("150"), Decimal("37.375")),
+    "rent": Category(Decimal("500"), Decimal("510")),
+}
+
+
+def replay(data, events):
+    for event in events:
+        ledger.apply_event(data, event)
+    return data
+
+
+def test_replay_with_decimals():
+    assert replay({}, EVENTS) == EXPECTED
+
+
+def test_replay_with_fixed_point_rescales():
+    data = replay(fixed_point.to_fixed_point({}, 2), EVENTS)
+    assert data.scale == 3
+    assert fixed_point.to_decimals(data) == EXPECTED
+
+
+def test_reset_keeps_other_values():
+    data = replay({"note": "hi"}, EVENTS + [Event(ledger.RESET)])
+    assert data["note"] == "hi"
+    assert data["food"] == Category(Decimal("150"), Decimal("150"))
+
+
+async def append_all(storage, chat_id, events, data):
+    for event in events:
+        ledger.apply_event(data, event)
+        await storage.append(None, chat_id, [event], data)
+
+
+def test_sqlite_rebuilds_from_snapshot_and_journal(tmp_path):
+    async def run(snapshot_every):
+        path = str(tmp_path / f"{snapshot_every}.db")
+        storage = SqliteStorage(path, snapshot_every)
+        await append_all(storage, 1, EVENTS, {})
+        await storage.close()
+        # A new process reads the latest snapshot and the journal after it
+        storage = SqliteStorage(path, snapshot_every)
+        loaded = await storage.load(None, 1)
+        history = await storage.history(1, 100)
+        await storage.close()
+        return loaded, history
+
+    for snapshot_every in (1, 3, 100):
+        loaded, history = asyncio.run(run(snapshot_every))
+        assert loaded == EXPECTED
+        assert [(e.op, e.type, e.amount) for e in reversed(history)] == [
+            (e.op, e.type, e.amount) for e in EVENTS
+        ]
+
+
+def test_sqlite_snapshots_every_few_changes(tmp_path):
+    async def run():
+        storage = SqliteStorage(str(tmp_path / "db"), 3)
+        await append_all(storage, 1, EVENTS, {})
+        journal_id = storage._db.execute(
+            "SELECT journal_id FROM snapshots WHERE chat_id = 1"
+        ).fetchone()[0]
+        await storage.close()
+        return journal_id
+
+    # The first change and every 3 after it are snapshotted: 1, 5 and 9
+    assert asyncio.run(run()) == 9
+
+
+def test_sqlite_keeps_chats_apart(tmp_path):
+    async def run():
+        storage = SqliteStorage(str(tmp_path / "db"))
+        await append_all(storage, 1, EVENTS, {})
+        await append_all(storage, 2, EVENTS[:2], {})
+        loaded = [await storage.load(None, chat_id) for chat_id in (1, 2, 3)]
+        await storage.close()
+        return loaded
+
+    first, second, third = asyncio.run(run())
+    assert first == EXPECTED
+    assert second == {
+        "food": Category(Decimal("100"), Decimal("100")),
+        "cat": Category(Decimal("20"), Decimal("20")),
+    }
+    assert third is None
+
+
+def test_sqlite_replaced_data_is_snapshotted(tmp_path):
+    async def run():
+        storage = SqliteStorage(str(tmp_path / "db"))
+        await append_all(storage, 1, EVENTS, {})
+        data = {"other": Category(Decimal("1"), Decimal("1"))}
+        await storage.save(None, 1, data)
+        loaded = await storage.load(None, 1)
+        await storage.close()
+        return loaded
+
+    assert asyncio.run(run()) == {"other": Category(Decimal("1"), Decimal("1"))}
@@ -0,0 +1,170 @@
+import asyncio
+from datetime import timedelta
+from types import SimpleNamespace
+
+from telegram.error import RetryAfter
+
+import outbound
+import tg_helper
+from outbound import OutboundScheduler
+
+
+def scheduler(max_retries=3) -> OutboundScheduler:
+    # No rate limits, the order only depends on priorities
+    return OutboundScheduler(0, 1, 0, max_retries)
+
+
+class Blocker:
+    def __init__(self):
+        self.release = asyncio.Event()
+        self.calls = []
+
+    # Holds the worker of the chat until released, so jobs queue behind it
+    async def block(self, text):
+        await self.release.wait()
+        return "first"
+
+    def record(self, name):
+        async def call(text):
+            self.calls.append((name, text))
+            return name
+
+        return call
+
+
+def test_jobs_are_sent_in_priority_order():
+    async def run():
+        sender = scheduler()
+        blocker = Blocker()
+        first = asyncio.create_task(sender.send(1, outbound.REPLY, "m", blocker.block))
+        await asyncio.sleep(0)
+        sends = [
+            sender.send(1, priority, "m", blocker.record(name))
+            for priority, name in (
+                (outbound.BULK, "bulk"),
+                (outbound.REPLY, "reply"),
+                (outbound.STATE, "state"),
+            )
+        ]
+        tasks = [asyncio.create_task(send) for send in sends]
+        await asyncio.sleep(0)
+        blocker.release.set()
+        results = await asyncio.gather(first, *tasks)
+        return results, [name for name, _ in blocker.calls]
+
+    results, order = asyncio.run(run())
+    assert results == ["first", "bulk", "reply", "state"]
+    assert order == ["state", "reply", "bulk"]
+
+
+def test_waiting_replies_with_the_same_key_are_merged():
+    async def run():
+        sender = scheduler()
+        blocker = Blocker()
+        first = asyncio.create_task(sender.send(1, outbound.REPLY, "m", blocker.block))
+        await asyncio.sleep(0)
+        tasks = [
+            asyncio.create_task(
+                sender.send(1, outbound.REPLY, "m", blocker.record(text), text, key)
+            )
+            for text, key in (("a", "k"), ("b", "other"), ("c", "k"))
+        ]
+        await asyncio.sleep(0)
+        blocker.release.set()
+        await asyncio.gather(first, *tasks)
+        return blocker.calls, len(sender)
+
+    calls, left = asyncio.run(run())
+    assert calls == [("a", "a\n\nc"), ("b", "b")]
+    assert left == 0
+
+
+def test_rate_limited_calls_are_retried():
+    async def run():
+        sender = scheduler()
+        attempts = []
+
+        async def call(text):
+            attempts.append(text)
+            if len(attempts) < 3:
+                raise RetryAfter(timedelta(seconds=0))
+            return "sent"
+
+        return await sender.send(1, outbound.REPLY, "m", call, "hi"), attempts
+
+    assert asyncio.run(run()) == ("sent", ["hi", "hi", "hi"])
+
+
+def test_rate_limit_is_raised_after_max_retries():
+    async def run():
+        sender = scheduler(max_retries=1)
+
+        async def call(text):
+            raise RetryAfter(0)
+
+        try:
+            await sender.send(1, outbound.REPLY, "m", call)
+        except RetryAfter:
+            return "raised"
+
+    assert asyncio.run(run()) == "raised"
+
+
+def test_workers_are_kept_until_done():
+    async def run():
+        sender = scheduler()
+        blocker = Blocker()
+        first = asyncio.create_task(sender.send(1, outbound.REPLY, "m", blocker.block))
+        await asyncio.sleep(0)
+        during = list(sender._workers)
+        blocker.release.set()
+        await first
+        await asyncio.sleep(0)
+        return during, list(sender._workers)
+
+    assert asyncio.run(run()) == ([1], [])
+
+
+def test_bulk_messages_are_not_merged_with_replies():
+    async def run():
+        sent = []
+        release = asyncio.Event()
+
+        async def send_message(chat_id, text, **kwargs):
+            await release.wait()
+            sent.append(text)
+
+        app = SimpleNamespace(bot=SimpleNamespace(send_message=send_message))
+        tasks = [
+            asyncio.create_task(tg_helper.send_text(app, 7, text, priority))
+            for text, priority in (
+                ("first", outbound.REPLY),
+                ("summary 1", outbound.BULK),
+                ("reply", outbound.REPLY),
+                ("summary 2", outbound.BULK),
+            )
+        ]
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(*tasks)
+        return sent
+
+    assert asyncio.run(run()) == ["first\n\nreply", "summary 1\n\nsummary 2"]
+
+
+def test_callback_answers_are_retried():
+    async def run():
+        answers = []
+
+        async def answer(text):
+            answers.append(text)
+            if len(answers) == 1:
+                raise RetryAfter(0)
+            return True
+
+        query = SimpleNamespace(
+            message=SimpleNamespace(chat=SimpleNamespace(id=8)), answer=answer
+        )
+        return await tg_helper.answer_callback(query, "Spent"), answers
+
+    assert asyncio.run(run()) == (True, ["Spent", "Spent"])
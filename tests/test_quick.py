@@ -0,0 +1,59 @@
+from decimal import Decimal
+
+import pytest
+
+import quick
+
+
+def callback_data(markup) -> list[str]:
+    return [button.callback_data for row in markup.inline_keyboard for button in row]
+
+
+def test_keyboards_parse_back():
+    for data in callback_data(quick.categories_keyboard(["food", "rent"])):
+        action, type, amount = quick.parse_callback(data)
+        assert action == quick.CATEGORY and amount is None
+        for spend in callback_data(quick.amounts_keyboard(type)):
+            parsed = quick.parse_callback(spend)
+            if parsed[0] == quick.BACK:
+                assert parsed == (quick.BACK, None, None)
+            else:
+                assert parsed[:2] == (quick.SPEND, type)
+                assert parsed[2] in quick.QUICK_AMOUNTS
+
+
+@pytest.mark.parametrize(
+    "data, parsed",
+    [
+        ("q:b", (quick.BACK, None, None)),
+        ("q:c:food", (quick.CATEGORY, "food", None)),
+        ("q:c:a:b", (quick.CATEGORY, "a:b", None)),
+        ("q:s:12.5:food", (quick.SPEND, "food", Decimal("12.5"))),
+        # Names may have colons, the amount never has
+        ("q:s:5:rent:flat", (quick.SPEND, "rent:flat", Decimal("5"))),
+    ],
+)
+def test_parse_callback(data, parsed):
+    assert quick.parse_callback(data) == parsed
+
+
+FORGED = ["q:", "q:c", "q:c:", "q:s:5", "q:s:5:", "q:s::food", "q:s:ten:food", "q:x:1"]
+
+
+@pytest.mark.parametrize(
+    "data", FORGED + ["q:s:NaN:food", "q:s:Infinity:food", "q:s:1e5000:food"]
+)
+def test_forged_callback_data_is_refused(data):
+    with pytest.raises(ValueError):
+        quick.parse_callback(data)
+
+
+def test_names_too_long_for_callback_data_are_left_out():
+    long_name = "x" * 60
+    data = callback_data(quick.categories_keyboard(["food", long_name]))
+    assert data == ["q:c:food"]
+
+
+def test_at_most_one_keyboard_of_categories():
+    types = [f"c{index}" for index in range(150)]
+    assert len(callback_data(quick.categories_keyboard(types))) == 99
@@ -0,0 +1,118 @@
+import asyncio
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import pytest
+
+import schedules
+from schedules import MONTHLY, WEEKLY, Schedule, ScheduleStore, next_reset
+
+
+def at(text: str, timezone: str = "UTC") -> float:
+    return datetime.fromisoformat(text).replace(tzinfo=ZoneInfo(timezone)).timestamp()
+
+
+@pytest.mark.parametrize(
+    "schedule, after, expected",
+    [
+        (Schedule(MONTHLY, 1, "UTC"), "2026-10-16 12:00", "2026-11-01 00:00"),
+        (Schedule(MONTHLY, 20, "UTC"), "2026-10-16 12:00", "2026-10-20 00:00"),
+        # A reset exactly at midnight is followed by the next month's
+        (Schedule(MONTHLY, 1, "UTC"), "2026-11-01 00:00", "2026-12-01 00:00"),
+        (Schedule(MONTHLY, 5, "UTC"), "2026-12-10 00:00", "2027-01-05 00:00"),
+        # Months without the day reset on their last one
+        (Schedule(MONTHLY, 31, "UTC"), "2027-02-01 00:00", "2027-02-28 00:00"),
+        (Schedule(MONTHLY, 31, "UTC"), "2028-02-01 00:00", "2028-02-29 00:00"),
+        (Schedule(MONTHLY, 31, "UTC"), "2027-02-28 00:00", "2027-03-31 00:00"),
+        # 2026-10-16 is a Friday
+        (Schedule(WEEKLY, 0, "UTC"), "2026-10-16 12:00", "2026-10-19 00:00"),
+        (Schedule(WEEKLY, 4, "UTC"), "2026-10-16 12:00", "2026-10-23 00:00"),
+        (Schedule(WEEKLY, 4, "UTC"), "2026-10-15 23:59", "2026-10-16 00:00"),
+    ],
+)
+def test_next_reset(schedule, after, expected):
+    assert next_reset(schedule, at(after)) == at(expected)
+
+
+def test_next_reset_is_midnight_in_the_timezone():
+    schedule = Schedule(MONTHLY, 1, "Asia/Tokyo")
+    # 2026-10-31 16:00 UTC is already November 1st in Tokyo
+    after = at("2026-10-31 14:00")
+    assert next_reset(schedule, after) == at("2026-11-01 00:00", "Asia/Tokyo")
+    assert next_reset(schedule, at("2026-10-31 15:00")) == at(
+        "2026-12-01 00:00", "Asia/Tokyo"
+    )
+
+
+def test_weekly_reset_across_a_clock_change():
+    # Berlin leaves summer time on 2026-10-25, that week is 169 hours long
+    schedule = Schedule(WEEKLY, 0, "Europe/Berlin")
+    first = next_reset(schedule, at("2026-10-18 12:00", "Europe/Berlin"))
+    second = next_reset(schedule, first)
+    assert first == at("2026-10-19 00:00", "Europe/Berlin")
+    assert second == at("2026-10-26 00:00", "Europe/Berlin")
+    assert second - first == 7 * 86400 + 3600
+
+
+@pytest.mark.parametrize(
+    "args, schedule",
+    [
+        (["monthly"], Schedule(MONTHLY, 1, schedules.RESET_TIMEZONE)),
+        (["monthly", "15", "Europe/Berlin"], Schedule(MONTHLY, 15, "Europe/Berlin")),
+        (["weekly", "Friday"], Schedule(WEEKLY, 4, schedules.RESET_TIMEZONE)),
+    ],
+)
+def test_parse_schedule(args, schedule):
+    assert schedules.parse_schedule(args) == schedule
+
+
+@pytest.mark.parametrize(
+    "args",
+    [
+        [],
+        ["daily"],
+        ["monthly", "32"],
+        ["monthly", "first"],
+        ["weekly", "someday"],
+        ["weekly", "mon", "Mars/Base"],
+        ["monthly", "1", "UTC", "extra"],
+    ],
+)
+def test_invalid_schedules_are_refused(args):
+    with pytest.raises(ValueError):
+        schedules.parse_schedule(args)
+
+
+def test_store_pops_due_chats_once_per_reset(tmp_path, monkeypatch):
+    monkeypatch.setattr(schedules.time, "time", lambda: at("2026-10-16 12:00"))
+    store = ScheduleStore()
+    store.open(str(tmp_path / "schedules.json"))
+    store.set(1, Schedule(MONTHLY, 1, "UTC"))
+    store.set(2, Schedule(WEEKLY, 0, "UTC"))
+    store.set(3, Schedule(WEEKLY, 0, "UTC"))
+    assert store.remove(3)
+    assert not store.remove(3)
+    assert store.pop_due(at("2026-10-18 00:00")) == []
+    assert store.pop_due(at("2026-10-19 00:00")) == [2]
+    assert store.pop_due(at("2026-10-19 01:00")) == []
+    assert store.pop_due(at("2026-11-02 00:00")) == [2, 1]
+    # Saved once the resets ran, like run_scheduled_resets does
+    store.save()
+
+    reopened = ScheduleStore()
+    reopened.open(str(tmp_path / "schedules.json"))
+    assert len(reopened) == 2
+    assert reopened.get(1) == Schedule(MONTHLY, 1, "UTC")
+    assert reopened.pop_due(at("2026-11-09 00:00")) == [2]
+
+
+def test_run_batch_keeps_going_after_a_failure():
+    done = []
+
+    async def reset(chat_id):
+        if chat_id == 2:
+            raise RuntimeError("down")
+        done.append(chat_id)
+
+    asyncio.run(schedules.run_batch([1, 2, 3], reset, 2))
+    assert done == [1, 3]
@@ -0,0 +1,60 @@
+import json
+
+import pytest
+
+from sharding import ShardedWebhook, shard_for, update_chat_id
+
+CHAT = {"id": -1001, "type": "supergroup"}
+USER = {"id": 42, "is_bot": False, "first_name": "A"}
+
+
+@pytest.mark.parametrize(
+    "update, chat_id",
+    [
+        ({"update_id": 1, "message": {"chat": CHAT, "from": USER}}, -1001),
+        ({"update_id": 1, "edited_message": {"chat": CHAT}}, -1001),
+        ({"update_id": 1, "my_chat_member": {"chat": CHAT, "from": USER}}, -1001),
+        (
+            {
+                "update_id": 1,
+                "callback_query": {"from": USER, "message": {"chat": CHAT}},
+            },
+            -1001,
+        ),
+        # A button of an inline message has no message, only its presser
+        ({"update_id": 1, "callback_query": {"from": USER}}, 42),
+        ({"update_id": 1, "inline_query": {"from": USER, "query": ""}}, 42),
+        ({"update_id": 1}, 0),
+    ],
+)
+def test_update_chat_id(update, chat_id):
+    assert update_chat_id(update) == chat_id
+
+
+def test_chats_stay_on_one_worker():
+    assert shard_for(-1001, 4) == shard_for(-1001, 4) == -1001 % 4
+    assert {shard_for(chat_id, 4) for chat_id in range(100)} == {0, 1, 2, 3}
+
+
+def test_route_puts_updates_into_the_queue_of_their_chat():
+    webhook = ShardedWebhook(lambda index: None, 3, 1)
+    body = json.dumps({"update_id": 1, "message": {"chat": {"id": 5}}}).encode()
+    assert webhook.route(body) == 2
+    assert webhook.shards[2].queue.get_nowait() == body
+
+
+def test_route_refuses_updates_when_the_queue_is_full():
+    webhook = ShardedWebhook(lambda index: None, 2, 1)
+    body = json.dumps({"update_id": 1, "message": {"chat": {"id": 4}}}).encode()
+    assert webhook.route(body) == 0
+    assert webhook.route(body) is None
+    other = json.dumps({"update_id": 2, "message": {"chat": {"id": 3}}}).encode()
+    assert webhook.route(other) == 1
+
+
+def test_route_rejects_malformed_updates():
+    webhook = ShardedWebhook(lambda index: None, 2, 1)
+    with pytest.raises(ValueError):
+        webhook.route(b"not json")
+    with pytest.raises(KeyError):
+        webhook.route(json.dumps({"message": {}}).encode())
@@ -0,0 +1,50 @@
+from decimal import Decimal
+
+import pytest
+
+from spend_filter import parse_spend_items
+
+
+@pytest.mark.parametrize(
+    "text, items",
+    [
+        ("12.5 food", [(Decimal("12.5"), "food")]),
+        ("  -3 food refund of lunch", [(Decimal("-3"), "food")]),
+        (".5 food", [(Decimal(".5"), "food")]),
+        ("1e2 rent", [(Decimal("100"), "rent")]),
+        ("2E-1 cat", [(Decimal("0.2"), "cat")]),
+        (
+            "10 food, 5 cat",
+            [(Decimal("10"), "food"), (Decimal("5"), "cat")],
+        ),
+        (
+            "10 food\n\n5 cat treats\n",
+            [(Decimal("10"), "food"), (Decimal("5"), "cat")],
+        ),
+    ],
+)
+def test_spends_are_parsed(text, items):
+    assert parse_spend_items(text) == items
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "",
+        "\n \n",
+        "hello there",
+        "food 10",
+        "10",
+        "10food",
+        "NaN food",
+        "Infinity food",
+        "1e999999 food",
+        "1e100 food",
+        "1234567890123456 food",
+        "10 food, 1e20 cat",
+        "10 food\nhello there",
+        "0x10 food",
+    ],
+)
+def test_other_messages_are_not_spends(text):
+    assert parse_spend_items(text) is None
@@ -0,0 +1,137 @@
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import spending
+from spending import MONTH, WEEK, SpendColumns, SpendingStore
+
+
+def at(text: str) -> float:
+    return datetime.fromisoformat(text).replace(tzinfo=ZoneInfo("UTC")).timestamp()
+
+
+NOW = at("2026-10-16 12:00")
+
+
+def columns(rows) -> SpendColumns:
+    result = SpendColumns()
+    result.append([(at(ts), name, amount) for ts, name, amount in rows])
+    result.loaded = True
+    return result
+
+
+HISTORY = [
+    ("2026-09-30 23:00", "food", 100.0),
+    ("2026-10-01 00:00", "food", 12.5),
+    ("2026-10-05 10:00", "rent", 500.0),
+    ("2026-10-12 00:00", "food", 7.5),
+    ("2026-10-15 09:00", "cat", 30.0),
+    ("2026-10-16 11:00", "food", -5.0),
+]
+
+
+def test_category_totals_are_of_the_period():
+    start, end = at("2026-10-01 00:00"), at("2026-11-01 00:00")
+    totals = spending.category_totals(columns(HISTORY), start, end)
+    assert dict(zip(totals.names, totals.spent.tolist())) == {
+        "food": 15.0,
+        "rent": 500.0,
+        "cat": 30.0,
+    }
+    assert totals.count == 5
+
+
+def test_period_totals():
+    boundaries = [at(f"2026-{month:02}-01 00:00") for month in (8, 9, 10, 11)]
+    totals = spending.period_totals(columns(HISTORY), boundaries)
+    assert totals.tolist() == [0.0, 100.0, 545.0]
+
+
+def test_period_start():
+    assert spending.period_start(WEEK, NOW, "UTC") == at("2026-10-12 00:00")
+    assert spending.period_start(MONTH, NOW, "UTC", 1) == at("2026-11-01 00:00")
+    assert spending.period_start(MONTH, NOW, "UTC", -10) == at("2025-12-01 00:00")
+    assert spending.period_days(MONTH, at("2027-02-01 00:00"), "UTC") == 28
+
+
+def test_top_report():
+    report = spending.top_report(columns(HISTORY), MONTH, NOW, "UTC", 2)
+    assert report == "Top categories this month:\nrent: 500 (92%)\ncat: 30 (6%)"
+
+
+def test_top_report_with_refunds_above_the_spending():
+    history = [
+        ("2026-10-02 00:00", "food", 20.0),
+        ("2026-10-03 00:00", "rent", -50.0),
+    ]
+    report = spending.top_report(columns(history), MONTH, NOW, "UTC", 5)
+    assert report == "Top categories this month:\nfood: 20"
+    history.append(("2026-10-04 00:00", "rent", 30.0))
+    report = spending.top_report(columns(history), MONTH, NOW, "UTC", 5)
+    assert report == "Top categories this month:\nfood: 20"
+
+
+def test_top_report_without_spending():
+    refund = [("2026-10-02 00:00", "food", -20.0)]
+    for rows in ([], refund):
+        report = spending.top_report(columns(rows), WEEK, NOW, "UTC", 5)
+        assert report == "Nothing spent this week."
+
+
+def test_period_report():
+    report = spending.period_report(columns(HISTORY), MONTH, NOW, "UTC", 2)
+    assert report == (
+        "Spending by month:\n2026-09: 100\n2026-10: 545\n\nAverage: 322.5"
+    )
+
+
+def test_category_report():
+    report = spending.category_report(
+        columns(HISTORY), WEEK, NOW, "UTC", {"food": 50.0, "cat": 20.0}
+    )
+    assert report.splitlines()[:4] == [
+        "Spending this week, 3 spends:",
+        "food: 2.5 / 50",
+        "cat: 30 / 20",
+        "",
+    ]
+
+
+def test_store_appends_and_reads_back(tmp_path):
+    store = SpendingStore(10, 60)
+    store.open(str(tmp_path))
+    store.append(1, [(1.0, "food", 10.0), (2.0, "cat", 2.5)])
+    store.append(1, [(3.0, "food", 1.0)])
+    store.append(2, [(4.0, "rent", 500.0)])
+    restarted = SpendingStore(10, 60)
+    restarted.open(str(tmp_path))
+    history = restarted.get(1)
+    assert history.names == ["food", "cat"]
+    assert list(history.ts) == [1.0, 2.0, 3.0]
+    assert list(history.category) == [0, 1, 0]
+    assert list(history.amount) == [10.0, 2.5, 1.0]
+    assert restarted.recent_chats(5, lambda chat_id: chat_id != 2) == [1]
+    restarted.clear(1)
+    assert len(restarted.get(1)) == 0
+
+
+def test_store_drops_rows_cut_short_by_a_crash(tmp_path):
+    store = SpendingStore(10, 60)
+    store.open(str(tmp_path))
+    store.append(1, [(1.0, "food", 10.0)])
+    # The last row only got as far as its time and category, with a name
+    # whose line wasn't finished
+    with open(tmp_path / "1.ts", "ab") as file:
+        file.write(spending.array("d", [2.0]).tobytes())
+    with open(tmp_path / "1.category", "ab") as file:
+        file.write(spending.array("I", [1]).tobytes())
+    with open(tmp_path / "1.names", "a") as file:
+        file.write('"ca')
+    restarted = SpendingStore(10, 60)
+    restarted.open(str(tmp_path))
+    restarted.append(1, [(3.0, "cat", 1.0)])
+    history = SpendingStore(10, 60)
+    history.open(str(tmp_path))
+    columns = history.get(1)
+    assert columns.names == ["food", "cat"]
+    assert list(columns.ts) == [1.0, 3.0]
+    assert list(columns.amount) == [10.0, 1.0]
@@ -0,0 +1,188 @@
+import asyncio
+import time
+
+import write_behind
+from write_behind import CircuitBreaker, WriteBehind
+
+
+class Recorder:
+    def __init__(self):
+        self.writes = []
+
+    async def __call__(self, value):
+        self.writes.append((value, time.monotonic()))
+
+    @property
+    def values(self):
+        return [value for value, _ in self.writes]
+
+
+def test_writes_only_the_latest_value_after_a_quiet_period():
+    async def run():
+        writer = WriteBehind(0.05, 1)
+        write = Recorder()
+        for value in range(5):
+            writer.schedule("chat", value, write)
+            await asyncio.sleep(0.01)
+        assert write.values == []
+        await asyncio.sleep(0.1)
+        return write.values, len(writer)
+
+    assert asyncio.run(run()) == ([4], 0)
+
+
+def test_keeps_writing_under_steady_changes():
+    async def run():
+        writer = WriteBehind(0.05, 0.1)
+        write = Recorder()
+        start = time.monotonic()
+        for value in range(20):
+            writer.schedule("chat", value, write)
+            await asyncio.sleep(0.01)
+        await writer.flush()
+        return start, write.writes
+
+    start, writes = asyncio.run(run())
+    # A value is never held back more than max_delay after the first one
+    assert writes[0][1] - start < 0.15
+    assert writes[-1][0] == 19
+    assert len(writes) >= 2
+
+
+def test_keys_are_written_separately():
+    async def run():
+        writer = WriteBehind(0.01, 1)
+        first, second = Recorder(), Recorder()
+        writer.schedule(1, "a", first)
+        writer.schedule(2, "b", second)
+        writer.schedule(1, "c", first)
+        await asyncio.sleep(0.05)
+        return first.values, second.values
+
+    assert asyncio.run(run()) == (["c"], ["b"])
+
+
+def test_flush_writes_right_away():
+    async def run():
+        writer = WriteBehind(10, 10)
+        write = Recorder()
+        writer.schedule("chat", 1, write)
+        assert writer.has_pending("chat")
+        assert writer.pending_value("chat") == 1
+        await asyncio.wait_for(writer.flush(), 1)
+        return write.values, writer.has_pending("chat")
+
+    assert asyncio.run(run()) == ([1], False)
+
+
+def test_failed_write_is_dropped_without_retriable():
+    async def run():
+        writer = WriteBehind(0.01, 1)
+        write = Recorder()
+
+        async def fail(value):
+            raise ValueError(value)
+
+        writer.schedule("chat", 1, fail)
+        await asyncio.sleep(0.05)
+        writer.schedule("chat", 2, write)
+        await asyncio.sleep(0.05)
+        return write.values, len(writer)
+
+    assert asyncio.run(run()) == ([2], 0)
+
+
+def test_breaker_opens_after_failures_in_a_row(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(write_behind.time, "monotonic", lambda: now[0])
+    breaker = CircuitBreaker(2, 10)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.closed and breaker.try_acquire()
+    breaker.record_failure()
+    assert not breaker.closed
+    assert not breaker.try_acquire()
+    assert breaker.wait_time() == 10
+    now[0] += 10
+    # A single call probes the service after the cooldown
+    assert breaker.try_acquire()
+    assert not breaker.try_acquire()
+    breaker.record_failure()
+    assert breaker.wait_time() == 10
+    now[0] += 10
+    assert breaker.try_acquire()
+    breaker.record_success()
+    assert breaker.closed and breaker.wait_time() == 0
+
+
+def test_failed_writes_are_retried_with_backoff():
+    async def run():
+        attempts = []
+
+        async def flaky(value):
+            attempts.append(time.monotonic())
+            if len(attempts) < 3:
+                raise ConnectionError("down")
+
+        writer = WriteBehind(
+            0, 0, retriable=lambda e: isinstance(e, ConnectionError), retry_delay=0.02
+        )
+        writer.schedule("chat", 1, flaky)
+        await asyncio.sleep(0.2)
+        return attempts, len(writer)
+
+    attempts, pending = asyncio.run(run())
+    assert len(attempts) == 3 and pending == 0
+    # 0.02 then 0.04 seconds between the attempts
+    assert attempts[2] - attempts[1] > attempts[1] - attempts[0] >= 0.02
+
+
+def test_open_breaker_holds_writes_until_a_probe_succeeds(monkeypatch):
+    async def run():
+        breaker = CircuitBreaker(1, 0.05)
+        writer = WriteBehind(
+            0,
+            0,
+            retriable=lambda e: isinstance(e, ConnectionError),
+            retry_delay=0.01,
+            breaker=breaker,
+        )
+        down = [True]
+        written = []
+
+        async def write(value):
+            if down[0]:
+                raise ConnectionError("down")
+            written.append(value)
+
+        writer.schedule(1, "a", write)
+        await asyncio.sleep(0.01)
+        assert not breaker.closed
+        writer.schedule(2, "b", write)
+        await asyncio.sleep(0.02)
+        # Nothing is tried while the breaker is open
+        assert written == [] and len(writer) == 2
+        down[0] = False
+        await asyncio.sleep(0.2)
+        return written, breaker.closed
+
+    written, closed = asyncio.run(run())
+    assert sorted(written) == ["a", "b"] and closed
+
+
+def test_a_bad_write_does_not_open_the_breaker():
+    async def run():
+        breaker = CircuitBreaker(1, 60)
+        writer = WriteBehind(
+            0, 0, retriable=lambda e: isinstance(e, ConnectionError), breaker=breaker
+        )
+
+        async def bad(value):
+            raise ValueError("too long")
+
+        writer.schedule(1, "a", bad)
+        await asyncio.sleep(0.02)
+        return breaker.closed, len(writer)
+
+    assert asyncio.run(run()) == (True, 0)